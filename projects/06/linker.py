@@ -0,0 +1,179 @@
+import os
+import sys
+import argparse
+import traceback
+from typing import Dict, List, Tuple
+
+from assembler import Parser, Code, SymbolTable
+
+ROM_SIZE = 32768
+
+
+class HackObject:
+    """A relocatable unit of Hack machine code.
+
+    words holds the encoded instructions, with 0 in place of every
+    A-instruction whose symbol is only resolved at link time; refs lists
+    those as (word offset, symbol). labels maps each label the unit defines
+    to its word offset.
+
+    On disk it is a text file:
+        hobj <name>
+        label <symbol> <offset>
+        ref <offset> <symbol>
+        code <number of words>
+    followed by one 16-bit binary word per line, as in a .hack file.
+    """
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+        self.words: List[int] = []
+        self.labels: Dict[str, int] = {}
+        self.refs: List[Tuple[int, str]] = []
+
+    def write(self, filename: str):
+        with open(filename, 'w') as file:
+            file.write(f'hobj {self.name}\n')
+            for symbol, offset in self.labels.items():
+                file.write(f'label {symbol} {offset}\n')
+            for offset, symbol in self.refs:
+                file.write(f'ref {offset} {symbol}\n')
+            file.write(f'code {len(self.words)}\n')
+            file.write(''.join('{0:016b}\n'.format(word) for word in self.words))
+
+    @staticmethod
+    def read(filename: str) -> 'HackObject':
+        with open(filename, 'r') as file:
+            header = file.readline().split()
+            if len(header) != 2 or header[0] != 'hobj':
+                raise Exception(f'{filename} is not a Hack object file')
+            obj = HackObject(header[1])
+            for line in file:
+                parts = line.split()
+                if parts[0] == 'label':
+                    obj.labels[parts[1]] = int(parts[2])
+                elif parts[0] == 'ref':
+                    obj.refs.append((int(parts[1]), parts[2]))
+                elif parts[0] == 'code':
+                    obj.words = [int(word, 2) for word in file.read().split()]
+                    if len(obj.words) != int(parts[1]):
+                        raise Exception(f'{filename} is truncated')
+                    break
+        return obj
+
+
+def assemble_object(filepath: str) -> HackObject:
+    """Assembles one .asm unit, leaving every symbol but the predefined ones to the linker."""
+    predefined = SymbolTable()
+    obj = HackObject(os.path.splitext(os.path.basename(filepath))[0])
+    parser = Parser(filepath)
+    while parser.has_more_commands():
+        parser.advance()
+        command_type = parser.command_type()
+        if command_type == 'L_COMMAND':
+            obj.labels[parser.symbol()] = len(obj.words)
+        elif command_type == 'A_COMMAND':
+            symbol = parser.symbol()
+            if symbol.isdigit():
+                obj.words.append(int(symbol))
+            elif predefined.contains(symbol):
+                obj.words.append(predefined.get_address(symbol))
+            else:
+                obj.refs.append((len(obj.words), symbol))
+                obj.words.append(0)
+        else:
+            code = '111' + Code.comp(parser.comp()) + Code.dest(parser.dest()) + Code.jump(parser.jmp())
+            obj.words.append(int(code, 2))
+    return obj
+
+
+def link(objects: List[HackObject]) -> List[int]:
+    """Lays objects out in order from ROM address 0 and resolves their refs.
+
+    A ref resolves to a label of its own unit first, then to the label of
+    any other unit. A symbol no unit defines is a variable, given the next
+    RAM slot from 16 in order of first reference, as assembler.py does for
+    a whole program, so linking gives the same words as assembling the
+    units concatenated.
+    """
+    bases: List[int] = []
+    address_by_label: Dict[str, int] = {}
+    defined_by: Dict[str, str] = {}
+    ambiguous: Dict[str, List[str]] = {}
+    base = 0
+    for obj in objects:
+        bases.append(base)
+        for symbol, offset in obj.labels.items():
+            if symbol in defined_by:
+                ambiguous.setdefault(symbol, [defined_by[symbol]]).append(obj.name)
+            address_by_label[symbol] = base + offset
+            defined_by[symbol] = obj.name
+        base += len(obj.words)
+    if base > ROM_SIZE:
+        raise Exception(f'Program takes {base} words, more than the {ROM_SIZE}-word ROM')
+
+    address_by_variable: Dict[str, int] = {}
+    words: List[int] = []
+    for obj, base in zip(objects, bases):
+        unit_words = list(obj.words)
+        for offset, symbol in obj.refs:
+            if symbol in obj.labels:
+                address = base + obj.labels[symbol]
+            elif symbol in ambiguous:
+                raise Exception(f'{obj.name} refers to {symbol}, defined in {", ".join(ambiguous[symbol])}')
+            elif symbol in address_by_label:
+                address = address_by_label[symbol]
+            else:
+                if symbol not in address_by_variable:
+                    address_by_variable[symbol] = 16 + len(address_by_variable)
+                address = address_by_variable[symbol]
+            unit_words[offset] = address
+        words.extend(unit_words)
+    return words
+
+
+def load_object(filepath: str) -> HackObject:
+    """Reads a .hobj, or the .hobj of an .asm, assembling it first if it is missing or stale."""
+    if filepath.endswith('.hobj'):
+        return HackObject.read(filepath)
+    obj_path = os.path.splitext(filepath)[0] + '.hobj'
+    if os.path.exists(obj_path) and os.path.getmtime(obj_path) >= os.path.getmtime(filepath):
+        return HackObject.read(obj_path)
+    obj = assemble_object(filepath)
+    obj.write(obj_path)
+    return obj
+
+
+def expand_inputs(inputs: List[str]) -> List[str]:
+    """Replaces each @file argument with the paths it lists, relative to it."""
+    paths = []
+    for path in inputs:
+        if not path.startswith('@'):
+            paths.append(path)
+            continue
+        with open(path[1:], 'r') as file:
+            directory = os.path.dirname(path[1:])
+            paths.extend(os.path.join(directory, line.strip()) for line in file if line.strip())
+    return paths
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Assembles .asm units into objects and links them.')
+    arg_parser.add_argument(
+        'inputs',
+        nargs='+',
+        help='.asm or .hobj units in ROM order, or @file listing them, as VMTranslator.py --objects writes',
+    )
+    arg_parser.add_argument('-o', '--output', default='Prog.hack', help='.hack file to write')
+    arg_parser.add_argument('-c', action='store_true', help='only assemble the .asm units into .hobj files')
+    args = arg_parser.parse_args()
+    try:
+        objects = [load_object(path) for path in expand_inputs(args.inputs)]
+        if not args.c:
+            words = link(objects)
+            with open(args.output, 'w') as file:
+                file.write(''.join('{0:016b}\n'.format(word) for word in words))
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
@@ -1,6 +1,7 @@
 import sys
 import traceback
 import os
+from typing import List, Optional
 
 class Command:
     C_ARITHMETIC = "C_ARITHMETIC"
@@ -25,25 +26,80 @@ class Segment:
     POINTER = "pointer"
 
 
+class VMCommand:
+    """One VM command, classified and converted once by Parser."""
+
+    __slots__ = ("command_type", "arg_1", "arg_2")
+
+    def __init__(self, command_type: str, arg_1: Optional[str] = None, arg_2: Optional[int] = None):
+        # arg_1 is the operation itself for arithmetic commands and None for return;
+        # arg_2 is None for commands that take no second argument
+        self.command_type = command_type
+        self.arg_1 = arg_1
+        self.arg_2 = arg_2
+
+
 class Parser:
+    COMMAND_TYPE_BY_KEYWORD = {
+        "add": Command.C_ARITHMETIC,
+        "sub": Command.C_ARITHMETIC,
+        "neg": Command.C_ARITHMETIC,
+        "eq": Command.C_ARITHMETIC,
+        "gt": Command.C_ARITHMETIC,
+        "lt": Command.C_ARITHMETIC,
+        "and": Command.C_ARITHMETIC,
+        "or": Command.C_ARITHMETIC,
+        "not": Command.C_ARITHMETIC,
+        "push": Command.C_PUSH,
+        "pop": Command.C_POP,
+        "label": Command.C_LABEL,
+        "goto": Command.C_GOTO,
+        "if-goto": Command.C_IF,
+        "function": Command.C_FUNCTION,
+        "call": Command.C_CALL,
+        "return": Command.C_RETURN,
+    }
+    # number of arguments after the keyword
+    NUM_ARGS_BY_COMMAND_TYPE = {
+        Command.C_ARITHMETIC: 0,
+        Command.C_PUSH: 2,
+        Command.C_POP: 2,
+        Command.C_LABEL: 1,
+        Command.C_GOTO: 1,
+        Command.C_IF: 1,
+        Command.C_FUNCTION: 2,
+        Command.C_CALL: 2,
+        Command.C_RETURN: 0,
+    }
+
     def __init__(self, filename: str):
         super().__init__()
-        self.lines: List[List[str]] = []
+        self.commands: List[VMCommand] = []
         self.curr_line = -1
 
+        command_type_by_keyword = self.COMMAND_TYPE_BY_KEYWORD
+        num_args_by_command_type = self.NUM_ARGS_BY_COMMAND_TYPE
         with open(filename, "r") as file:
-            for line in file.readlines():
-                cleaned = line.strip()
-                if not cleaned:
+            for line_number, line in enumerate(file, 1):
+                words = line.split("//", 1)[0].split()
+                if not words:
                     continue
-                if cleaned.startswith("//"):
-                    continue
-
-                removed_comment = cleaned.split("//")[0].strip()
-                self.lines.append(removed_comment.split(" "))
+                command_type = command_type_by_keyword.get(words[0])
+                if command_type is None:
+                    raise Exception(f"{filename}:{line_number}: Unsupported command type {words[0]}")
+                num_args = num_args_by_command_type[command_type]
+                if len(words) != num_args + 1:
+                    raise Exception(f"{filename}:{line_number}: {words[0]} takes {num_args} arguments")
+                if num_args == 0:
+                    arg_1 = words[0] if command_type == Command.C_ARITHMETIC else None
+                    self.commands.append(VMCommand(command_type, arg_1))
+                elif num_args == 1:
+                    self.commands.append(VMCommand(command_type, words[1]))
+                else:
+                    self.commands.append(VMCommand(command_type, words[1], int(words[2])))
 
     def has_more_commands(self):
-        return self.curr_line < len(self.lines) - 1
+        return self.curr_line < len(self.commands) - 1
 
     def advance(self):
         if not self.has_more_commands():
@@ -51,45 +107,19 @@ class Parser:
         self.curr_line += 1
 
     def command_type(self):
-        curr = self.lines[self.curr_line]
-        command = curr[0]
-
-        if command in ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"):
-            return Command.C_ARITHMETIC
-        if command == "pop":
-            return Command.C_POP
-        if command == "push":
-            return Command.C_PUSH
-        if command == "label":
-            return Command.C_LABEL
-        if command == "goto":
-            return Command.C_GOTO
-        if command == "if-goto":
-            return Command.C_IF
-        if command == "function":
-            return Command.C_FUNCTION
-        if command == "call":
-            return Command.C_CALL
-        raise Exception(f"Unsupported command type {command}")
+        return self.commands[self.curr_line].command_type
 
     def arg_1(self):
-        if self.command_type() == Command.C_RETURN:
+        command = self.commands[self.curr_line]
+        if command.arg_1 is None:
             raise Exception("No arg1 for return command")
-        curr = self.lines[self.curr_line]
-        if self.command_type() == Command.C_ARITHMETIC:
-            return curr[0]
-        return curr[1]
+        return command.arg_1
 
     def arg_2(self):
-        if self.command_type() not in (
-            Command.C_PUSH,
-            Command.C_POP,
-            Command.C_FUNCTION,
-            Command.C_CALL,
-        ):
-            raise Exception(f"No arg2 for {self.command_type()}")
-        curr = self.lines[self.curr_line]
-        return curr[2]
+        command = self.commands[self.curr_line]
+        if command.arg_2 is None:
+            raise Exception(f"No arg2 for {command.command_type}")
+        return command.arg_2
 
 
 class CodeWriter:
@@ -197,7 +227,7 @@ class CodeWriter:
         self.file.write(f"\n")
 
 
-    def write_push_pop(self, command: str, segment: str, index: str):
+    def write_push_pop(self, command: str, segment: str, index: int):
         self.file.write(f"// {command} {segment} {index}\n")
         if command == Command.C_PUSH:
             if segment == Segment.CONSTANT:
@@ -230,7 +260,7 @@ class CodeWriter:
                 self.file.write(f"A=D+A\n")
                 self.file.write(f"D=M\n")
             elif segment == Segment.POINTER:
-                if int(index) == 0:
+                if index == 0:
                     self.file.write(f"@THIS\n")
                 else:
                     self.file.write(f"@THAT\n")
@@ -283,7 +313,7 @@ class CodeWriter:
                 self.file.write(f"M=M-1\n")
                 self.file.write(f"A=M\n")
                 self.file.write(f"D=M\n")
-                if int(index) == 0:
+                if index == 0:
                     self.file.write(f"@THIS\n")
                 else:
                     self.file.write(f"@THAT\n")
@@ -298,15 +328,12 @@ if __name__ == "__main__":
     try:
         parser = Parser(in_file)
         writer = CodeWriter(out_file)
-        while parser.has_more_commands():
-            parser.advance()
-            command_type = parser.command_type()
+        for command in parser.commands:
+            command_type = command.command_type
             if command_type == Command.C_ARITHMETIC:
-                # print(f'{command_type} {parser.arg_1()}')
-                writer.write_arithmetic(parser.arg_1())
+                writer.write_arithmetic(command.arg_1)
             elif command_type in (Command.C_PUSH, Command.C_POP):
-                # print(f'{command_type} {parser.arg_1()} {parser.arg_2()}')
-                writer.write_push_pop(command_type, parser.arg_1(), parser.arg_2())
+                writer.write_push_pop(command_type, command.arg_1, command.arg_2)
         writer.close()
     except Exception as e:
         traceback.print_exc()
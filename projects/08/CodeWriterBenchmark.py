@@ -0,0 +1,94 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+from typing import List
+
+from VMTranslator import CodeWriter, _process_vm_file, vm_files
+
+FIBONACCI_ELEMENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "FunctionCalls", "FibonacciElement")
+
+
+def write_synthetic_vm(filename: str, num_commands: int):
+    """Writes a VM file of num_commands commands with a typical Jack compiler mix."""
+    rng = random.Random(0)
+    segments = ("local", "argument", "this", "that", "static", "temp", "pointer")
+    arithmetic = ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not")
+    with open(filename, "w") as file:
+        written = 0
+        function_index = 0
+        while written < num_commands:
+            file.write(f"function Synthetic.f{function_index} 3\n")
+            for i in range(min(1000, num_commands - written - 2)):
+                kind = rng.random()
+                if kind < 0.35:
+                    file.write(f"push constant {rng.randrange(100)}\n")
+                elif kind < 0.55:
+                    segment = rng.choice(segments)
+                    file.write(f"push {segment} {rng.randrange(2 if segment == 'pointer' else 3)}\n")
+                elif kind < 0.7:
+                    segment = rng.choice(segments)
+                    file.write(f"pop {segment} {rng.randrange(2 if segment == 'pointer' else 3)}\n")
+                elif kind < 0.88:
+                    file.write(f"{rng.choice(arithmetic)}\n")
+                elif kind < 0.92:
+                    file.write(f"label L{i}\n")
+                elif kind < 0.95:
+                    file.write(f"if-goto L{i}\n")
+                else:
+                    file.write(f"call Synthetic.f{function_index} 2\n")
+            file.write("return\n")
+            written += min(1000, num_commands - written - 2) + 2
+            function_index += 1
+
+
+def translate(in_files: List[str], out_file: str):
+    writer = CodeWriter(out_file)
+    for in_file in in_files:
+        _process_vm_file(in_file=in_file, writer=writer)
+    writer.close()
+
+
+def translate_in_memory(in_files: List[str]) -> str:
+    writer = CodeWriter(in_files[0], in_memory=True)
+    for in_file in in_files:
+        _process_vm_file(in_file=in_file, writer=writer)
+    return writer.getvalue()
+
+
+def bench(name: str, in_files: List[str], num_commands: int, repeat: int, out_file: str):
+    for mode in ("file", "in-memory"):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if mode == "file":
+                translate(in_files, out_file)
+            else:
+                translate_in_memory(in_files)
+            best = min(best, time.perf_counter() - start)
+        print(
+            f"{name:<18} {mode:<9} {best * 1000:9.1f} ms  "
+            f"{num_commands / best / 1000:8.1f}k commands/s"
+        )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Times CodeWriter on real and synthetic VM code.")
+    arg_parser.add_argument("--commands", type=int, default=1_000_000, help="size of the synthetic VM file")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best is kept")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_file = os.path.join(tmp_dir, "out.asm")
+
+        in_files = vm_files(FIBONACCI_ELEMENT)
+        num_commands = sum(
+            1 for in_file in in_files for line in open(in_file) if line.split("//")[0].strip()
+        )
+        # repeat the small program so that the timings are measurable
+        bench("FibonacciElement", in_files * 200, num_commands * 200, args.repeat, out_file)
+
+        synthetic = os.path.join(tmp_dir, "Synthetic.vm")
+        write_synthetic_vm(synthetic, args.commands)
+        bench("synthetic", [synthetic], args.commands, args.repeat, out_file)
@@ -0,0 +1,81 @@
+import argparse
+from typing import Dict, List
+
+
+def read_counters(filename: str) -> Dict[int, str]:
+    """Reads the .counters sidecar written by VMTranslator.py --instrument."""
+    name_by_address: Dict[int, str] = {}
+    with open(filename, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            address, name = line.split()
+            name_by_address[int(address)] = name
+    return name_by_address
+
+
+def read_ram_dump(filename: str, addresses: List[int]) -> Dict[int, int]:
+    """Reads counter values from a RAM dump.
+
+    Three formats are understood:
+    - a CPU emulator .out file produced with the output-list from --output-list,
+      whose columns are the counters in address order
+    - lines of 'address value'
+    - one value per line, starting at RAM[0]
+    """
+    with open(filename, "r") as file:
+        lines = [line.strip() for line in file if line.strip()]
+
+    if lines and lines[0].startswith("|"):
+        # the last row holds the values, the first one the (truncated) headers
+        values = [int(value) for value in lines[-1].strip("|").split("|")]
+        return dict(zip(addresses, values))
+
+    value_by_address: Dict[int, int] = {}
+    for index, line in enumerate(lines):
+        parts = line.replace(":", " ").split()
+        if len(parts) == 1:
+            value_by_address[index] = int(parts[0])
+        else:
+            value_by_address[int(parts[0])] = int(parts[1])
+    return value_by_address
+
+
+def print_report(name_by_address: Dict[int, str], value_by_address: Dict[int, int]):
+    # counters are 16-bit words, read them back unsigned; a counter that
+    # reached 65536 has wrapped around
+    counts = [
+        (value_by_address.get(address, 0) & 0xFFFF, name)
+        for address, name in name_by_address.items()
+    ]
+    counts.sort(key=lambda count: (-count[0], count[1]))
+    total = sum(count for count, _ in counts) or 1
+    width = max((len(name) for _, name in counts), default=0)
+    for count, name in counts:
+        if not count:
+            continue
+        kind = "loop" if "$" in name else "call"
+        print(f"{name:<{width}}  {kind}  {count:>6}  {100 * count / total:5.1f}%")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Prints the hottest functions and loops of an instrumented program."
+    )
+    arg_parser.add_argument("counters", help=".counters file written next to the .asm")
+    arg_parser.add_argument("dump", nargs="?", help="RAM dump of the program after a run")
+    arg_parser.add_argument(
+        "--output-list",
+        action="store_true",
+        help="print a test script output-list line that dumps every counter",
+    )
+    args = arg_parser.parse_args()
+
+    name_by_address = read_counters(args.counters)
+    addresses = sorted(name_by_address)
+    if args.output_list:
+        print("output-list " + " ".join(f"RAM[{address}]%D1.6.1" for address in addresses) + ";")
+    elif args.dump:
+        print_report(name_by_address, read_ram_dump(args.dump, addresses))
+    else:
+        arg_parser.error("a RAM dump is required unless --output-list is given")
@@ -0,0 +1,158 @@
+import sys
+import argparse
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+ROM_SIZE = 32768
+
+# the first word of the comment VMTranslator.py starts each block with
+KIND_BY_COMMENT = {
+    "C_PUSH": "push",
+    "C_POP": "pop",
+    "add": "arithmetic",
+    "sub": "arithmetic",
+    "neg": "arithmetic",
+    "and": "arithmetic",
+    "or": "arithmetic",
+    "not": "arithmetic",
+    "eq": "comparison",
+    "gt": "comparison",
+    "lt": "comparison",
+    "label": "label",
+    "goto": "goto",
+    "if-goto": "if-goto",
+    "function": "function",
+    "call": "call",
+    "tail": "tail call",
+    "return": "return",
+    "inline": "inline",
+    "init": "bootstrap",
+    "zero": "function",
+}
+
+
+class RomBlock:
+    """A run of ROM words emitted for one VM function and command kind."""
+
+    __slots__ = ("address", "size", "function_name", "kind")
+
+    def __init__(self, address: int, function_name: str, kind: str):
+        self.address = address
+        self.size = 0
+        self.function_name = function_name
+        self.kind = kind
+
+
+def read_rom_blocks(filename: str) -> List[RomBlock]:
+    """Splits an .asm file written by VMTranslator.py into tagged blocks.
+
+    Addresses are assigned as the assembler does: every line that is not a
+    label, a comment or blank takes the next ROM word. Code outside any
+    function, i.e. the bootstrap and the shared zero-fill routine, is
+    attributed to pseudo functions in parentheses.
+    """
+    blocks: List[RomBlock] = []
+    function_name = "(start)"
+    block = RomBlock(0, function_name, "other")
+    address = 0
+    with open(filename, "r") as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("("):
+                continue
+            if line.startswith("//"):
+                words = line[2:].split()
+                if not words:
+                    continue
+                kind = KIND_BY_COMMENT.get(words[0], "other")
+                if kind == "function" and words[0] == "function":
+                    if words[1].endswith("$inline"):
+                        # the locals of an inlined body, part of the caller
+                        kind = "inline"
+                    else:
+                        function_name = words[1]
+                elif kind == "bootstrap":
+                    function_name = "(bootstrap)"
+                elif words[0] == "zero":
+                    function_name = "(zero fill)"
+                if block.size:
+                    blocks.append(block)
+                block = RomBlock(address, function_name, kind)
+                continue
+            block.size += 1
+            address += 1
+    if block.size:
+        blocks.append(block)
+    return blocks
+
+
+def size_by(blocks: List[RomBlock], key) -> List[Tuple[str, int]]:
+    """Sums block sizes by key(block), largest first."""
+    sizes: Dict[str, int] = defaultdict(int)
+    for block in blocks:
+        sizes[key(block)] += block.size
+    return sorted(sizes.items(), key=lambda size: (-size[1], size[0]))
+
+
+def print_sizes(title: str, sizes: List[Tuple[str, int]], total: int, top: Optional[int]):
+    print(f"{title}:")
+    width = max((len(name) for name, _ in sizes[:top]), default=0)
+    for name, size in sizes[:top]:
+        print(f"  {name:<{width}}  {size:>6}  {100 * size / (total or 1):5.1f}%")
+    if top is not None and len(sizes) > top:
+        rest = sum(size for _, size in sizes[top:])
+        print(f"  ... {len(sizes) - top} more, {rest} words")
+
+
+def print_map(blocks: List[RomBlock]):
+    """Prints the address range of every function, in ROM order."""
+    print("Map:")
+    start, function_name, size = 0, None, 0
+    for block in blocks + [RomBlock(-1, "", "")]:
+        if block.function_name != function_name:
+            if function_name is not None:
+                print(f"  {start:>5}-{start + size - 1:<5}  {size:>6}  {function_name}")
+            start, function_name, size = block.address, block.function_name, 0
+        size += block.size
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Shows what uses the ROM of a program translated by VMTranslator.py."
+    )
+    arg_parser.add_argument("asm", help=".asm file written by VMTranslator.py")
+    arg_parser.add_argument(
+        "--hack", help="the assembled .hack file, to check the total against the assembler's"
+    )
+    arg_parser.add_argument("--top", type=int, default=20, help="rows per table, 0 for all")
+    arg_parser.add_argument("--map", action="store_true", help="also print each function's ROM addresses")
+    arg_parser.add_argument(
+        "--warn-at",
+        type=float,
+        default=0.9,
+        help="warn once the program uses this fraction of the 32K ROM",
+    )
+    args = arg_parser.parse_args()
+
+    blocks = read_rom_blocks(args.asm)
+    total = sum(block.size for block in blocks)
+    top = args.top or None
+    print_sizes("ROM words by function", size_by(blocks, lambda block: block.function_name), total, top)
+    print_sizes(
+        "ROM words by class", size_by(blocks, lambda block: block.function_name.split(".")[0]), total, top
+    )
+    print_sizes("ROM words by VM command kind", size_by(blocks, lambda block: block.kind), total, None)
+    if args.map:
+        print_map(blocks)
+    print(f"Total: {total} of {ROM_SIZE} ROM words ({100 * total / ROM_SIZE:.1f}%)")
+
+    if args.hack:
+        with open(args.hack, "r") as file:
+            assembled = sum(1 for line in file if line.strip())
+        if assembled != total:
+            print(f"warning: {args.hack} has {assembled} words, not {total}", file=sys.stderr)
+    if total > ROM_SIZE:
+        print(f"error: the program is {total - ROM_SIZE} words over the 32K ROM", file=sys.stderr)
+        sys.exit(1)
+    if total >= args.warn_at * ROM_SIZE:
+        print(f"warning: only {ROM_SIZE - total} ROM words left", file=sys.stderr)
@@ -0,0 +1,432 @@
+import sys
+import os
+import re
+import argparse
+import traceback
+from array import array
+from typing import List, Dict, Tuple, Optional
+
+from VMTranslator import (
+    Parser,
+    Command,
+    Segment,
+    vm_files,
+    load_python_program,
+    run_python_program,
+)
+
+RAM_SIZE = 32768
+
+# opcodes, one per resolved command
+OP_ADD = 0
+OP_SUB = 1
+OP_NEG = 2
+OP_EQ = 3
+OP_GT = 4
+OP_LT = 5
+OP_AND = 6
+OP_OR = 7
+OP_NOT = 8
+OP_PUSH_CONSTANT = 9  # arg1 = value
+OP_PUSH_SEGMENT = 10  # arg1 = base pointer address (LCL..THAT), arg2 = index
+OP_PUSH_FIXED = 11  # arg1 = address, for static, temp and pointer
+OP_POP_SEGMENT = 12  # arg1 = base pointer address (LCL..THAT), arg2 = index
+OP_POP_FIXED = 13  # arg1 = address, for static, temp and pointer
+OP_GOTO = 14  # arg1 = target command index
+OP_IF = 15  # arg1 = target command index
+OP_FUNCTION = 16  # arg1 = number of locals
+OP_CALL = 17  # arg1 = target command index, arg2 = number of arguments
+OP_RETURN = 18
+
+OP_BY_ARITHMETIC = {
+    "add": OP_ADD,
+    "sub": OP_SUB,
+    "neg": OP_NEG,
+    "eq": OP_EQ,
+    "gt": OP_GT,
+    "lt": OP_LT,
+    "and": OP_AND,
+    "or": OP_OR,
+    "not": OP_NOT,
+}
+
+SP = 0
+LCL = 1
+ARG = 2
+THIS = 3
+THAT = 4
+
+BASE_BY_SEGMENT = {
+    Segment.LOCAL: LCL,
+    Segment.ARGUMENT: ARG,
+    Segment.THIS: THIS,
+    Segment.THAT: THAT,
+}
+
+
+class VMProgram:
+    """VM files resolved into parallel opcode/operand arrays.
+
+    Labels are scoped by function and, like function names, resolved to
+    command indexes at load time. Label commands themselves take no step, as
+    in the VM emulator, so they are not part of the arrays.
+    """
+
+    def __init__(self, in_files: List[str]):
+        super().__init__()
+        commands: List[Tuple[str, str, int, str, str]] = []
+        for in_file in in_files:
+            class_name = os.path.splitext(os.path.basename(in_file))[0]
+            curr_fn = ""
+            for command in Parser(in_file).commands:
+                if command.command_type == Command.C_FUNCTION:
+                    curr_fn = command.arg_1
+                commands.append(
+                    (command.command_type, command.arg_1 or "", command.arg_2 or 0, class_name, curr_fn)
+                )
+
+        # first pass: command index of every function and label
+        self.function_index: Dict[str, int] = {}
+        label_index: Dict[Tuple[str, str], int] = {}
+        index = 0
+        for command_type, arg_1, _, _, curr_fn in commands:
+            if command_type == Command.C_LABEL:
+                label_index[(curr_fn, arg_1)] = index
+                continue
+            if command_type == Command.C_FUNCTION:
+                self.function_index[arg_1] = index
+            index += 1
+        if index >= RAM_SIZE:
+            raise Exception(f"{index} commands do not fit in a 15-bit return address")
+
+        # second pass: encode
+        self.ops = array("B")
+        self.arg1 = array("i")
+        self.arg2 = array("i")
+        self.static_address: Dict[str, int] = {}
+        for command_type, arg_1, arg_2, class_name, curr_fn in commands:
+            if command_type == Command.C_LABEL:
+                continue
+            op, operand_1, operand_2 = OP_RETURN, 0, 0
+            if command_type == Command.C_ARITHMETIC:
+                op = OP_BY_ARITHMETIC[arg_1]
+            elif command_type in (Command.C_PUSH, Command.C_POP):
+                is_push = command_type == Command.C_PUSH
+                index = arg_2
+                if arg_1 == Segment.CONSTANT:
+                    if not is_push:
+                        raise Exception("Cannot pop to the constant segment")
+                    op, operand_1 = OP_PUSH_CONSTANT, index
+                elif arg_1 in BASE_BY_SEGMENT:
+                    op = OP_PUSH_SEGMENT if is_push else OP_POP_SEGMENT
+                    operand_1, operand_2 = BASE_BY_SEGMENT[arg_1], index
+                else:
+                    op = OP_PUSH_FIXED if is_push else OP_POP_FIXED
+                    operand_1 = self._fixed_address(arg_1, index, class_name)
+            elif command_type in (Command.C_GOTO, Command.C_IF):
+                if (curr_fn, arg_1) not in label_index:
+                    raise Exception(f"Unknown label {arg_1} in {curr_fn or class_name}")
+                op = OP_GOTO if command_type == Command.C_GOTO else OP_IF
+                operand_1 = label_index[(curr_fn, arg_1)]
+            elif command_type == Command.C_FUNCTION:
+                op, operand_1 = OP_FUNCTION, arg_2
+            elif command_type == Command.C_CALL:
+                if arg_1 not in self.function_index:
+                    raise Exception(f"Unknown function {arg_1}")
+                op, operand_1, operand_2 = OP_CALL, self.function_index[arg_1], arg_2
+            self.ops.append(op)
+            self.arg1.append(operand_1)
+            self.arg2.append(operand_2)
+
+    def _fixed_address(self, segment: str, index: int, class_name: str) -> int:
+        if segment == Segment.TEMP:
+            return 5 + index
+        if segment == Segment.POINTER:
+            return THIS + index
+        if segment == Segment.STATIC:
+            # allocated from RAM[16] in order of first use, as the assembler does
+            name = f"{class_name}.{index}"
+            if name not in self.static_address:
+                self.static_address[name] = 16 + len(self.static_address)
+            return self.static_address[name]
+        raise Exception(f"Unsupported segment {segment}")
+
+
+class VMInterpreter:
+    def __init__(self, program: VMProgram):
+        super().__init__()
+        self.program = program
+        self.ram = array("h", bytes(2 * RAM_SIZE))
+        self.pc = 0
+        self.steps = 0
+
+    def bootstrap(self):
+        """Sets SP to 256 and calls Sys.init, as the translator's bootstrap code does."""
+        self.ram[SP] = 256
+        self.call("Sys.init", 0)
+
+    def call(self, function_name: str, num_args: int):
+        """Calls function_name with a frame returning to the end of the program."""
+        ram = self.ram
+        sp = ram[SP]
+        ram[sp] = len(self.program.ops)
+        ram[sp + 1] = ram[LCL]
+        ram[sp + 2] = ram[ARG]
+        ram[sp + 3] = ram[THIS]
+        ram[sp + 4] = ram[THAT]
+        ram[ARG] = sp - num_args
+        ram[SP] = ram[LCL] = sp + 5
+        self.pc = self.program.function_index[function_name]
+
+    def run(self, max_steps: int) -> int:
+        """Executes up to max_steps commands and returns the number executed."""
+        ops, arg1, arg2 = self.program.ops, self.program.arg1, self.program.arg2
+        ram = self.ram
+        pc = self.pc
+        end = len(ops)
+        steps = 0
+        while steps < max_steps and pc < end:
+            steps += 1
+            op = ops[pc]
+            pc += 1
+            if op == OP_PUSH_CONSTANT:
+                sp = ram[SP]
+                ram[sp] = arg1[pc - 1]
+                ram[SP] = sp + 1
+            elif op == OP_PUSH_SEGMENT:
+                sp = ram[SP]
+                ram[sp] = ram[(ram[arg1[pc - 1]] + arg2[pc - 1]) & 0x7FFF]
+                ram[SP] = sp + 1
+            elif op == OP_PUSH_FIXED:
+                sp = ram[SP]
+                ram[sp] = ram[arg1[pc - 1]]
+                ram[SP] = sp + 1
+            elif op == OP_POP_SEGMENT:
+                sp = ram[SP] - 1
+                ram[(ram[arg1[pc - 1]] + arg2[pc - 1]) & 0x7FFF] = ram[sp]
+                ram[SP] = sp
+            elif op == OP_POP_FIXED:
+                sp = ram[SP] - 1
+                ram[arg1[pc - 1]] = ram[sp]
+                ram[SP] = sp
+            elif op <= OP_OR:
+                # binary commands, apart from neg
+                if op == OP_NEG:
+                    sp = ram[SP] - 1
+                    value = -ram[sp]
+                    ram[sp] = -32768 if value == 32768 else value
+                    continue
+                sp = ram[SP] - 1
+                x = ram[sp - 1]
+                y = ram[sp]
+                if op == OP_ADD:
+                    value = x + y
+                elif op == OP_SUB:
+                    value = x - y
+                elif op == OP_EQ:
+                    value = -1 if x == y else 0
+                elif op == OP_GT:
+                    value = -1 if x > y else 0
+                elif op == OP_LT:
+                    value = -1 if x < y else 0
+                elif op == OP_AND:
+                    value = x & y
+                else:
+                    value = x | y
+                if value > 32767:
+                    value -= 65536
+                elif value < -32768:
+                    value += 65536
+                ram[sp - 1] = value
+                ram[SP] = sp
+            elif op == OP_NOT:
+                sp = ram[SP] - 1
+                ram[sp] = ~ram[sp]
+            elif op == OP_IF:
+                sp = ram[SP] - 1
+                ram[SP] = sp
+                if ram[sp]:
+                    pc = arg1[pc - 1]
+            elif op == OP_GOTO:
+                pc = arg1[pc - 1]
+            elif op == OP_CALL:
+                sp = ram[SP]
+                ram[sp] = pc
+                ram[sp + 1] = ram[LCL]
+                ram[sp + 2] = ram[ARG]
+                ram[sp + 3] = ram[THIS]
+                ram[sp + 4] = ram[THAT]
+                ram[ARG] = sp - arg2[pc - 1]
+                ram[SP] = ram[LCL] = sp + 5
+                pc = arg1[pc - 1]
+            elif op == OP_FUNCTION:
+                sp = ram[SP]
+                num_locals = arg1[pc - 1]
+                ram[sp : sp + num_locals] = array("h", bytes(2 * num_locals))
+                ram[SP] = sp + num_locals
+            else:
+                # OP_RETURN
+                frame = ram[LCL]
+                ret_addr = ram[frame - 5]
+                arg = ram[ARG]
+                ram[arg] = ram[ram[SP] - 1]
+                ram[SP] = arg + 1
+                ram[THAT] = ram[frame - 1]
+                ram[THIS] = ram[frame - 2]
+                ram[ARG] = ram[frame - 3]
+                ram[LCL] = ram[frame - 4]
+                pc = ret_addr
+        self.pc = pc
+        self.steps += steps
+        return steps
+
+
+class TestScript:
+    """Runs the subset of VM emulator test scripts used by projects 07 and 08."""
+
+    def __init__(self, filename: str):
+        super().__init__()
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        with open(filename, "r") as file:
+            text = re.sub(r"/\*.*?\*/", "", file.read(), flags=re.S)
+        text = re.sub(r"//[^\n]*", "", text)
+        # expand 'repeat n { ... }' blocks
+        text = re.sub(r"repeat\s+(\d+)\s*\{([^}]*)\}", self._expand_repeat, text)
+        self.commands = [command.strip() for command in re.split(r"[,;]", text) if command.strip()]
+        self.interpreter: Optional[VMInterpreter] = None
+        self.output_list: List[Tuple[int, int, int, int]] = []
+        self.output_file: Optional[str] = None
+        self.compare_to: Optional[str] = None
+        self.lines: List[str] = []
+
+    @staticmethod
+    def _expand_repeat(match: re.Match) -> str:
+        count, body = int(match.group(1)), match.group(2)
+        if body.strip().rstrip(";") == "vmstep":
+            # run the whole block in one go rather than one command at a time
+            return f"vmstep {count};"
+        return body * count
+
+    def run(self) -> bool:
+        """Runs the script, writes its output file and returns whether it matches compare-to."""
+        for command in self.commands:
+            words = command.split()
+            if words[0] == "load":
+                self._load(words[1] if len(words) > 1 else None)
+            elif words[0] == "output-file":
+                self.output_file = os.path.join(self.directory, words[1])
+            elif words[0] == "compare-to":
+                self.compare_to = os.path.join(self.directory, words[1])
+            elif words[0] == "output-list":
+                self.output_list = []
+                for item in words[1:]:
+                    match = re.fullmatch(r"RAM\[(\d+)\]%D(\d+)\.(\d+)\.(\d+)", item)
+                    if not match:
+                        raise Exception(f"Unsupported output-list item {item}")
+                    self.output_list.append(tuple(int(group) for group in match.groups()))
+                self._output_header()
+            elif words[0] == "set":
+                self._set(words[1], int(words[2]))
+            elif words[0] == "vmstep":
+                self.interpreter.run(int(words[1]) if len(words) > 1 else 1)
+            elif words[0] == "output":
+                self._output_values()
+            else:
+                raise Exception(f"Unsupported test script command {command}")
+        return self._write_and_compare()
+
+    def _load(self, name: Optional[str]):
+        if name is None:
+            in_files = vm_files(self.directory)
+        else:
+            in_files = [os.path.join(self.directory, name)]
+        program = VMProgram(in_files)
+        self.interpreter = VMInterpreter(program)
+        # like the VM emulator, start at Sys.init without a calling frame
+        self.interpreter.pc = program.function_index.get("Sys.init", 0)
+
+    def _set(self, target: str, value: int):
+        ram = self.interpreter.ram
+        base_by_name = {"local": LCL, "argument": ARG, "this": THIS, "that": THAT}
+        match = re.fullmatch(r"(\w+)(?:\[(\d+)\])?", target)
+        name, index = match.group(1), match.group(2)
+        if name == "RAM":
+            ram[int(index)] = value
+        elif name == "sp" and index is None:
+            ram[SP] = value
+        elif name in base_by_name and index is None:
+            ram[base_by_name[name]] = value
+        elif name in base_by_name:
+            ram[ram[base_by_name[name]] + int(index)] = value
+        elif name == "temp":
+            ram[5 + int(index)] = value
+        else:
+            raise Exception(f"Unsupported set target {target}")
+
+    def _output_header(self):
+        line = "|"
+        for address, left, width, right in self.output_list:
+            line += f"RAM[{address}]"[: left + width + right].center(left + width + right) + "|"
+        self.lines.append(line)
+
+    def _output_values(self):
+        line = "|"
+        for address, left, width, right in self.output_list:
+            line += " " * left + f"{self.interpreter.ram[address]:>{width}}" + " " * right + "|"
+        self.lines.append(line)
+
+    def _write_and_compare(self) -> bool:
+        if self.output_file:
+            with open(self.output_file, "w") as file:
+                file.write("\n".join(self.lines) + "\n")
+        if not self.compare_to:
+            return True
+        with open(self.compare_to, "r") as file:
+            expected = [line.strip() for line in file if line.strip()]
+        return expected == self.lines
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Runs VM code directly, without translating it.")
+    arg_parser.add_argument("path", help=".vm file, directory of .vm files, or .tst test script")
+    arg_parser.add_argument(
+        "--steps", type=int, default=10_000_000, help="maximum number of VM commands to run"
+    )
+    arg_parser.add_argument(
+        "--dump", help="RAM range to print after the run, e.g. 256:270"
+    )
+    arg_parser.add_argument(
+        "--jit",
+        action="store_true",
+        help="run Sys.init compiled to Python functions instead of interpreting, until it halts",
+    )
+    arg_parser.add_argument(
+        "--jit-cache", help="directory caching the compiled program between runs"
+    )
+    args = arg_parser.parse_args()
+    try:
+        if args.path.endswith(".tst"):
+            passed = TestScript(args.path).run()
+            print("Comparison ended successfully" if passed else "Comparison failure")
+            sys.exit(0 if passed else 1)
+
+        in_files = vm_files(args.path) if os.path.isdir(args.path) else [args.path]
+        if args.jit:
+            namespace = load_python_program(in_files, args.jit_cache)
+            run_python_program(namespace)
+            ram = namespace["ram"]
+        else:
+            program = VMProgram(in_files)
+            interpreter = VMInterpreter(program)
+            if "Sys.init" in program.function_index:
+                interpreter.bootstrap()
+            steps = interpreter.run(args.steps)
+            print(f"Ran {steps} VM commands", file=sys.stderr)
+            ram = interpreter.ram
+        if args.dump:
+            start, end = (int(bound) for bound in args.dump.split(":"))
+            for address in range(start, end):
+                print(f"{address} {ram[address]}")
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit(1)
@@ -1,8 +1,14 @@
 import sys
 import traceback
 import os
-from typing import List
-from collections import defaultdict
+import argparse
+import io
+import re
+import hashlib
+import marshal
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Set, Optional, NamedTuple, Tuple, TextIO, Iterable, Iterator
+from collections import defaultdict, deque
 
 class Command:
     C_ARITHMETIC = "C_ARITHMETIC"
@@ -27,25 +33,83 @@ class Segment:
     POINTER = "pointer"
 
 
+class VMCommand:
+    """One VM command, classified and converted once by Parser."""
+
+    __slots__ = ("command_type", "arg_1", "arg_2")
+
+    def __init__(self, command_type: str, arg_1: Optional[str] = None, arg_2: Optional[int] = None):
+        # arg_1 is the operation itself for arithmetic commands and None for return;
+        # arg_2 is None for commands that take no second argument
+        self.command_type = command_type
+        self.arg_1 = arg_1
+        self.arg_2 = arg_2
+
+
 class Parser:
+    COMMAND_TYPE_BY_KEYWORD = {
+        "add": Command.C_ARITHMETIC,
+        "sub": Command.C_ARITHMETIC,
+        "neg": Command.C_ARITHMETIC,
+        "eq": Command.C_ARITHMETIC,
+        "gt": Command.C_ARITHMETIC,
+        "lt": Command.C_ARITHMETIC,
+        "and": Command.C_ARITHMETIC,
+        "or": Command.C_ARITHMETIC,
+        "not": Command.C_ARITHMETIC,
+        "push": Command.C_PUSH,
+        "pop": Command.C_POP,
+        "label": Command.C_LABEL,
+        "goto": Command.C_GOTO,
+        "if-goto": Command.C_IF,
+        "function": Command.C_FUNCTION,
+        "call": Command.C_CALL,
+        "return": Command.C_RETURN,
+    }
+    # number of arguments after the keyword
+    NUM_ARGS_BY_COMMAND_TYPE = {
+        Command.C_ARITHMETIC: 0,
+        Command.C_PUSH: 2,
+        Command.C_POP: 2,
+        Command.C_LABEL: 1,
+        Command.C_GOTO: 1,
+        Command.C_IF: 1,
+        Command.C_FUNCTION: 2,
+        Command.C_CALL: 2,
+        Command.C_RETURN: 0,
+    }
+
     def __init__(self, filename: str):
         super().__init__()
-        self.lines: List[List[str]] = []
-        self.curr_line = -1
-
         with open(filename, "r") as file:
-            for line in file.readlines():
-                cleaned = line.strip()
-                if not cleaned:
-                    continue
-                if cleaned.startswith("//"):
-                    continue
+            self.commands: List[VMCommand] = list(self.iter_commands(file, filename))
+        self.curr_line = -1
 
-                removed_comment = cleaned.split("//")[0].strip()
-                self.lines.append(removed_comment.split(" "))
+    @classmethod
+    def iter_commands(cls, lines: Iterable[str], filename: str) -> Iterator[VMCommand]:
+        """Yields the commands of lines one at a time, without holding on to any of them."""
+        command_type_by_keyword = cls.COMMAND_TYPE_BY_KEYWORD
+        num_args_by_command_type = cls.NUM_ARGS_BY_COMMAND_TYPE
+        for line_number, line in enumerate(lines, 1):
+            words = line.split("//", 1)[0].split()
+            if not words:
+                continue
+            command_type = command_type_by_keyword.get(words[0])
+            if command_type is None:
+                raise Exception(f"{filename}:{line_number}: Unsupported command type {words[0]}")
+            num_args = num_args_by_command_type[command_type]
+            if len(words) != num_args + 1:
+                raise Exception(f"{filename}:{line_number}: {words[0]} takes {num_args} arguments")
+            if num_args == 0:
+                arg_1 = words[0] if command_type == Command.C_ARITHMETIC else None
+                yield VMCommand(command_type, arg_1)
+            elif num_args == 1:
+                yield VMCommand(command_type, words[1])
+            else:
+                yield VMCommand(command_type, words[1], int(words[2]))
 
     def has_more_commands(self):
-        return self.curr_line < len(self.lines) - 1
+        return self.curr_line < len(self.commands) - 1
 
     def advance(self):
         if not self.has_more_commands():
@@ -53,495 +117,1605 @@ class Parser:
         self.curr_line += 1
 
     def command_type(self):
-        curr = self.lines[self.curr_line]
-        command = curr[0]
-
-        if command in ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"):
-            return Command.C_ARITHMETIC
-        if command == "pop":
-            return Command.C_POP
-        if command == "push":
-            return Command.C_PUSH
-        if command == "label":
-            return Command.C_LABEL
-        if command == "goto":
-            return Command.C_GOTO
-        if command == "if-goto":
-            return Command.C_IF
-        if command == "function":
-            return Command.C_FUNCTION
-        if command == "call":
-            return Command.C_CALL
-        if command == "return":
-            return Command.C_RETURN
-        raise Exception(f"Unsupported command type {command}")
+        return self.commands[self.curr_line].command_type
 
     def arg_1(self):
-        if self.command_type() == Command.C_RETURN:
+        command = self.commands[self.curr_line]
+        if command.arg_1 is None:
             raise Exception("No arg1 for return command")
-        curr = self.lines[self.curr_line]
-        if self.command_type() == Command.C_ARITHMETIC:
-            return curr[0]
-        return curr[1]
+        return command.arg_1
 
     def arg_2(self):
-        if self.command_type() not in (
-            Command.C_PUSH,
-            Command.C_POP,
-            Command.C_FUNCTION,
-            Command.C_CALL,
-        ):
-            raise Exception(f"No arg2 for {self.command_type()}")
-        curr = self.lines[self.curr_line]
-        return curr[2]
+        command = self.commands[self.curr_line]
+        if command.arg_2 is None:
+            raise Exception(f"No arg2 for {command.command_type}")
+        return command.arg_2
+
+
+def _asm(*lines: str) -> Tuple[str, int]:
+    """Renders asm lines into one block and counts the ROM words it takes.
+
+    Lines may hold str.format fields for the parts that vary per command;
+    labels and comments never take a ROM word, whatever they are filled with.
+    """
+    text = "".join(f"{line}\n" for line in lines)
+    rom_words = sum(1 for line in lines if line and not line.startswith(("//", "(")))
+    return text, rom_words
+
+
+# push D onto the stack
+_PUSH_D = ("@SP", "A=M", "M=D", "@SP", "M=M+1")
+# pop the top of the stack into D
+_POP_D = ("@SP", "M=M-1", "A=M", "D=M")
+# *(D + top of the stack) = top of the stack, popping it
+_POP_TO_ADDRESS = ("@SP", "M=M-1", "A=M", "D=D+M", "A=D-M", "M=D-A")
+
+_UNARY_ASM = {
+    "neg": _asm("// neg", "@SP", "M=M-1", "A=M", "M=-M", "@SP", "M=M+1", ""),
+    "not": _asm("// not", "@SP", "M=M-1", "A=M", "M=!M", "@SP", "M=M+1", ""),
+}
+_BINARY_ASM = {
+    command: _asm(f"// {command}", *_POP_D, "@SP", "M=M-1", "A=M", op, "@SP", "M=M+1", "")
+    for command, op in (("add", "M=D+M"), ("sub", "M=M-D"), ("and", "M=D&M"), ("or", "M=D|M"))
+}
+# jumps to the else label when the comparison is false
+_COMPARISON_ASM = {
+    command: _asm(
+        f"// {command}",
+        *_POP_D,
+        "@SP", "M=M-1", "A=M",
+        "D=M-D",
+        "@{else_label}", f"D;{jump}",
+        "@SP", "A=M", "M=-1",
+        "@{end_label}", "0;JMP",
+        "({else_label})",
+        "@SP", "A=M", "M=0",
+        "({end_label})",
+        "@SP", "M=M+1",
+        "",
+    )
+    for command, jump in (("eq", "JNE"), ("gt", "JLE"), ("lt", "JGE"))
+}
+
+# lines loading the pushed value into D
+_PUSH_LOAD = {
+    Segment.CONSTANT: ("@{address}", "D=A"),
+    Segment.STATIC: ("@{class_name}.{address}", "D=M"),
+    Segment.TEMP: ("@{address}", "D=A", "@5", "A=D+A", "D=M"),
+    Segment.POINTER: ("@{base}", "D=M"),
+}
+# lines before and after A is pointed at the popped value
+_POP_STORE = {
+    Segment.STATIC: ((), ("D=M", "@{class_name}.{address}", "M=D")),
+    Segment.TEMP: (("@5", "D=A", "@{address}", "D=D+A"), ("D=D+M", "A=D-M", "M=D-A")),
+    Segment.POINTER: ((), ("D=M", "@{base}", "M=D")),
+}
+for _segment in (Segment.LOCAL, Segment.ARGUMENT, Segment.THIS, Segment.THAT):
+    _PUSH_LOAD[_segment] = ("@{address}", "D=A", "@{base}", "A=D+M", "D=M")
+    _POP_STORE[_segment] = (("@{address}", "D=A", "@{base}", "D=D+M"), ("D=D+M", "A=D-M", "M=D-A"))
+
+_PUSH_ASM = {
+    segment: _asm("// {command} {segment} {index}", *load, *_PUSH_D, "")
+    for segment, load in _PUSH_LOAD.items()
+}
+_POP_ASM = {
+    segment: _asm("// {command} {segment} {index}", *before, "@SP", "M=M-1", "A=M", *after, "")
+    for segment, (before, after) in _POP_STORE.items()
+}
+
+# Templates for CodeWriter.batch_sp, where SP in RAM is only brought up to
+# date at the end of each basic block. The stack slot a command works on is
+# addressed relative to SP in RAM, between the two halves of each template.
+MAX_SP_OFFSET = 3
+_STACK_SLOT_ASM = {
+    slot: _asm(
+        "@SP",
+        "A=M" if slot == 0 else "A=M+1" if slot > 0 else "A=M-1",
+        *["A=A+1" if slot > 0 else "A=A-1"] * (abs(slot) - 1),
+    )
+    for slot in range(-MAX_SP_OFFSET - 2, MAX_SP_OFFSET + 2)
+}
+_PUSH_BATCHED_ASM = {
+    segment: (_asm("// {command} {segment} {index}", *load), _asm("M=D", ""))
+    for segment, load in _PUSH_LOAD.items()
+}
+_POP_BATCHED_ASM = {
+    segment: (_asm("// {command} {segment} {index}", *before), _asm(*after, ""))
+    for segment, (before, after) in _POP_STORE.items()
+}
+_UNARY_BATCHED_ASM = {
+    command: (_asm(f"// {command}"), _asm(op, ""))
+    for command, op in (("neg", "M=-M"), ("not", "M=!M"))
+}
+_BINARY_BATCHED_ASM = {
+    command: (_asm(f"// {command}"), _asm("D=M", "A=A-1", op, ""))
+    for command, op in (("add", "M=D+M"), ("sub", "M=M-D"), ("and", "M=D&M"), ("or", "M=D|M"))
+}
+# the true and false halves both address the result slot again, since the
+# jump clobbers A
+_COMPARISON_BATCHED_ASM = {
+    command: (
+        _asm(f"// {command}"),
+        _asm("D=M", "A=A-1", "D=M-D", "@{else_label}", f"D;{jump}"),
+        _asm("M=-1", "@{end_label}", "0;JMP", "({else_label})"),
+        _asm("M=0", "({end_label})", ""),
+    )
+    for command, jump in (("eq", "JNE"), ("gt", "JLE"), ("lt", "JGE"))
+}
+# SP writes each command does when not batched
+_SP_WRITES_BY_ARITHMETIC = {
+    "neg": 2, "not": 2, "add": 3, "sub": 3, "and": 3, "or": 3, "eq": 3, "gt": 3, "lt": 3,
+}
+
+# Function prologues zeroing the locals; see CodeWriter.write_prologue
+# SP++ and zero the slot below
+_ZERO_LOCAL = ("@SP", "AM=M+1", "A=A-1", "M=0")
+_ZERO_LOCAL_ASM = _asm(*_ZERO_LOCAL)
+# zero the slots from SP on, then move SP past them
+_ZERO_FIRST_ASM = _asm("@SP", "A=M", "M=0")
+_ZERO_NEXT_ASM = _asm("A=A+1", "M=0")
+_ZERO_SKIP_ASM = _asm("@{num_vars}", "D=A", "@SP", "M=D+M")
+_ZERO_LOOP_ASM = _asm("@{num_vars}", "D=A", "({label})", *_ZERO_LOCAL, "D=D-1", "@{label}", "D;JGT")
+# jump into the shared routine at the entry zeroing num_vars slots, returning through R15
+ZERO_FILL_LABEL = "VM$zero_fill"
+_ZERO_FILL_CALL_ASM = _asm(
+    "@{ret_label}", "D=A", "@R15", "M=D", f"@{ZERO_FILL_LABEL}.{{num_vars}}", "0;JMP", "({ret_label})"
+)
+_COUNTER_ASM = _asm("@{address}", "M=M+1")
+_GOTO_ASM = _asm("// goto {label}", "@{label}", "0;JMP", "")
+_IF_ASM = _asm("// if-goto {label}", *_POP_D, "@{label}", "D;JNE", "")
+
+_CALL_ASM = _asm(
+    "// call {function_name} {num_args}",
+    # push retAddrLabel
+    "@{ret_addr_label}", "D=A", *_PUSH_D,
+    # push LCL, ARG, THIS and THAT
+    "@LCL", "D=M", *_PUSH_D,
+    "@ARG", "D=M", *_PUSH_D,
+    "@THIS", "D=M", *_PUSH_D,
+    "@THAT", "D=M", *_PUSH_D,
+    # ARG = SP-5-nArgs
+    "@SP", "D=M", "@5", "D=D-A", "@{num_args}", "D=D-A", "@ARG", "M=D",
+    # LCL = SP
+    "@SP", "D=M", "@LCL", "M=D",
+    # goto functionName
+    "@{function_name}", "0;JMP",
+    "({ret_addr_label})",
+    "",
+)
+
+_RETURN_ASM = _asm(
+    "// return",
+    # endFrame (R13) = LCL
+    "@LCL", "D=M", "@R13", "M=D",
+    # retAddr (R14) = *(endFrame – 5)
+    "@R13", "D=M", "@5", "D=D-A", "A=D", "D=M", "@R14", "M=D",
+    # *ARG=pop()
+    *_POP_D, "@ARG", "A=M", "M=D",
+    # SP = ARG + 1
+    "@ARG", "D=M+1", "@SP", "M=D",
+    # THAT, THIS, ARG and LCL = *(endFrame – 1..4)
+    "@R13", "D=M", "@1", "D=D-A", "A=D", "D=M", "@THAT", "M=D",
+    "@R13", "D=M", "@2", "D=D-A", "A=D", "D=M", "@THIS", "M=D",
+    "@R13", "D=M", "@3", "D=D-A", "A=D", "D=M", "@ARG", "M=D",
+    "@R13", "D=M", "@4", "D=D-A", "A=D", "D=M", "@LCL", "M=D",
+    # goto retAddr (R14)
+    "@R14", "A=M", "0;JMP",
+    "",
+)
+
+# A tail call reuses the caller's frame: the new arguments go over the
+# caller's from ARG on, followed by the frame the caller was called with,
+# and the callee then returns straight to the caller's caller.
+# When both take as many arguments the saved frame is already in place,
+# right below LCL, and only the arguments move.
+_TAIL_CALL_ASM = _asm(
+    "// tail call {function_name} {num_args}",
+    "@LCL", "D=M", "@ARG", "D=D-M", "@{frame_end}", "D=D-A", "@{move_frame_label}", "D;JNE",
+)
+# *(ARG+i) = the i-th of the new arguments
+_TAIL_CALL_ARG_ASM = _asm("@SP", "D=M", "@{from_top}", "A=D-A", "D=M", "@ARG", "A=M")
+_TAIL_CALL_JUMP_ASM = _asm("@LCL", "D=M", "@SP", "M=D", "@{function_name}", "0;JMP")
+# Otherwise copy the saved frame above the stack, right after the new
+# arguments, and move both down to ARG together. Words are copied upwards
+# from *++R13 to *++R14, which is safe as the destination is always lower.
+_COPY_WORD = ("@R13", "AM=M+1", "D=M", "@R14", "AM=M+1", "M=D")
+_TAIL_CALL_MOVE_ASM = _asm(
+    "({move_frame_label})",
+    "@LCL", "D=M", "@6", "D=D-A", "@R13", "M=D", "@SP", "D=M-1", "@R14", "M=D",
+    *_COPY_WORD * 5,
+    "@SP", "D=M", "@{args_below}", "D=D-A", "@R13", "M=D", "@ARG", "D=M-1", "@R14", "M=D",
+)
+_COPY_WORD_ASM = _asm(*_COPY_WORD)
+_TAIL_CALL_MOVE_JUMP_ASM = _asm("@R14", "D=M+1", "@LCL", "M=D", "@SP", "M=D", "@{function_name}", "0;JMP", "")
+
+# R13 = SP-nArgs, the base of the inlined callee's frame
+_INLINE_ASM = _asm("// inline {function_name} {num_args}", "@SP", "D=M", "@{num_args}", "D=D-A", "@R13", "M=D")
+# save THIS and THAT as a real call frame would
+_INLINE_SAVE_POINTERS_ASM = _asm("@THIS", "D=M", "@R14", "M=D", "@THAT", "D=M", "@R15", "M=D")
+_INLINE_RETURN_ASM = _asm(
+    "// inline return",
+    # *R13 = pop()
+    "@SP", "AM=M-1", "D=M", "@R13", "A=M", "M=D",
+    # SP = R13 + 1
+    "@R13", "D=M+1", "@SP", "M=D",
+)
+_INLINE_RESTORE_POINTERS_ASM = _asm("@R14", "D=M", "@THIS", "M=D", "@R15", "D=M", "@THAT", "M=D")
+
+
+# words of Hack ROM, and the highest address an A-instruction can load plus one
+ROM_SIZE = 32768
+# the stack segment, the only RAM the counters of --instrument may take:
+# below it are the registers and statics, above it the heap, which the OS's
+# Memory.alloc hands out, then the screen and keyboard
+STACK_BASE = 256
+HEAP_BASE = 2048
 
 
 class CodeWriter:
-    def __init__(self, filename: str):
+    """Writes Hack assembly for VM commands.
+
+    Each block starts with a comment naming the VM command it was written
+    for, which RomReport.py uses to attribute ROM words to functions.
+    """
+
+    # blocks buffered before they are written out together
+    BUFFER_BLOCKS = 4096
+
+    def __init__(self, filename: str, in_memory: bool = False):
         super().__init__()
         self.class_name = os.path.splitext(os.path.basename(filename))[0]
-        self.file = open(filename, "w")
+        # comparison labels are namespaced by file so that files can be
+        # translated independently of each other
+        self.label_prefix = self.class_name
+        # asm blocks not yet written to file; in memory they are all kept
+        # until getvalue
+        self.blocks: List[str] = []
+        if in_memory:
+            self.file = None
+        elif filename == "-":
+            self.file = sys.stdout
+        else:
+            self.file = open(filename, "w")
         self.label_count = 0
+        # return labels are counted per calling function, see write_call
+        self.function_name = None
         self.ret_count_by_fn = defaultdict(int)
+        # number of instructions emitted, i.e. ROM words once assembled
+        self.rom_words = 0
+        # callees whose bodies are spliced into their call sites
+        self.inline_by_fn: Dict[str, InlineCallee] = {}
+        self.inline_num_args: Optional[int] = None
+        # RAM address of the counter bumped on entry to a function or loop head
+        self.counter_by_name: Dict[str, int] = {}
+        # "speed" zeroes locals with straight-line code, "size" with a loop or,
+        # for up to zero_fill_max locals, the shared routine of write_zero_fill
+        self.prologue = "speed"
+        self.zero_fill_max = 0
+        # with tail_calls, call f n directly followed by return reuses the frame
+        self.tail_calls = False
+        # with batch_sp, the real stack pointer is SP in RAM plus sp_offset
+        # until the end of the basic block, see write_sp_offset
+        self.batch_sp = False
+        self.sp_offset = 0
+        # writes to SP the unbatched code would have done, and the ones done
+        self.sp_writes = 0
+        self.sp_writes_emitted = 0
 
     def set_file_name(self, filename: str):
         self.class_name = os.path.splitext(os.path.basename(filename))[0]
+        self.label_prefix = self.class_name
+
+    def flush(self):
+        if self.file is not None:
+            self.file.write("".join(self.blocks))
+            self.blocks.clear()
 
     def close(self):
-        self.file.close()
+        if self.file is not None:
+            self.flush()
+            if self.file is sys.stdout:
+                self.file.flush()
+            else:
+                self.file.close()
+
+    def getvalue(self) -> str:
+        """Returns all asm written so far by an in-memory writer."""
+        if self.file is not None:
+            raise Exception("getvalue needs a CodeWriter created with in_memory=True")
+        asm = "".join(self.blocks)
+        self.blocks = [asm]
+        return asm
+
+    def write(self, asm: str, rom_words: int):
+        self.blocks.append(asm)
+        self.rom_words += rom_words
+        if len(self.blocks) >= self.BUFFER_BLOCKS:
+            self.flush()
+
+    def write_fragment(self, asm: str, rom_words: int):
+        """Appends asm translated by another CodeWriter."""
+        self.write(asm, rom_words)
 
     def writeline(self, command: str):
-        self.file.write(f"{command}\n")
+        self.write(f"{command}\n", 1 if command and not command.startswith(("//", "(")) else 0)
 
-    def write_arithmetic(self, command: str):
-        self.writeline(f"// {command}")
-        self.writeline(f"@SP")
-        self.writeline(f"M=M-1")
-        self.writeline(f"A=M")
-        # Unary commands
-        if command == 'neg':
-            self.writeline(f"M=-M")
-            # Increment stack pointer
-            self.writeline(f"@SP")
-            self.writeline(f"M=M+1")
-            self.writeline(f"")
-            return
-        elif command == 'not':
-            self.writeline('M=!M')
-            # Increment stack pointer
-            self.writeline(f"@SP")
-            self.writeline(f"M=M+1")
-            self.writeline(f"")
+    def write_sp_offset(self, keep_d: bool = False):
+        """Brings SP in RAM up to date with the pushes and pops batched so far."""
+        offset = self.sp_offset
+        if not offset:
             return
+        self.sp_offset = 0
+        if abs(offset) <= 2 or keep_d:
+            step = "M=M+1\n" if offset > 0 else "M=M-1\n"
+            self.write("@SP\n" + step * abs(offset), 1 + abs(offset))
+            self.sp_writes_emitted += abs(offset)
+        else:
+            update = "M=D+M" if offset > 0 else "M=M-D"
+            self.write(f"@{abs(offset)}\nD=A\n@SP\n{update}\n", 4)
+            self.sp_writes_emitted += 1
 
-        # Binary Commands
-        self.writeline(f"D=M")
-        # D contains the second arg
-        self.writeline(f"@SP")
-        self.writeline(f"M=M-1")
-        self.writeline(f"A=M")
-        if command == 'add':            
-            self.writeline(f"M=D+M")
-        elif command == 'sub':
-            self.writeline(f"M=M-D")
-        elif command == 'and':
-            self.writeline(f"M=D&M")
-        elif command == 'or':
-            self.writeline(f"M=D|M")
-        elif command == 'eq':
-            else_label = f'LABEL{self.label_count}'
-            end_label = f'LABEL{self.label_count + 1}'
-            self.label_count += 2
+    def write_stack_slot(self, slot: int):
+        """Points A at the stack slot sp_offset + slot words above SP in RAM."""
+        self.write(*_STACK_SLOT_ASM[self.sp_offset + slot])
 
-            self.writeline(f"D=M-D")
-            self.writeline(f"@{else_label}")
-            self.writeline(f"D;JNE")
-            self.writeline(f"@SP")
-            self.writeline(f"A=M")
-            self.writeline(f"M=-1")
-            self.writeline(f"@{end_label}")
-            self.writeline(f"0;JMP")
-            self.writeline(f"({else_label})")
-            self.writeline(f"@SP")
-            self.writeline(f"A=M")
-            self.writeline(f"M=0")
-            self.writeline(f"({end_label})")
-        elif command == 'gt':
-            else_label = f'LABEL{self.label_count}'
-            end_label = f'LABEL{self.label_count + 1}'
+    def _write_arithmetic_batched(self, command: str):
+        if abs(self.sp_offset) >= MAX_SP_OFFSET:
+            self.write_sp_offset()
+        self.sp_writes += _SP_WRITES_BY_ARITHMETIC[command]
+        if command in _COMPARISON_BATCHED_ASM:
+            head, compare, true_part, false_part = _COMPARISON_BATCHED_ASM[command]
+            else_label = f'{self.label_prefix}$LABEL{self.label_count}'
+            end_label = f'{self.label_prefix}$LABEL{self.label_count + 1}'
             self.label_count += 2
+            self.write(*head)
+            self.write_stack_slot(-1)
+            self.write(compare[0].format(else_label=else_label), compare[1])
+            self.write_stack_slot(-2)
+            self.write(true_part[0].format(else_label=else_label, end_label=end_label), true_part[1])
+            self.write_stack_slot(-2)
+            self.write(false_part[0].format(end_label=end_label), false_part[1])
+            self.sp_offset -= 1
+        elif command in _BINARY_BATCHED_ASM:
+            head, tail = _BINARY_BATCHED_ASM[command]
+            self.write(*head)
+            self.write_stack_slot(-1)
+            self.write(*tail)
+            self.sp_offset -= 1
+        else:
+            head, tail = _UNARY_BATCHED_ASM[command]
+            self.write(*head)
+            self.write_stack_slot(-1)
+            self.write(*tail)
 
-            self.writeline(f"D=M-D")
-            self.writeline(f"@{else_label}")
-            self.writeline(f"D;JLE")
-            self.writeline(f"@SP")
-            self.writeline(f"A=M")
-            self.writeline(f"M=-1")
-            self.writeline(f"@{end_label}")
-            self.writeline(f"0;JMP")
-            self.writeline(f"({else_label})")
-            self.writeline(f"@SP")
-            self.writeline(f"A=M")
-            self.writeline(f"M=0")
-            self.writeline(f"({end_label})")
-        elif command == 'lt':
-            else_label = f'LABEL{self.label_count}'
-            end_label = f'LABEL{self.label_count + 1}'
+    def write_arithmetic(self, command: str):
+        if self.batch_sp and command in _SP_WRITES_BY_ARITHMETIC:
+            self._write_arithmetic_batched(command)
+        elif command in _COMPARISON_ASM:
+            asm, rom_words = _COMPARISON_ASM[command]
+            else_label = f'{self.label_prefix}$LABEL{self.label_count}'
+            end_label = f'{self.label_prefix}$LABEL{self.label_count + 1}'
             self.label_count += 2
-
-            self.writeline(f"D=M-D")
-            self.writeline(f"@{else_label}")
-            self.writeline(f"D;JGE")
-            self.writeline(f"@SP")
-            self.writeline(f"A=M")
-            self.writeline(f"M=-1")
-            self.writeline(f"@{end_label}")
-            self.writeline(f"0;JMP")
-            self.writeline(f"({else_label})")
-            self.writeline(f"@SP")
-            self.writeline(f"A=M")
-            self.writeline(f"M=0")
-            self.writeline(f"({end_label})")
-        # Increment stack pointer
-        self.writeline(f"@SP")
-        self.writeline(f"M=M+1")
-        self.writeline(f"")
+            self.write(asm.format(else_label=else_label, end_label=end_label), rom_words)
+        elif command in _BINARY_ASM:
+            self.write(*_BINARY_ASM[command])
+        elif command in _UNARY_ASM:
+            self.write(*_UNARY_ASM[command])
+        else:
+            raise Exception(f'Invalid command {command} for write_arithmetic')
 
     def write_push_pop(self, command: str, segment: str, index: int):
-        self.writeline(f"// {command} {segment} {index}")
+        address_by_segment = {
+            Segment.LOCAL: "LCL",
+            Segment.ARGUMENT: "ARG",
+            Segment.THIS: "THIS",
+            Segment.THAT: "THAT",
+        }
+        address = index
+        if self.inline_num_args is not None:
+            # an inlined body addresses its arguments and locals from R13,
+            # see write_inline
+            address_by_segment[Segment.LOCAL] = "R13"
+            address_by_segment[Segment.ARGUMENT] = "R13"
+            if segment == Segment.LOCAL:
+                address += self.inline_num_args
+        if segment == Segment.POINTER:
+            base = "THIS" if index == 0 else "THAT"
+        else:
+            base = address_by_segment.get(segment)
+
         if command == Command.C_PUSH:
-            if segment == Segment.CONSTANT:
-                self.writeline(f"@{index}")
-                self.writeline(f"D=A")
-            elif segment in (
-                Segment.LOCAL,
-                Segment.ARGUMENT,
-                Segment.THIS,
-                Segment.THAT,
-            ):
-                self.writeline(f"@{index}")
-                self.writeline(f"D=A")
-                address_by_segment = {
-                    Segment.LOCAL: "LCL",
-                    Segment.ARGUMENT: "ARG",
-                    Segment.THIS: "THIS",
-                    Segment.THAT: "THAT",
-                }
-                self.writeline(f"@{address_by_segment[segment]}")
-                self.writeline(f"A=D+M")
-                self.writeline(f"D=M")
-            elif segment == Segment.STATIC:
-                self.writeline(f"@{self.class_name}.{index}")
-                self.writeline(f"D=M")
-            elif segment == Segment.TEMP:
-                self.writeline(f"@{index}")
-                self.writeline(f"D=A")
-                self.writeline(f"@5")
-                self.writeline(f"A=D+A")
-                self.writeline(f"D=M")
-            elif segment == Segment.POINTER:
-                if index == 0:
-                    self.writeline(f"@THIS")
-                else:
-                    self.writeline(f"@THAT")
-                self.writeline(f"D=M")
-            # D contains the value to be inserted into the stack
-            # Insert it into the stack and increment stack pointer
-            self.writeline(f"@SP")
-            self.writeline(f"A=M")
-            self.writeline(f"M=D")
-            self.writeline(f"@SP")
-            self.writeline(f"M=M+1")
+            template = (_PUSH_BATCHED_ASM if self.batch_sp else _PUSH_ASM).get(segment)
         elif command == Command.C_POP:
-            if segment in (Segment.LOCAL, Segment.ARGUMENT, Segment.THIS, Segment.THAT):
-                self.writeline(f"@{index}")
-                self.writeline(f"D=A")
-                address_by_segment = {
-                    Segment.LOCAL: "LCL",
-                    Segment.ARGUMENT: "ARG",
-                    Segment.THIS: "THIS",
-                    Segment.THAT: "THAT",
-                }
-                self.writeline(f"@{address_by_segment[segment]}")
-                self.writeline(f"D=D+M")
-                self.writeline(f"@SP")
-                self.writeline(f"M=M-1")
-                self.writeline(f"A=M")
-                self.writeline(f"D=D+M")
-                self.writeline(f"A=D-M")
-                self.writeline(f"M=D-A")
-            elif segment == Segment.STATIC:
-                self.writeline(f"@SP")
-                self.writeline(f"M=M-1")
-                self.writeline(f"A=M")
-                self.writeline(f"D=M")
-                self.writeline(f"@{self.class_name}.{index}")
-                self.writeline(f"M=D")
-            elif segment == Segment.TEMP:
-                self.writeline(f"@5")
-                self.writeline(f"D=A")
-                self.writeline(f"@{index}")
-                self.writeline(f"D=D+A")
-                self.writeline(f"@SP")
-                self.writeline(f"M=M-1")
-                self.writeline(f"A=M")
-                self.writeline(f"D=D+M")
-                self.writeline(f"A=D-M")
-                self.writeline(f"M=D-A")
-            elif segment == Segment.POINTER:
-                self.writeline(f"@SP")
-                self.writeline(f"M=M-1")
-                self.writeline(f"A=M")
-                self.writeline(f"D=M")
-                if index == 0:
-                    self.writeline(f"@THIS")
-                else:
-                    self.writeline(f"@THAT")
-                self.writeline(f"M=D")
+            template = (_POP_BATCHED_ASM if self.batch_sp else _POP_ASM).get(segment)
         else:
             raise Exception(f'Invalid command {command} for write_push_pop')
-        self.writeline(f"")
+        if template is None:
+            raise Exception(f'Invalid segment {segment} for {command}')
+        fields = dict(
+            command=command,
+            segment=segment,
+            index=index,
+            address=address,
+            base=base,
+            class_name=self.class_name,
+        )
+        if not self.batch_sp:
+            asm, rom_words = template
+            self.write(asm.format(**fields), rom_words)
+            return
+
+        # the value is moved through D, so the stack slot is addressed last
+        if abs(self.sp_offset) >= MAX_SP_OFFSET:
+            self.write_sp_offset()
+        self.sp_writes += 1
+        (head, head_words), (tail, tail_words) = template
+        self.write(head.format(**fields), head_words)
+        if command == Command.C_PUSH:
+            self.write_stack_slot(0)
+            self.sp_offset += 1
+        else:
+            self.write_stack_slot(-1)
+            self.sp_offset -= 1
+        self.write(tail.format(**fields), tail_words)
 
     def write_init(self):
-        self.writeline(f"// init")
-        self.writeline(f"@256")
-        self.writeline(f"D=A")
-        self.writeline(f"@SP")
-        self.writeline(f"M=D")
+        self.write(*_asm("// init", "@256", "D=A", "@SP", "M=D"))
         self.write_call('Sys.init', 0)
-        self.writeline(f"")
-    
+        self.write("\n", 0)
+
     def write_label(self, label: str):
-        self.writeline(f"// label {label}")
-        self.writeline(f"({label})")
-        self.writeline(f"")
+        self.write_sp_offset()
+        self.write(f"// label {label}\n({label})\n", 0)
+        self.write_counter(f"{self.function_name}${label}")
+        self.write("\n", 0)
+
+    def write_counter(self, name: str):
+        if name in self.counter_by_name:
+            asm, rom_words = _COUNTER_ASM
+            self.write(asm.format(address=self.counter_by_name[name]), rom_words)
 
     def write_goto(self, label: str):
-        self.writeline(f"// goto {label}")
-        self.writeline(f'@{label}')
-        self.writeline(f"0;JMP")
-        self.writeline(f"")
+        self.write_sp_offset()
+        asm, rom_words = _GOTO_ASM
+        self.write(asm.format(label=label), rom_words)
 
     def write_if(self, label: str):
-        self.writeline(f"// if-goto {label}")
-        self.writeline(f"@SP")
-        self.writeline(f"M=M-1")
-        self.writeline(f"A=M")
-        self.writeline(f"D=M")
-        self.writeline(f'@{label}')
-        self.writeline(f"D;JNE")
-        self.writeline(f"")
+        if self.batch_sp:
+            # pop the condition into D, then settle SP without touching D
+            self.sp_writes += 1
+            self.write(f"// if-goto {label}\n", 0)
+            self.write_stack_slot(-1)
+            self.write("D=M\n", 1)
+            self.sp_offset -= 1
+            self.write_sp_offset(keep_d=True)
+            self.write(f"@{label}\nD;JNE\n\n", 2)
+            return
+        asm, rom_words = _IF_ASM
+        self.write(asm.format(label=label), rom_words)
 
-    def write_function(self, function_name: str, num_vars: int):
-        self.writeline(f"// function {function_name} {num_vars}")
-        self.writeline(f"({function_name})")
-        for i in range(num_vars):
-            self.writeline(f"@0")
-            self.writeline(f"D=A")
-            self.writeline(f"@SP")
-            self.writeline(f"A=M")
-            self.writeline(f"M=D")
-            self.writeline(f"@SP")
-            self.writeline(f"M=M+1")
-        self.writeline(f"")
+    def write_function(self, function_name: str, num_vars: int, label: bool = True):
+        self.write_sp_offset()
+        self.write(f"// function {function_name} {num_vars}\n", 0)
+        if label:
+            self.function_name = function_name
+            self.write(f"({function_name})\n", 0)
+            self.write_counter(function_name)
+        # an inlined body must not jump to the shared routine, as R15 may hold
+        # the caller's THAT, see write_inline
+        self.write_prologue(num_vars, shared=label)
+        self.write("\n", 0)
+
+    def write_prologue(self, num_vars: int, shared: bool = True):
+        """Pushes num_vars zeros, in the fewest cycles or, with prologue "size", ROM words."""
+        if not num_vars:
+            return
+        unrolled_words = min(_ZERO_LOCAL_ASM[1] * num_vars, 2 * num_vars + 5)
+        if self.prologue == "size":
+            asm, rom_words = _ZERO_FILL_CALL_ASM
+            if shared and num_vars <= self.zero_fill_max and rom_words < unrolled_words:
+                ret_label = f"{self.function_name}$zero_fill"
+                self.write(asm.format(ret_label=ret_label, num_vars=num_vars), rom_words)
+                return
+            asm, rom_words = _ZERO_LOOP_ASM
+            if rom_words < unrolled_words:
+                label = f'{self.label_prefix}$LABEL{self.label_count}'
+                self.label_count += 1
+                self.write(asm.format(label=label, num_vars=num_vars), rom_words)
+                return
+        if num_vars <= 2:
+            asm, rom_words = _ZERO_LOCAL_ASM
+            self.write(asm * num_vars, rom_words * num_vars)
+            return
+        self.write(*_ZERO_FIRST_ASM)
+        asm, rom_words = _ZERO_NEXT_ASM
+        self.write(asm * (num_vars - 1), rom_words * (num_vars - 1))
+        asm, rom_words = _ZERO_SKIP_ASM
+        self.write(asm.format(num_vars=num_vars), rom_words)
+
+    def write_zero_fill(self, max_vars: int):
+        """Writes the routine that prologues of up to max_vars locals share with prologue "size".
+
+        It has an entry point for each local count, each falling through to
+        the next, and returns to the address in R15.
+        """
+        self.write("// zero fill\n", 0)
+        asm, rom_words = _ZERO_LOCAL_ASM
+        for num_vars in range(max_vars, 0, -1):
+            self.write(f"({ZERO_FILL_LABEL}.{num_vars})\n", 0)
+            self.write(asm, rom_words)
+        self.write("@R15\nA=M\n0;JMP\n\n", 3)
+        self.zero_fill_max = max_vars
 
     def write_call(self, function_name: str, num_vars: int):
-        self.writeline(f"// call {function_name} {num_vars}")
-        ret_count = self.ret_count_by_fn[function_name]
-        ret_addr_label = f'{function_name}$ret.{ret_count}'
-        self.ret_count_by_fn[function_name] += 1
-
-        # push retAddrLabel
-        self.writeline(f'@{ret_addr_label}')
-        self.writeline(f'D=A')
-        self.writeline(f"@SP")
-        self.writeline(f"A=M")
-        self.writeline(f"M=D")
-        self.writeline(f"@SP")
-        self.writeline(f"M=M+1")
-
-        # push LCL
-        self.writeline(f'@LCL')
-        self.writeline(f'D=M')
-        self.writeline(f"@SP")
-        self.writeline(f"A=M")
-        self.writeline(f"M=D")
-        self.writeline(f"@SP")
-        self.writeline(f"M=M+1")
-
-        # push ARG
-        self.writeline(f'@ARG')
-        self.writeline(f'D=M')
-        self.writeline(f"@SP")
-        self.writeline(f"A=M")
-        self.writeline(f"M=D")
-        self.writeline(f"@SP")
-        self.writeline(f"M=M+1")
-
-        # push THIS
-        self.writeline(f'@THIS')
-        self.writeline(f'D=M')
-        self.writeline(f"@SP")
-        self.writeline(f"A=M")
-        self.writeline(f"M=D")
-        self.writeline(f"@SP")
-        self.writeline(f"M=M+1")
-
-        # push THAT
-        self.writeline(f'@THAT')
-        self.writeline(f'D=M')
-        self.writeline(f"@SP")
-        self.writeline(f"A=M")
-        self.writeline(f"M=D")
-        self.writeline(f"@SP")
-        self.writeline(f"M=M+1")
-        
-        # ARG = SP-5-nArgs
-        self.writeline(f'@SP')
-        self.writeline(f'D=M')
-        self.writeline(f'@5')
-        self.writeline(f'D=D-A')
-        self.writeline(f'@{num_vars}')
-        self.writeline(f'D=D-A')
-        self.writeline(f'@ARG')
-        self.writeline(f'M=D')
-
-        # LCL = SP
-        self.writeline(f'@SP')
-        self.writeline(f'D=M')
-        self.writeline(f'@LCL')
-        self.writeline(f'M=D')
-
-        # goto functionName
-        self.writeline(f'@{function_name}')
-        self.writeline(f"0;JMP")
-
-        # (retAddrLabel)
-        self.writeline(f"({ret_addr_label})")
-        self.writeline('')
+        if function_name in self.inline_by_fn:
+            self.write_inline(self.inline_by_fn[function_name], num_vars)
+            return
+        self.write_sp_offset()
+        caller = self.function_name or self.label_prefix
+        ret_count = self.ret_count_by_fn[caller]
+        ret_addr_label = f'{caller}$ret.{ret_count}'
+        self.ret_count_by_fn[caller] += 1
+
+        asm, rom_words = _CALL_ASM
+        self.write(
+            asm.format(function_name=function_name, num_args=num_vars, ret_addr_label=ret_addr_label),
+            rom_words,
+        )
 
     def write_return(self):
-        self.writeline(f"// return")
-
-        # endFrame (R13) = LCL
-        self.writeline(f'@LCL')
-        self.writeline(f'D=M')
-        self.writeline(f'@R13')
-        self.writeline(f'M=D')
-
-        # retAddr (R14) = *(endFrame – 5)
-        self.writeline(f'@R13')
-        self.writeline(f'D=M')
-        self.writeline(f'@5')
-        self.writeline(f'D=D-A')
-        self.writeline(f'A=D')
-        self.writeline(f'D=M')
-        self.writeline(f'@R14')
-        self.writeline(f'M=D')
-
-        # *ARG=pop()
-        self.writeline(f'@SP')
-        self.writeline(f"M=M-1")
-        self.writeline(f"A=M")
-        self.writeline(f"D=M")
-        self.writeline(f'@ARG')
-        self.writeline(f"A=M")
-        self.writeline(f"M=D")
-
-        # SP = ARG + 1
-        self.writeline(f'@ARG')
-        self.writeline(f"D=M+1")
-        self.writeline(f'@SP')
-        self.writeline(f'M=D')
-
-        # THAT = *(endFrame – 1)
-        self.writeline(f'@R13')
-        self.writeline(f'D=M')
-        self.writeline(f'@1')
-        self.writeline(f'D=D-A')
-        self.writeline(f'A=D')
-        self.writeline(f'D=M')
-        self.writeline(f'@THAT')
-        self.writeline(f'M=D')
-
-        # THIS = *(endFrame – 2)
-        self.writeline(f'@R13')
-        self.writeline(f'D=M')
-        self.writeline(f'@2')
-        self.writeline(f'D=D-A')
-        self.writeline(f'A=D')
-        self.writeline(f'D=M')
-        self.writeline(f'@THIS')
-        self.writeline(f'M=D')
-
-        # ARG = *(endFrame – 3)
-        self.writeline(f'@R13')
-        self.writeline(f'D=M')
-        self.writeline(f'@3')
-        self.writeline(f'D=D-A')
-        self.writeline(f'A=D')
-        self.writeline(f'D=M')
-        self.writeline(f'@ARG')
-        self.writeline(f'M=D')
-        
-        # LCL = *(endFrame – 4)
-        self.writeline(f'@R13')
-        self.writeline(f'D=M')
-        self.writeline(f'@4')
-        self.writeline(f'D=D-A')
-        self.writeline(f'A=D')
-        self.writeline(f'D=M')
-        self.writeline(f'@LCL')
-        self.writeline(f'M=D')
-
-        # goto retAddr (R14)
-        self.writeline(f'@R14')
-        self.writeline(f'A=M')
-        self.writeline(f"0;JMP")
-        self.writeline(f"")
-
-
-def _process_vm_file(in_file: str, writer: CodeWriter):
-    parser = Parser(in_file)
-    writer.set_file_name(in_file)
-    while parser.has_more_commands():
-        parser.advance()
-        command_type = parser.command_type()
+        self.write_sp_offset()
+        self.write(*_RETURN_ASM)
+
+    def write_tail_call(self, function_name: str, num_args: int):
+        """Writes call function_name num_args followed by return, without a new frame."""
+        self.write_sp_offset()
+        move_frame_label = f'{self.label_prefix}$LABEL{self.label_count}'
+        self.label_count += 1
+        asm, rom_words = _TAIL_CALL_ASM
+        self.write(
+            asm.format(
+                function_name=function_name,
+                num_args=num_args,
+                frame_end=num_args + 5,
+                move_frame_label=move_frame_label,
+            ),
+            rom_words,
+        )
+        asm, rom_words = _TAIL_CALL_ARG_ASM
+        for i in range(num_args):
+            self.write(asm.format(from_top=num_args - i), rom_words)
+            self.write("A=A+1\n" * i + "M=D\n", i + 1)
+        asm, rom_words = _TAIL_CALL_JUMP_ASM
+        self.write(asm.format(function_name=function_name), rom_words)
+
+        asm, rom_words = _TAIL_CALL_MOVE_ASM
+        self.write(asm.format(move_frame_label=move_frame_label, args_below=num_args + 1), rom_words)
+        asm, rom_words = _COPY_WORD_ASM
+        self.write(asm * (num_args + 5), rom_words * (num_args + 5))
+        asm, rom_words = _TAIL_CALL_MOVE_JUMP_ASM
+        self.write(asm.format(function_name=function_name), rom_words)
+
+    def write_inline(self, callee: "InlineCallee", num_args: int):
+        self.write_sp_offset()
+        asm, rom_words = _INLINE_ASM
+        self.write(asm.format(function_name=callee.function_name, num_args=num_args), rom_words)
+        if callee.sets_pointer:
+            self.write(*_INLINE_SAVE_POINTERS_ASM)
+        self.write("\n", 0)
+
+        class_name = self.class_name
+        self.class_name = callee.class_name
+        self.inline_num_args = num_args
+        self.write_function(f"{callee.function_name}$inline", callee.num_vars, label=False)
+        _write_inline_body(self, callee)
+        self.inline_num_args = None
+        self.class_name = class_name
+
+        self.write_sp_offset()
+        self.write(*_INLINE_RETURN_ASM)
+        if callee.sets_pointer:
+            self.write(*_INLINE_RESTORE_POINTERS_ASM)
+        self.write("\n", 0)
+
+
+class InlineCallee(NamedTuple):
+    function_name: str
+    class_name: str
+    num_vars: int
+    # (command type, arg1, arg2) for every command between function and return
+    body: List[Tuple[str, str, int]]
+    sets_pointer: bool
+
+
+class CodegenOptions(NamedTuple):
+    inline_by_fn: Dict[str, InlineCallee]
+    counter_by_name: Dict[str, int]
+    batch_sp: bool = False
+    prologue: str = "speed"
+    zero_fill_max: int = 0
+    tail_calls: bool = False
+
+    def apply(self, writer: CodeWriter):
+        writer.inline_by_fn = self.inline_by_fn
+        writer.counter_by_name = self.counter_by_name
+        writer.batch_sp = self.batch_sp
+        writer.prologue = self.prologue
+        writer.zero_fill_max = self.zero_fill_max
+        writer.tail_calls = self.tail_calls
+
+
+def _write_inline_body(writer: CodeWriter, callee: InlineCallee):
+    for command_type, arg_1, arg_2 in callee.body:
         if command_type == Command.C_ARITHMETIC:
-            writer.write_arithmetic(parser.arg_1())
-        elif command_type in (Command.C_PUSH, Command.C_POP):
-            writer.write_push_pop(command_type, parser.arg_1(), int(parser.arg_2()))
+            writer.write_arithmetic(arg_1)
+        else:
+            writer.write_push_pop(command_type, arg_1, arg_2)
+
+
+class VMHalt(Exception):
+    """Raised by Sys.halt in programs compiled by PythonWriter."""
+
+
+class CounterRangeError(Exception):
+    """Raised when the counters of --instrument do not fit in the stack segment."""
+
+
+class PythonWriter:
+    """Translates VM code into a Python module with one Python function per VM function.
+
+    The stack of a function is simulated at compile time: stack slots,
+    locals and arguments become Python local variables, and VM calls become
+    Python calls. Labels split a function into blocks that a dispatch loop
+    jumps between. Static, temp, this and that accesses go through the
+    module's ram list, so the heap and the screen behave as on the Hack
+    platform; the stack frames themselves do not live in ram.
+    """
+
+    def __init__(self, filename: str, file: Optional[TextIO] = None):
+        super().__init__()
+        self.class_name = os.path.splitext(os.path.basename(filename))[0]
+        self.file = file
+        if file is None:
+            self.file = open(filename, "w")
+        self.static_address: Dict[str, int] = {}
+        self.py_name_by_fn: Dict[str, str] = {}
+        self.defined: Set[str] = set()
+        # commands of the function being translated, written out on the next function
+        self.function_name = None
+        self.num_vars = 0
+        self.commands: List[Tuple[str, str, int]] = []
+        self.lines = [
+            "# generated by VMTranslator.py --python",
+            "ram = [0] * 32768",
+            "",
+        ]
+
+    def set_file_name(self, filename: str):
+        self.class_name = os.path.splitext(os.path.basename(filename))[0]
+
+    def close(self):
+        self.file.write(self.source())
+        self.file.close()
+
+    def source(self) -> str:
+        """Finishes the module and returns its source."""
+        self._flush_function()
+        self.function_name = None
+        undefined = set(self.py_name_by_fn) - self.defined
+        if undefined:
+            raise Exception(f"Unknown functions {', '.join(sorted(undefined))}")
+        lines = self.lines + ["", "PY_NAME_BY_FUNCTION = {"]
+        for function_name, py_name in self.py_name_by_fn.items():
+            lines.append(f"    {function_name!r}: {py_name},")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def _py_name(self, function_name: str) -> str:
+        if function_name not in self.py_name_by_fn:
+            py_name = re.sub(r"\W", "_", function_name)
+            self.py_name_by_fn[function_name] = f"vm_{py_name}_{len(self.py_name_by_fn)}"
+        return self.py_name_by_fn[function_name]
+
+    def _fixed_address(self, segment: str, index: int) -> int:
+        if segment == Segment.TEMP:
+            return 5 + index
+        # allocated from RAM[16] in order of first use, as the assembler does
+        name = f"{self.class_name}.{index}"
+        if name not in self.static_address:
+            self.static_address[name] = 16 + len(self.static_address)
+        return self.static_address[name]
+
+    def write_arithmetic(self, command: str):
+        self.commands.append((Command.C_ARITHMETIC, command, 0))
+
+    def write_push_pop(self, command: str, segment: str, index: int):
+        if segment in (Segment.STATIC, Segment.TEMP):
+            # resolved now, while class_name is that of the file being read
+            index = self._fixed_address(segment, index)
+        self.commands.append((command, segment, index))
+
+    def write_label(self, label: str):
+        self.commands.append((Command.C_LABEL, label, 0))
+
+    def write_goto(self, label: str):
+        self.commands.append((Command.C_GOTO, label, 0))
+
+    def write_if(self, label: str):
+        self.commands.append((Command.C_IF, label, 0))
+
+    def write_call(self, function_name: str, num_vars: int):
+        self.commands.append((Command.C_CALL, self._py_name(function_name), num_vars))
+
+    def write_return(self):
+        self.commands.append((Command.C_RETURN, "", 0))
+
+    def write_sp_offset(self):
+        # the Python stack is simulated at compile time, there is no SP to settle
+        pass
+
+    # Python calls always get a frame of their own
+    tail_calls = False
+
+    def write_function(self, function_name: str, num_vars: int):
+        self._flush_function()
+        self.function_name = function_name
+        self.defined.add(function_name)
+        self.num_vars = num_vars
+        self.commands = []
+
+    def _operand(self, segment: str, index: int) -> str:
+        """Python expression for a segment slot, usable on either side of '='."""
+        if segment == Segment.LOCAL:
+            return f"l{index}"
+        if segment == Segment.ARGUMENT:
+            return f"a{index}"
+        if segment == Segment.THIS:
+            return f"ram[this + {index}]"
+        if segment == Segment.THAT:
+            return f"ram[that + {index}]"
+        if segment == Segment.POINTER:
+            return "this" if index == 0 else "that"
+        # static and temp, already resolved to an address
+        return f"ram[{index}]"
+
+    def _flush_function(self):
+        if self.function_name is None:
+            if self.commands:
+                raise Exception("PythonWriter only translates code inside functions")
+            return
+
+        labels = [arg_1 for command_type, arg_1, _ in self.commands if command_type == Command.C_LABEL]
+        block_by_label = {label: block for block, label in enumerate(labels, start=1)}
+        num_args = 1 + max(
+            (index for command_type, segment, index in self.commands
+             if command_type in (Command.C_PUSH, Command.C_POP) and segment == Segment.ARGUMENT),
+            default=-1,
+        )
+        params = ", ".join([f"a{i}=0" for i in range(num_args)] + ["*_"])
+        out = [f"def {self._py_name(self.function_name)}({params}):"]
+        out.append(f"    # function {self.function_name} {self.num_vars}")
+        for i in range(self.num_vars):
+            out.append(f"    l{i} = 0")
+        out.append("    this = that = 0")
+        indent = "    "
+        if labels:
+            out.append("    block = 0")
+            out.append("    while True:")
+            out.append("        if block <= 0:")
+            indent = "            "
+
+        # stack depth at each label, known from the first jump to or fall into it
+        depth_by_label: Dict[str, int] = {}
+        depth: Optional[int] = 0
+        for command_type, arg_1, arg_2 in self.commands:
+            if command_type == Command.C_LABEL:
+                if depth is not None and depth_by_label.setdefault(arg_1, depth) != depth:
+                    raise Exception(f"Inconsistent stack depth at {self.function_name} {arg_1}")
+                depth = depth_by_label.get(arg_1, 0)
+                if out[-1].endswith(":"):
+                    out.append(f"{indent}pass")
+                out.append(f"        if block <= {block_by_label[arg_1]}:")
+                continue
+            if depth is None:
+                # unreachable until the next label
+                continue
+            top = f"s{depth - 1}"
+            if command_type == Command.C_PUSH:
+                if arg_1 == Segment.CONSTANT:
+                    out.append(f"{indent}s{depth} = {arg_2}")
+                else:
+                    out.append(f"{indent}s{depth} = {self._operand(arg_1, arg_2)}")
+                depth += 1
+            elif command_type == Command.C_POP:
+                out.append(f"{indent}{self._operand(arg_1, arg_2)} = {top}")
+                depth -= 1
+            elif command_type == Command.C_ARITHMETIC:
+                if arg_1 == "neg":
+                    out.append(f"{indent}{top} = ((32768 - {top}) & 65535) - 32768")
+                elif arg_1 == "not":
+                    out.append(f"{indent}{top} = ~{top}")
+                else:
+                    x, y = f"s{depth - 2}", top
+                    expression = {
+                        "add": f"(({x} + {y} + 32768) & 65535) - 32768",
+                        "sub": f"(({x} - {y} + 32768) & 65535) - 32768",
+                        "and": f"{x} & {y}",
+                        "or": f"{x} | {y}",
+                        "eq": f"-1 if {x} == {y} else 0",
+                        "gt": f"-1 if {x} > {y} else 0",
+                        "lt": f"-1 if {x} < {y} else 0",
+                    }[arg_1]
+                    out.append(f"{indent}{x} = {expression}")
+                    depth -= 1
+            elif command_type in (Command.C_GOTO, Command.C_IF):
+                if arg_1 not in block_by_label:
+                    raise Exception(f"Unknown label {arg_1} in {self.function_name}")
+                jump = f"block = {block_by_label[arg_1]}; continue"
+                if command_type == Command.C_IF:
+                    depth -= 1
+                    out.append(f"{indent}if s{depth}: {jump}")
+                else:
+                    out.append(f"{indent}{jump}")
+                if depth_by_label.setdefault(arg_1, depth) != depth:
+                    raise Exception(f"Inconsistent stack depth at {self.function_name} {arg_1}")
+                if command_type == Command.C_GOTO:
+                    depth = None
+            elif command_type == Command.C_CALL:
+                depth -= arg_2
+                args = ", ".join(f"s{depth + i}" for i in range(arg_2))
+                out.append(f"{indent}s{depth} = {arg_1}({args})")
+                depth += 1
+            elif command_type == Command.C_RETURN:
+                out.append(f"{indent}return {top}")
+                depth = None
+        if labels:
+            if out[-1].endswith(":"):
+                out.append(f"{indent}pass")
+            out.append(f"        return 0")
+        out.append("")
+        self.lines.extend(out)
+
+
+def load_python_program(in_files: List[str], cache_dir: Optional[str] = None) -> Dict:
+    """Translates in_files with PythonWriter and returns the executed module namespace.
+
+    The compiled code is cached in cache_dir by a hash of the VM sources and
+    of this translator, so later runs skip both translation and compilation.
+    """
+    digest = hashlib.sha256()
+    with open(__file__, "rb") as file:
+        digest.update(file.read())
+    digest.update(sys.version.encode())
+    for in_file in in_files:
+        digest.update(os.path.basename(in_file).encode())
+        with open(in_file, "rb") as file:
+            digest.update(file.read())
+    cache_path = None
+    code = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, f"{digest.hexdigest()}.marshal")
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as file:
+                code = marshal.load(file)
+    if code is None:
+        writer = PythonWriter("vm_program.py", file=io.StringIO())
+        for in_file in in_files:
+            _process_vm_file(in_file=in_file, writer=writer)
+        code = compile(writer.source(), "vm_program.py", "exec")
+        if cache_path is not None:
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                marshal.dump(code, file)
+            os.replace(tmp_path, cache_path)
+
+    namespace: Dict = {}
+    exec(code, namespace)
+    return namespace
+
+
+def run_python_program(namespace: Dict, function_name: str = "Sys.init"):
+    """Calls function_name of a program loaded by load_python_program until it returns or halts."""
+    py_name_by_fn = namespace["PY_NAME_BY_FUNCTION"]
+    if "Sys.halt" in py_name_by_fn:
+        def halt(*_):
+            raise VMHalt()
+
+        # calls are resolved through the module globals, so this replaces
+        # Sys.halt's busy loop everywhere
+        namespace[py_name_by_fn["Sys.halt"].__name__] = halt
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 20000))
+    try:
+        py_name_by_fn[function_name]()
+    except VMHalt:
+        pass
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+
+
+def vm_files(directory: str) -> List[str]:
+    """Lists the .vm files of directory, sorted so that output does not depend on directory order."""
+    with os.scandir(directory) as it:
+        return sorted(
+            entry.path for entry in it if entry.name.endswith(".vm") and entry.is_file()
+        )
+
+
+def read_vm_commands(in_file: str) -> Iterator[VMCommand]:
+    """Yields the commands of in_file as it is read."""
+    with open(in_file, "r") as file:
+        yield from Parser.iter_commands(file, in_file)
+
+
+def _process_vm_file(in_file: str, writer: CodeWriter, functions: Optional[Set[str]] = None):
+    """Translates in_file. If functions is given, only those functions are emitted."""
+    writer.set_file_name(in_file)
+    _process_commands(read_vm_commands(in_file), writer, functions)
+
+
+def _process_commands(
+    commands: Iterable[VMCommand],
+    writer: CodeWriter,
+    functions: Optional[Set[str]] = None,
+    class_per_function: bool = False,
+):
+    """Translates commands as they come.
+
+    With class_per_function, the static segment of each function belongs to
+    the class its name starts with, as for a whole program concatenated from
+    the Jack compiler's per-class files.
+    """
+    emitting = True
+    # with tail_calls, a call waits to see whether a return follows it
+    pending_call: Optional[VMCommand] = None
+    for command in commands:
+        command_type = command.command_type
+        if pending_call is not None and emitting:
+            if command_type == Command.C_RETURN:
+                writer.write_tail_call(pending_call.arg_1, pending_call.arg_2)
+                pending_call = None
+                continue
+            writer.write_call(pending_call.arg_1, pending_call.arg_2)
+        pending_call = None
+        if command_type == Command.C_FUNCTION:
+            if functions is not None:
+                emitting = command.arg_1 in functions
+            if class_per_function:
+                writer.class_name = command.arg_1.split(".")[0]
+        if not emitting:
+            continue
+        if command_type == Command.C_PUSH or command_type == Command.C_POP:
+            writer.write_push_pop(command_type, command.arg_1, command.arg_2)
+        elif command_type == Command.C_ARITHMETIC:
+            writer.write_arithmetic(command.arg_1)
         elif command_type == Command.C_LABEL:
-            writer.write_label(parser.arg_1())
+            writer.write_label(command.arg_1)
         elif command_type == Command.C_GOTO:
-            writer.write_goto(parser.arg_1())
+            writer.write_goto(command.arg_1)
         elif command_type == Command.C_IF:
-            writer.write_if(parser.arg_1())
+            writer.write_if(command.arg_1)
         elif command_type == Command.C_FUNCTION:
-            writer.write_function(parser.arg_1(), int(parser.arg_2()))
+            writer.write_function(command.arg_1, command.arg_2)
         elif command_type == Command.C_CALL:
-            writer.write_call(parser.arg_1(), int(parser.arg_2()))
+            if writer.tail_calls and command.arg_1 not in writer.inline_by_fn:
+                pending_call = command
+            else:
+                writer.write_call(command.arg_1, command.arg_2)
         elif command_type == Command.C_RETURN:
             writer.write_return()
+    if pending_call is not None and emitting:
+        writer.write_call(pending_call.arg_1, pending_call.arg_2)
+    # the input may end in the middle of a basic block
+    writer.write_sp_offset()
+
+
+class FragmentCache:
+    """On-disk cache of per-file asm fragments.
+
+    Entries are keyed by a hash of everything a fragment depends on: this
+    translator's source, the file name and contents, and the code generation
+    options that affect the file. The least recently used entries are evicted
+    once the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        with open(__file__, "rb") as file:
+            self.translator_digest = hashlib.sha256(file.read()).hexdigest()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(
+        self,
+        in_file: str,
+        source: bytes,
+        functions: Optional[Set[str]],
+        options: CodegenOptions,
+    ) -> str:
+        digest = hashlib.sha256()
+        digest.update(self.translator_digest.encode())
+        digest.update(os.path.basename(in_file).encode())
+        digest.update(source)
+        # only the options that can change this file's output are part of the key,
+        # so that e.g. the OS files stay cached when the program using them changes
+        defined = {fn.decode() for fn in re.findall(rb"^\s*function\s+(\S+)", source, re.M)}
+        called = {fn.decode() for fn in re.findall(rb"^\s*call\s+(\S+)", source, re.M)}
+        if functions is not None:
+            digest.update(repr(sorted(defined & functions)).encode())
+        else:
+            digest.update(b"*")
+        inline_by_fn = options.inline_by_fn
+        digest.update(repr(sorted((fn, inline_by_fn[fn]) for fn in called & set(inline_by_fn))).encode())
+        counters = [
+            (name, address)
+            for name, address in options.counter_by_name.items()
+            if name.split("$")[0] in defined
+        ]
+        digest.update(repr(sorted(counters)).encode())
+        digest.update(
+            repr((options.batch_sp, options.prologue, options.zero_fill_max, options.tail_calls)).encode()
+        )
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, int]]:
+        path = os.path.join(self.cache_dir, f"{key}.asm")
+        try:
+            with open(path, "r", newline="") as file:
+                rom_words = int(file.readline())
+                asm = file.read()
+        except (OSError, ValueError):
+            return None
+        # mark as recently used for eviction
+        os.utime(path)
+        return asm, rom_words
+
+    def put(self, key: str, asm: str, rom_words: int):
+        path = os.path.join(self.cache_dir, f"{key}.asm")
+        # write then rename, so that concurrent workers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", newline="") as file:
+            file.write(f"{rom_words}\n")
+            file.write(asm)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".asm") and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+def _translate_vm_file(
+    in_file: str,
+    functions: Optional[Set[str]],
+    options: CodegenOptions,
+    cache: Optional[FragmentCache] = None,
+) -> Tuple[str, int]:
+    """Translates in_file on its own and returns its asm and ROM word count."""
+    if cache is not None:
+        with open(in_file, "rb") as file:
+            key = cache.key(in_file, file.read(), functions, options)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    writer = CodeWriter(in_file, in_memory=True)
+    options.apply(writer)
+    _process_vm_file(in_file=in_file, writer=writer, functions=functions)
+    asm, rom_words = writer.getvalue(), writer.rom_words
+    if cache is not None:
+        cache.put(key, asm, rom_words)
+    return asm, rom_words
+
+
+def _translate_vm_files(
+    in_files: List[str],
+    functions: Optional[Set[str]],
+    options: CodegenOptions,
+    jobs: int,
+    cache: Optional[FragmentCache] = None,
+) -> Iterator[Tuple[str, int]]:
+    """Translates every file, in parallel if jobs > 1, yielding fragments in the order of in_files.
+
+    Each fragment is yielded as soon as it and all before it are done, so
+    they can be written out without holding the whole program.
+    """
+    if jobs <= 1 or len(in_files) <= 1:
+        for in_file in in_files:
+            yield _translate_vm_file(in_file, functions, options, cache)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(
+            _translate_vm_file,
+            in_files,
+            [functions] * len(in_files),
+            [options] * len(in_files),
+            [cache] * len(in_files),
+        )
+
+
+def _reachable_functions(
+    in_files: List[str], root: str = "Sys.init", inlined: Set[str] = frozenset()
+) -> Optional[Set[str]]:
+    """Walks the call graph from root and returns every function it can reach.
+
+    Calls to inlined functions are not edges, since no code jumps to them.
+    Returns None if root is not defined in any of the files, in which case
+    nothing can be safely eliminated.
+    """
+    calls_by_fn: Dict[str, Set[str]] = {}
+    for in_file in in_files:
+        curr_fn = None
+        for command in read_vm_commands(in_file):
+            if command.command_type == Command.C_FUNCTION:
+                curr_fn = command.arg_1
+                calls_by_fn[curr_fn] = set()
+            elif command.command_type == Command.C_CALL and curr_fn is not None:
+                if command.arg_1 not in inlined:
+                    calls_by_fn[curr_fn].add(command.arg_1)
+
+    if root not in calls_by_fn:
+        return None
+
+    reachable = {root}
+    queue = deque([root])
+    while queue:
+        fn = queue.popleft()
+        for callee in calls_by_fn.get(fn, ()):
+            if callee not in reachable:
+                reachable.add(callee)
+                queue.append(callee)
+    return reachable
+
+
+def _unreachable_rom_words(in_files: List[str], reachable: Set[str]) -> Dict[str, int]:
+    """Returns the ROM words each eliminated function would have taken."""
+    words_by_fn: Dict[str, int] = {}
+    for in_file in in_files:
+        dropped = {
+            command.arg_1
+            for command in read_vm_commands(in_file)
+            if command.command_type == Command.C_FUNCTION and command.arg_1 not in reachable
+        }
+        for fn in dropped:
+            writer = CodeWriter(in_file, in_memory=True)
+            _process_vm_file(in_file=in_file, writer=writer, functions={fn})
+            words_by_fn[fn] = writer.rom_words
+    return words_by_fn
+
+
+def _max_num_vars(in_files: List[str], functions: Optional[Set[str]]) -> int:
+    """Returns the most locals any of functions, or any function if None, has."""
+    return max(
+        (
+            command.arg_2
+            for in_file in in_files
+            for command in read_vm_commands(in_file)
+            if command.command_type == Command.C_FUNCTION
+            and (functions is None or command.arg_1 in functions)
+        ),
+        default=0,
+    )
+
+
+def _batched_sp_writes(
+    in_files: List[str], functions: Optional[Set[str]], options: CodegenOptions
+) -> Dict[str, Tuple[int, int]]:
+    """Returns (SP writes without batching, SP writes emitted) for each file."""
+    writes_by_file: Dict[str, Tuple[int, int]] = {}
+    for in_file in in_files:
+        writer = CodeWriter(in_file, in_memory=True)
+        options.apply(writer)
+        _process_vm_file(in_file=in_file, writer=writer, functions=functions)
+        writes_by_file[os.path.basename(in_file)] = (writer.sp_writes, writer.sp_writes_emitted)
+    return writes_by_file
+
+
+def _print_sp_report(writes_by_file: Dict[str, Tuple[int, int]]):
+    for name, (unbatched, emitted) in writes_by_file.items():
+        print(
+            f"Batched SP updates in {name}: {unbatched - emitted} of {unbatched} removed",
+            file=sys.stderr,
+        )
+
+
+def _inline_candidates(in_files: List[str], max_commands: int) -> Dict[str, InlineCallee]:
+    """Finds leaf functions of at most max_commands commands ending in their only return."""
+    candidates: Dict[str, InlineCallee] = {}
+    for in_file in in_files:
+        class_name = os.path.splitext(os.path.basename(in_file))[0]
+        curr_fn = None
+        for command in read_vm_commands(in_file):
+            command_type = command.command_type
+            if command_type == Command.C_FUNCTION:
+                curr_fn = InlineCallee(
+                    function_name=command.arg_1,
+                    class_name=class_name,
+                    num_vars=command.arg_2,
+                    body=[],
+                    sets_pointer=False,
+                )
+            elif curr_fn is None:
+                continue
+            elif command_type == Command.C_RETURN:
+                if len(curr_fn.body) <= max_commands:
+                    candidates[curr_fn.function_name] = curr_fn
+                # skip the code after the first return: nothing jumps to it,
+                # since any goto before the return disqualifies the function
+                curr_fn = None
+            elif command_type == Command.C_ARITHMETIC:
+                curr_fn.body.append((command_type, command.arg_1, 0))
+            elif command_type in (Command.C_PUSH, Command.C_POP):
+                segment = command.arg_1
+                curr_fn.body.append((command_type, segment, command.arg_2))
+                if command_type == Command.C_POP and segment == Segment.POINTER:
+                    curr_fn = curr_fn._replace(sets_pointer=True)
+            else:
+                # labels, jumps and calls are control flow we do not inline
+                curr_fn = None
+    return candidates
+
+
+def _inline_cost(callee: InlineCallee) -> Tuple[int, int]:
+    """Returns (cycles saved per call, ROM words added per call site) for inlining callee."""
+    def count_words(write) -> int:
+        writer = CodeWriter(callee.class_name, in_memory=True)
+        write(writer)
+        return writer.rom_words
+
+    # the body is straight-line code, so every instruction costs one cycle
+    call_words = count_words(lambda writer: writer.write_call(callee.function_name, 1))
+    return_words = count_words(lambda writer: writer.write_return())
+    inline_words = count_words(lambda writer: writer.write_inline(callee, 1))
+    def write_body(writer: CodeWriter):
+        writer.write_function(callee.function_name, callee.num_vars, label=False)
+        _write_inline_body(writer, callee)
+
+    body_words = count_words(write_body)
+    return call_words + body_words + return_words - inline_words, inline_words - call_words
+
+
+def _choose_inline_callees(
+    in_files: List[str], max_commands: int, budget: int
+) -> Dict[str, InlineCallee]:
+    """Picks the candidates to inline at every call site without growing ROM by more than budget."""
+    sites_by_fn: Dict[str, int] = defaultdict(int)
+    for in_file in in_files:
+        for command in read_vm_commands(in_file):
+            if command.command_type == Command.C_CALL:
+                sites_by_fn[command.arg_1] += 1
+
+    chosen: Dict[str, InlineCallee] = {}
+    candidates = _inline_candidates(in_files, max_commands)
+    costs = {fn: _inline_cost(callee) for fn, callee in candidates.items()}
+    # cheapest callees first, so the budget covers as many call sites as possible
+    for fn in sorted(candidates, key=lambda fn: costs[fn][1] * sites_by_fn[fn]):
+        if not sites_by_fn[fn]:
+            continue
+        saved, growth = costs[fn]
+        if growth * sites_by_fn[fn] > budget:
+            continue
+        budget -= growth * sites_by_fn[fn]
+        chosen[fn] = candidates[fn]
+        print(
+            f"Inlined {fn} at {sites_by_fn[fn]} call sites: "
+            f"{saved} cycles saved per call, {growth:+} ROM words per site",
+            file=sys.stderr,
+        )
+    return chosen
+
+
+def _counter_slots(
+    in_files: List[str], functions: Optional[Set[str]], loop_heads: bool, end: int
+) -> Dict[str, int]:
+    """Reserves a RAM counter, just below end, for each function and optionally each loop head.
+
+    A loop head is a label some later goto or if-goto of the same function
+    jumps back to. It is named Function$label. Nothing keeps the program
+    off the counters, so they must lie in the stack segment, above
+    anything its stack reaches.
+    """
+    names = []
+    for in_file in in_files:
+        curr_fn = None
+        seen_labels: List[str] = []
+        for command in read_vm_commands(in_file):
+            command_type = command.command_type
+            if command_type == Command.C_FUNCTION:
+                curr_fn = command.arg_1
+                seen_labels = []
+                if functions is None or curr_fn in functions:
+                    names.append(curr_fn)
+            elif curr_fn is None or (functions is not None and curr_fn not in functions):
+                continue
+            elif command_type == Command.C_LABEL:
+                seen_labels.append(command.arg_1)
+            elif loop_heads and command_type in (Command.C_GOTO, Command.C_IF):
+                name = f"{curr_fn}${command.arg_1}"
+                if command.arg_1 in seen_labels and name not in names:
+                    names.append(name)
+    base = end - len(names)
+    if base < STACK_BASE or end > HEAP_BASE:
+        raise CounterRangeError(
+            f"{len(names)} counters at RAM {base}-{end - 1} do not fit in the stack segment, "
+            f"RAM {STACK_BASE}-{HEAP_BASE - 1}; pick an --instrument-end from {STACK_BASE + len(names)} to {HEAP_BASE}"
+        )
+    return {name: base + i for i, name in enumerate(names)}
+
+
+def _write_unit(path: str, asm: str):
+    """Writes the asm of one unit, leaving the file alone if it has not changed.
+
+    Keeping the modification time of unchanged units lets the linker reuse
+    their objects.
+    """
+    try:
+        with open(path, "r") as file:
+            if file.read() == asm:
+                return
+    except OSError:
+        pass
+    with open(path, "w") as file:
+        file.write(asm)
+
+
+def _write_counters_file(out_file: str, counter_by_name: Dict[str, int]):
+    """Writes the sidecar mapping each counter's RAM address to what it counts."""
+    with open(os.path.splitext(out_file)[0] + ".counters", "w") as file:
+        for name, address in counter_by_name.items():
+            file.write(f"{address} {name}\n")
+
 
 if __name__ == "__main__":
-    filename = sys.argv[1]
+    arg_parser = argparse.ArgumentParser(description="Translates VM code into Hack assembly.")
+    arg_parser.add_argument("path", help=".vm file or directory of .vm files, or - to read stdin")
+    arg_parser.add_argument(
+        "-o",
+        "--output",
+        help="asm file to write, - for stdout; defaults to stdout for stdin and to a .asm next to path otherwise",
+    )
+    arg_parser.add_argument(
+        "--init",
+        action="store_true",
+        help="for a single file or stdin, start with the bootstrap code calling Sys.init, as directory mode does",
+    )
+    arg_parser.add_argument(
+        "--keep-unreachable",
+        action="store_true",
+        help="in directory mode, emit functions that Sys.init can never reach",
+    )
+    arg_parser.add_argument(
+        "--inline",
+        action="store_true",
+        help="splice small leaf functions into their call sites",
+    )
+    arg_parser.add_argument(
+        "--inline-max-commands",
+        type=int,
+        default=8,
+        help="largest function body, in VM commands, considered for inlining",
+    )
+    arg_parser.add_argument(
+        "--inline-budget",
+        type=int,
+        default=2048,
+        help="maximum ROM words inlining may add across all call sites",
+    )
+    arg_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of processes translating files in directory mode",
+    )
+    arg_parser.add_argument(
+        "--cache-dir",
+        help="directory caching the translation of each .vm file, e.g. the OS",
+    )
+    arg_parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="bytes the cache may use before old entries are evicted",
+    )
+    arg_parser.add_argument(
+        "--instrument",
+        action="store_true",
+        help="count calls of every function in reserved RAM, see ProfileReport.py",
+    )
+    arg_parser.add_argument(
+        "--instrument-loops",
+        action="store_true",
+        help="with --instrument, also count iterations of every loop head",
+    )
+    arg_parser.add_argument(
+        "--instrument-end",
+        type=int,
+        help=f"with --instrument, required: counters take the RAM just below this address, which must lie in "
+        f"the stack segment, e.g. {HEAP_BASE} for its top if the program's stack stays below them",
+    )
+    arg_parser.add_argument(
+        "--batch-sp",
+        action="store_true",
+        help="update SP once per basic block instead of on every push and pop",
+    )
+    arg_parser.add_argument(
+        "--prologue",
+        choices=("speed", "size"),
+        default="speed",
+        help="zero function locals with straight-line code, or with a loop and, in directory mode, a shared routine",
+    )
+    arg_parser.add_argument(
+        "--tail-calls",
+        action="store_true",
+        help="reuse the caller's frame for a call directly followed by return",
+    )
+    arg_parser.add_argument(
+        "--objects",
+        action="store_true",
+        help="in directory mode, write one .asm unit per .vm file plus Dir.boot.asm into Dir/obj, and a "
+        "Dir.units list, to be linked with ../06/linker.py @Dir/Dir.units",
+    )
+    arg_parser.add_argument(
+        "--python",
+        action="store_true",
+        help="write a Python module with one function per VM function instead of assembly",
+    )
+    args = arg_parser.parse_args()
+    filename = args.path
+    if filename == "-" and (args.python or args.inline or args.instrument):
+        arg_parser.error("--python, --inline and --instrument read their input more than once, so they need a file")
+    if args.output == "-" and args.instrument:
+        arg_parser.error("--instrument writes a .counters file next to the output, so it needs -o FILE")
+    if args.instrument and args.instrument_end is None:
+        arg_parser.error("--instrument needs --instrument-end, the RAM address the counters end at")
+    if args.instrument and not STACK_BASE < args.instrument_end <= HEAP_BASE:
+        arg_parser.error(f"--instrument-end must lie in the stack segment, from {STACK_BASE + 1} to {HEAP_BASE}")
     try:
-        if os.path.isdir(filename):  
-            dir_name = os.path.basename(filename)
-            out_file = dir_name + '.asm'
-            writer = CodeWriter(os.path.join(filename, out_file))    
+        if args.python:
+            if os.path.isdir(filename):
+                in_files = vm_files(filename)
+                out_file = os.path.join(filename, os.path.basename(os.path.abspath(filename)) + ".py")
+            else:
+                in_files = [filename]
+                out_file = os.path.splitext(filename)[0] + ".py"
+            writer = PythonWriter(out_file)
+            for in_file in in_files:
+                _process_vm_file(in_file=in_file, writer=writer)
+        elif filename == "-":
+            # commands are translated as they are read, so memory use does
+            # not depend on the size of the input
+            writer = CodeWriter(args.output or "-")
+            writer.batch_sp = args.batch_sp
+            writer.prologue = args.prologue
+            writer.tail_calls = args.tail_calls
+            writer.set_file_name("Stdin")
+            if args.init:
+                writer.write_init()
+            _process_commands(Parser.iter_commands(sys.stdin, "<stdin>"), writer, class_per_function=True)
+        elif os.path.isdir(filename):  
+            dir_name = os.path.basename(os.path.abspath(filename))
+            out_file = args.output or os.path.join(filename, dir_name + '.asm')
+            in_files = vm_files(filename)
+            inline_by_fn = {}
+            if args.inline:
+                inline_by_fn = _choose_inline_callees(
+                    in_files, args.inline_max_commands, args.inline_budget
+                )
+            reachable = None
+            if not args.keep_unreachable:
+                reachable = _reachable_functions(in_files, inlined=set(inline_by_fn))
+            counter_by_name = {}
+            if args.instrument:
+                counter_by_name = _counter_slots(
+                    in_files, reachable, args.instrument_loops, args.instrument_end
+                )
+                _write_counters_file(out_file, counter_by_name)
+            if args.objects:
+                # units go in a directory of their own, so they do not
+                # overwrite the X.asm of a single-file translation of X.vm
+                obj_dir = os.path.join(filename, "obj")
+                os.makedirs(obj_dir, exist_ok=True)
+                # the bootstrap is a unit of its own, linked first
+                writer = CodeWriter(os.path.join(obj_dir, dir_name + ".boot.asm"))
+            else:
+                writer = CodeWriter(out_file)
+            zero_fill_max = 0
+            if args.prologue == "size":
+                zero_fill_max = _max_num_vars(in_files, reachable)
+            options = CodegenOptions(
+                inline_by_fn=inline_by_fn,
+                counter_by_name=counter_by_name,
+                batch_sp=args.batch_sp,
+                prologue=args.prologue,
+                zero_fill_max=zero_fill_max,
+                tail_calls=args.tail_calls,
+            )
+            cache = None
+            if args.cache_dir:
+                cache = FragmentCache(args.cache_dir, args.cache_size)
             writer.write_init()
-            with os.scandir(filename) as it:
-                for entry in it:
-                    if entry.name.endswith(".vm") and entry.is_file():            
-                        _process_vm_file(in_file=entry.path, writer=writer)
+            if zero_fill_max:
+                writer.write_zero_fill(zero_fill_max)
+            fragments = _translate_vm_files(
+                in_files,
+                functions=reachable,
+                options=options,
+                jobs=args.jobs,
+                cache=cache,
+            )
+            if args.objects:
+                units = [dir_name + ".boot.asm"]
+                for in_file, (fragment, rom_words) in zip(in_files, fragments):
+                    unit = os.path.splitext(os.path.basename(in_file))[0] + ".asm"
+                    _write_unit(os.path.join(obj_dir, unit), fragment)
+                    units.append(unit)
+                    writer.rom_words += rom_words
+                with open(os.path.join(filename, dir_name + ".units"), "w") as file:
+                    file.write("".join(f"obj/{unit}\n" for unit in units))
+            else:
+                for fragment, rom_words in fragments:
+                    writer.write_fragment(fragment, rom_words)
+            if cache is not None:
+                cache.evict()
+            if args.batch_sp:
+                _print_sp_report(_batched_sp_writes(in_files, reachable, options))
+            if reachable is not None:
+                words_by_fn = _unreachable_rom_words(in_files, reachable)
+                print(
+                    f"Eliminated {len(words_by_fn)} unreachable functions, "
+                    f"saving {sum(words_by_fn.values())} ROM words "
+                    f"({writer.rom_words} ROM words emitted)",
+                    file=sys.stderr,
+                )
+            if writer.rom_words > ROM_SIZE:
+                print(
+                    f"warning: {writer.rom_words} ROM words do not fit in the {ROM_SIZE}-word ROM, "
+                    f"see RomReport.py",
+                    file=sys.stderr,
+                )
         else:
             path = os.path.splitext(filename)[0]
-            out_file = path + '.asm'
+            out_file = args.output or path + '.asm'
+            inline_by_fn = {}
+            if args.inline:
+                inline_by_fn = _choose_inline_callees(
+                    [filename], args.inline_max_commands, args.inline_budget
+                )
+            counter_by_name = {}
+            if args.instrument:
+                counter_by_name = _counter_slots(
+                    [filename], None, args.instrument_loops, args.instrument_end
+                )
+                _write_counters_file(out_file, counter_by_name)
             writer = CodeWriter(out_file)
+            CodegenOptions(
+                inline_by_fn=inline_by_fn,
+                counter_by_name=counter_by_name,
+                batch_sp=args.batch_sp,
+                prologue=args.prologue,
+                tail_calls=args.tail_calls,
+            ).apply(writer)
+            if args.init:
+                writer.write_init()
             _process_vm_file(in_file=filename, writer=writer)
+            if args.batch_sp:
+                _print_sp_report({os.path.basename(filename): (writer.sp_writes, writer.sp_writes_emitted)})
         writer.close()
+    except CounterRangeError as e:
+        # raised before any output file is opened
+        arg_parser.error(str(e))
     except Exception as e:
         traceback.print_exc()
         writer.close()
@@ -1,5 +1,5 @@
 import os, sys, re
-from typing import TextIO, Optional
+from typing import TextIO, Optional, Iterator, Tuple
 import html
 from functools import wraps
 
@@ -82,104 +82,68 @@ class TokenKeyword:
     THIS = "this"
 
 
+# One alternative per kind of lexical element, tried in order at each
+# position. Whitespace and comments are matched only to be skipped, and the
+# token kinds are named as TokenType so that a match's lastgroup is its type.
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<comment>//[^\n]*|/\*.*?\*/)
+    | (?P<unterminated_comment>/\*)
+    | (?P<symbol>[{}()\[\].,;+\-*/&|<>=~])
+    | (?P<int_const>[0-9]+)
+    | (?P<string_const>"[^"\n]*")
+    | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<invalid>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+SKIPPED_ELEMENTS = frozenset(("space", "comment"))
+KEYWORD_SET = frozenset(KEYWORDS)
+
+
+def tokenize(text: str) -> Iterator[Tuple[str, str]]:
+    """Yields the (token type, token) pairs of a Jack source in one pass."""
+    for match in TOKEN_PATTERN.finditer(text):
+        token_type = match.lastgroup
+        if token_type in SKIPPED_ELEMENTS:
+            continue
+        token = match.group()
+        if token_type == TokenType.IDENTIFIER:
+            if token in KEYWORD_SET:
+                token_type = TokenType.KEYWORD
+        elif token_type == "invalid":
+            raise Exception(f"Invalid character {token}")
+        elif token_type == "unterminated_comment":
+            raise Exception("Unterminated comment")
+        yield token_type, token
+
+
 class JackTokenizer:
     def __init__(self, file: TextIO):
         self.text: str = file.read()
-        self.current_index: int = 0
+        self.tokens: Iterator[Tuple[str, str]] = tokenize(self.text)
         self.current_token: Optional[str] = None
-        self.next_index: Optional[int] = None
-        self.next_token: Optional[str] = None
+        self.current_type: Optional[str] = None
+        self.next_token: Optional[Tuple[str, str]] = None
         file.seek(0)
 
     def has_more_tokens(self):
-        if self.next_token:
-            return True
-
-        index = self.current_index
-        if index >= len(self.text):
-            return False
-
-        # ignore whitespace and comments
-        is_space = self.text[index].isspace()
-        is_block_comment = self.text[index : index + 2] == "/*"
-        is_inline_comment = self.text[index : index + 2] == "//"
-        while is_space or is_block_comment or is_inline_comment:
-            if is_space:
-                index += 1
-            elif is_inline_comment:
-                # go to the next line
-                index = self.text.index("\n", index + 1) + 1
-            else:
-                # go to the corresponding end block
-                index = self.text.index("*/", index + 2) + 2
-            if index >= len(self.text):
-                return False
-
-            is_space = self.text[index].isspace()
-            is_block_comment = self.text[index : index + 2] == "/*"
-            is_inline_comment = self.text[index : index + 2] == "//"
-
-        curr_char: str = self.text[index]
-        if curr_char in SYMBOLS:
-            # can only be a symbol
-            self.next_token = curr_char
-            self.next_index = index + 1
-        elif curr_char == '"':
-            # can only be a string constant
-            end_index = self.text.index('"', index + 1)
-            self.next_token = self.text[index : end_index + 1]
-            self.next_index = end_index + 1
-        elif curr_char.isdigit():
-            # can only be an integer constant
-            token = curr_char
-            index += 1
-            while index < len(self.text) and self.text[index].isdigit():
-                token += self.text[index]
-                index += 1
-            self.next_token = token
-            self.next_index = index
-        elif curr_char.isalpha():
-            # can be either an identifier or keyword
-            token = curr_char
-            index += 1
-            while (
-                index < len(self.text)
-                and self.text[index].isalnum()
-                or self.text[index] == "_"
-            ):
-                token += self.text[index]
-                index += 1
-            self.next_token = token
-            self.next_index = index
-        else:
-            raise Exception(f"Invalid character {curr_char}")
+        if self.next_token is None:
+            self.next_token = next(self.tokens, None)
         return self.next_token is not None
 
     def advance(self):
         if not self.has_more_tokens():
             raise Exception("No more tokens to read")
-        self.current_token = self.next_token
-        self.current_index = self.next_index
-        self.next_index = None
+        self.current_type, self.current_token = self.next_token
         self.next_token = None
 
     def token_type(self) -> TokenType:
-        if self.current_token in KEYWORDS:
-            return TokenType.KEYWORD
-
-        if self.current_token in SYMBOLS:
-            return TokenType.SYMBOL
-
-        if self.current_token.isdigit():
-            return TokenType.INT_CONST
-
-        if self.current_token.startswith('"') and self.current_token.endswith('"'):
-            return TokenType.STRING_CONST
-
-        if re.search(r"[\w\d_]+", self.current_token):
-            return TokenType.IDENTIFIER
-
-        raise Exception(f"Cannot determine token type for {self.current_token}")
+        if self.current_type is None:
+            raise Exception(f"Cannot determine token type for {self.current_token}")
+        return self.current_type
 
     def keyword(self):
         token_type = self.token_type()
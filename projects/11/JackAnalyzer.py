@@ -1,5 +1,7 @@
 import os, sys, re
-from typing import TextIO, Optional, DefaultDict, NamedTuple, Dict
+import argparse
+from array import array
+from typing import TextIO, Optional, DefaultDict, NamedTuple, Dict, Iterator, Tuple, List, Set, Union
 import html
 from collections import defaultdict
 
@@ -82,866 +84,1804 @@ class TokenKeyword:
     THIS = "this"
 
 
+# One alternative per kind of lexical element, tried in order at each
+# position. Whitespace and comments are matched only to be skipped, and the
+# token kinds are named as TokenType so that a match's lastgroup is its type.
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<comment>//[^\n]*|/\*.*?\*/)
+    | (?P<unterminated_comment>/\*)
+    | (?P<symbol>[{}()\[\].,;+\-*/&|<>=~])
+    | (?P<int_const>[0-9]+)
+    | (?P<string_const>"[^"\n]*")
+    | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<invalid>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+SKIPPED_ELEMENTS = frozenset(("space", "comment"))
+KEYWORD_SET = frozenset(KEYWORDS)
+
+
+def tokenize(text: str) -> Iterator[Tuple[str, str, int, int]]:
+    """Yields the (token type, token, offset, line) of each token of a Jack source in one pass."""
+    line = 1
+    for match in TOKEN_PATTERN.finditer(text):
+        token_type = match.lastgroup
+        token = match.group()
+        if token_type in SKIPPED_ELEMENTS:
+            line += token.count("\n")
+            continue
+        if token_type == TokenType.IDENTIFIER:
+            if token in KEYWORD_SET:
+                token_type = TokenType.KEYWORD
+        elif token_type == "invalid":
+            raise Exception(f"line {line}: invalid character {token}")
+        elif token_type == "unterminated_comment":
+            raise Exception(f"line {line}: unterminated comment")
+        yield token_type, token, match.start(), line
+
+
 class JackTokenizer:
+    """The tokens of a Jack source, classified up front.
+
+    types, values, offsets and lines are parallel arrays indexed by token
+    number; cursor is the number of the current token, so looking at any
+    token is an index and accessors do no classification. Values are
+    interned, and keywords are TokenKeyword values as they are.
+    """
+
     def __init__(self, file: TextIO):
+        self.filename: str = getattr(file, "name", "<input>")
         self.text: str = file.read()
-        self.current_index: int = 0
-        self.current_token: Optional[str] = None
-        self.next_index: Optional[int] = None
-        self.next_token: Optional[str] = None
+        self.types: List[str] = []
+        self.values: List[str] = []
+        self.offsets = array("L")
+        self.lines = array("L")
+        for token_type, token, offset, line in tokenize(self.text):
+            self.types.append(token_type)
+            self.values.append(sys.intern(token))
+            self.offsets.append(offset)
+            self.lines.append(line)
+        self.cursor: int = -1
         file.seek(0)
 
     def has_more_tokens(self):
-        if self.next_token:
-            return True
-
-        index = self.current_index
-        if index >= len(self.text):
-            return False
-
-        # ignore whitespace and comments
-        is_space = self.text[index].isspace()
-        is_block_comment = self.text[index : index + 2] == "/*"
-        is_inline_comment = self.text[index : index + 2] == "//"
-        while is_space or is_block_comment or is_inline_comment:
-            if is_space:
-                index += 1
-            elif is_inline_comment:
-                # go to the next line
-                index = self.text.index("\n", index + 1) + 1
-            else:
-                # go to the corresponding end block
-                index = self.text.index("*/", index + 2) + 2
-            if index >= len(self.text):
-                return False
-
-            is_space = self.text[index].isspace()
-            is_block_comment = self.text[index : index + 2] == "/*"
-            is_inline_comment = self.text[index : index + 2] == "//"
-
-        curr_char: str = self.text[index]
-        if curr_char in SYMBOLS:
-            # can only be a symbol
-            self.next_token = curr_char
-            self.next_index = index + 1
-        elif curr_char == '"':
-            # can only be a string constant
-            end_index = self.text.index('"', index + 1)
-            self.next_token = self.text[index : end_index + 1]
-            self.next_index = end_index + 1
-        elif curr_char.isdigit():
-            # can only be an integer constant
-            token = curr_char
-            index += 1
-            while index < len(self.text) and self.text[index].isdigit():
-                token += self.text[index]
-                index += 1
-            self.next_token = token
-            self.next_index = index
-        elif curr_char.isalpha():
-            # can be either an identifier or keyword
-            token = curr_char
-            index += 1
-            while (
-                index < len(self.text)
-                and self.text[index].isalnum()
-                or self.text[index] == "_"
-            ):
-                token += self.text[index]
-                index += 1
-            self.next_token = token
-            self.next_index = index
-        else:
-            raise Exception(f"Invalid character {curr_char}")
-        return self.next_token is not None
+        return self.cursor + 1 < len(self.types)
 
     def advance(self):
         if not self.has_more_tokens():
-            raise Exception("No more tokens to read")
-        self.current_token = self.next_token
-        self.current_index = self.next_index
-        self.next_index = None
-        self.next_token = None
+            raise self.error("no more tokens to read")
+        self.cursor += 1
+
+    def peek(self) -> Optional[str]:
+        """The value of the token after the current one, None at the end."""
+        if self.cursor + 1 < len(self.values):
+            return self.values[self.cursor + 1]
+        return None
+
+    def location(self, cursor: Optional[int] = None) -> str:
+        if cursor is None:
+            cursor = self.cursor
+        if not 0 <= cursor < len(self.types):
+            return f"{self.filename}: end of file"
+        return f"{self.filename}:{self.lines[cursor]}"
+
+    def error(self, message: Optional[str] = None) -> Exception:
+        """An exception for the current token, to raise where it does not fit the grammar."""
+        if message is None:
+            if 0 <= self.cursor < len(self.types):
+                message = f"unexpected {self.types[self.cursor]} {self.values[self.cursor]}"
+            else:
+                message = "unexpected end of file"
+        return Exception(f"{self.location()}: {message}")
 
     def token_type(self) -> TokenType:
-        if self.current_token in KEYWORDS:
-            return TokenType.KEYWORD
-
-        if self.current_token in SYMBOLS:
-            return TokenType.SYMBOL
-
-        if self.current_token.isdigit():
-            return TokenType.INT_CONST
-
-        if self.current_token.startswith('"') and self.current_token.endswith('"'):
-            return TokenType.STRING_CONST
-
-        if re.search(r"[\w\d_]+", self.current_token):
-            return TokenType.IDENTIFIER
-
-        raise Exception(f"Cannot determine token type for {self.current_token}")
+        return self.types[self.cursor]
 
     def keyword(self):
-        token_type = self.token_type()
-        if token_type != TokenType.KEYWORD:
-            raise Exception("Current token is not a keyword")
-        mappings = {
-            "class": TokenKeyword.CLASS,
-            "method": TokenKeyword.METHOD,
-            "function": TokenKeyword.FUNCTION,
-            "constructor": TokenKeyword.CONSTRUCTOR,
-            "int": TokenKeyword.INT,
-            "boolean": TokenKeyword.BOOLEAN,
-            "char": TokenKeyword.CHAR,
-            "void": TokenKeyword.VOID,
-            "var": TokenKeyword.VAR,
-            "static": TokenKeyword.STATIC,
-            "field": TokenKeyword.FIELD,
-            "let": TokenKeyword.LET,
-            "do": TokenKeyword.DO,
-            "if": TokenKeyword.IF,
-            "else": TokenKeyword.ELSE,
-            "while": TokenKeyword.WHILE,
-            "return": TokenKeyword.RETURN,
-            "true": TokenKeyword.TRUE,
-            "false": TokenKeyword.FALSE,
-            "null": TokenKeyword.NULL,
-            "this": TokenKeyword.THIS,
-        }
-        return mappings[self.current_token]
+        if self.types[self.cursor] != TokenType.KEYWORD:
+            raise self.error("expected a keyword")
+        return self.values[self.cursor]
 
     def symbol(self):
-        token_type = self.token_type()
-        if token_type != TokenType.SYMBOL:
-            raise Exception("Current token is not a symbol")
-        return self.current_token
+        if self.types[self.cursor] != TokenType.SYMBOL:
+            raise self.error("expected a symbol")
+        return self.values[self.cursor]
 
     def identifier(self):
-        token_type = self.token_type()
-        if token_type != TokenType.IDENTIFIER:
-            raise Exception("Current token is not an identifier")
-        return self.current_token
+        if self.types[self.cursor] != TokenType.IDENTIFIER:
+            raise self.error("expected an identifier")
+        return self.values[self.cursor]
 
     def int_val(self):
-        token_type = self.token_type()
-        if token_type != TokenType.INT_CONST:
-            raise Exception("Current token is not an integer constant")
-        return int(self.current_token)
+        if self.types[self.cursor] != TokenType.INT_CONST:
+            raise self.error("expected an integer constant")
+        return int(self.values[self.cursor])
 
     def string_val(self):
-        token_type = self.token_type()
-        if token_type != TokenType.STRING_CONST:
-            raise Exception("Current token is not a string constant")
-        return self.current_token[1:-1]  # remove surrounding double quotes
+        if self.types[self.cursor] != TokenType.STRING_CONST:
+            raise self.error("expected a string constant")
+        return self.values[self.cursor][1:-1]  # remove surrounding double quotes
+
+
+class ClassNode:
+    __slots__ = ("name", "n_statics", "n_fields", "subroutines")
+
+    def __init__(self, name: str, n_statics: int, n_fields: int, subroutines: List["SubroutineNode"]):
+        self.name = name
+        self.n_statics = n_statics
+        self.n_fields = n_fields
+        self.subroutines = subroutines
+
+
+class SubroutineNode:
+    __slots__ = ("kind", "return_type", "name", "n_locals", "statements")
+
+    def __init__(self, kind: str, return_type: str, name: str, n_locals: int, statements: List["Statement"]):
+        self.kind = kind
+        self.return_type = return_type
+        self.name = name
+        self.n_locals = n_locals
+        self.statements = statements
+
+
+class LetStatement:
+    __slots__ = ("target", "index", "value")
+
+    def __init__(self, target: "Variable", index: Optional["Expression"], value: "Expression"):
+        self.target = target
+        self.index = index  # None unless this assigns an array element
+        self.value = value
+
+
+class IfStatement:
+    __slots__ = ("condition", "then_statements", "else_statements")
+
+    def __init__(
+        self,
+        condition: "Expression",
+        then_statements: List["Statement"],
+        else_statements: Optional[List["Statement"]],
+    ):
+        self.condition = condition
+        self.then_statements = then_statements
+        self.else_statements = else_statements
+
+
+class WhileStatement:
+    __slots__ = ("condition", "statements")
+
+    def __init__(self, condition: "Expression", statements: List["Statement"]):
+        self.condition = condition
+        self.statements = statements
+
+
+class DoStatement:
+    __slots__ = ("call",)
+
+    def __init__(self, call: "SubroutineCall"):
+        self.call = call
+
+
+class ReturnStatement:
+    __slots__ = ("value",)
+
+    def __init__(self, value: Optional["Expression"]):
+        self.value = value
+
+
+class IntegerConstant:
+    __slots__ = ("value",)
+
+    def __init__(self, value: int):
+        self.value = value
+
+
+class StringConstant:
+    __slots__ = ("value",)
+
+    def __init__(self, value: str):
+        self.value = value
+
+
+class KeywordConstant:
+    __slots__ = ("keyword",)
+
+    def __init__(self, keyword: str):
+        self.keyword = keyword
+
+
+class Variable:
+    """A use of a variable, resolved to the VM segment and index it lives at."""
+
+    __slots__ = ("name", "var_type", "segment", "index")
+
+    def __init__(self, name: str, var_type: str, segment: str, index: int):
+        self.name = name
+        self.var_type = var_type
+        self.segment = segment
+        self.index = index
+
+
+class ArrayAccess:
+    __slots__ = ("array", "index")
+
+    def __init__(self, array: Variable, index: "Expression"):
+        self.array = array
+        self.index = index
+
+
+class SubroutineCall:
+    """A call of the VM function name.
+
+    receiver is the object a method is called on, passed as the first
+    argument: a Variable, or the KeywordConstant this for a call on the
+    current object. It is None for a function or constructor call.
+    """
+
+    __slots__ = ("name", "receiver", "args")
+
+    def __init__(self, name: str, receiver: Optional[Union[Variable, KeywordConstant]], args: List["Expression"]):
+        self.name = name
+        self.receiver = receiver
+        self.args = args
+
+
+class UnaryOp:
+    __slots__ = ("op", "operand")
+
+    def __init__(self, op: str, operand: "Expression"):
+        self.op = op
+        self.operand = operand
+
+
+class BinaryOp:
+    __slots__ = ("op", "left", "right")
+
+    def __init__(self, op: str, left: "Expression", right: "Expression"):
+        self.op = op
+        self.left = left
+        self.right = right
+
+
+Statement = Union[LetStatement, IfStatement, WhileStatement, DoStatement, ReturnStatement]
+Expression = Union[
+    IntegerConstant, StringConstant, KeywordConstant, Variable, ArrayAccess, SubroutineCall, UnaryOp, BinaryOp
+]
+
+BINARY_OPS = ("+", "-", "*", "/", "&", "|", "<", ">", "=")
+UNARY_OPS = ("-", "~")
+KEYWORD_CONSTANTS = (TokenKeyword.TRUE, TokenKeyword.FALSE, TokenKeyword.NULL, TokenKeyword.THIS)
+PRIMITIVE_TYPES = (TokenKeyword.INT, TokenKeyword.CHAR, TokenKeyword.BOOLEAN)
 
 
 class CompilationEngine:
-    def __init__(self, in_file: TextIO, out_file: TextIO):
+    """Parses a Jack class into an AST, resolving the variables it uses."""
+
+    def __init__(self, in_file: TextIO):
         self.tokenizer: JackTokenizer = JackTokenizer(in_file)
-        self.writer: VMWriter = VMWriter(out_file)
         self.class_table: SymbolTable = SymbolTable()
         self.subroutine_table: SymbolTable = SymbolTable()
         self.tokenizer.advance()
 
         self.class_name = None
-        self.method_name = None
-        self.label_count = 0
-        self.expression_counts = []
 
-    def compile_class(self):
+    def _at_symbol(self, symbol: str) -> bool:
+        return self.tokenizer.token_type() == TokenType.SYMBOL and self.tokenizer.symbol() == symbol
+
+    def _expect_symbol(self, symbol: str):
+        if self.tokenizer.symbol() != symbol:
+            raise self.tokenizer.error()
+        self.tokenizer.advance()
+
+    def _compile_type(self) -> str:
+        # 'int' | 'char' | 'boolean' | className
+        if self.tokenizer.token_type() == TokenType.KEYWORD:
+            if self.tokenizer.keyword() not in PRIMITIVE_TYPES:
+                raise self.tokenizer.error()
+            var_type = self.tokenizer.keyword()
+        elif self.tokenizer.token_type() == TokenType.IDENTIFIER:
+            var_type = self.tokenizer.identifier()
+        else:
+            raise self.tokenizer.error()
+        self.tokenizer.advance()
+        return var_type
+
+    def _resolve(self, var_name: str) -> Optional[Variable]:
+        # look at the subroutine table first, then at the class table
+        for table in (self.subroutine_table, self.class_table):
+            var_kind = table.kind_of(var_name)
+            if var_kind != VarKind.NONE:
+                return Variable(
+                    name=var_name,
+                    var_type=table.type_of(var_name),
+                    segment=VM_SEGMENT_BY_VAR_KIND[var_kind],
+                    index=table.index_of(var_name),
+                )
+        return None
+
+    def _compile_variable(self) -> Variable:
+        var_name = self.tokenizer.identifier()
+        variable = self._resolve(var_name)
+        if variable is None:
+            raise self.tokenizer.error(f"undefined variable {var_name}")
+        self.tokenizer.advance()
+        return variable
+
+    def compile_class(self) -> ClassNode:
         # 'class' className '{' classVarDec* subroutineDec* '}'
         if self.tokenizer.keyword() != TokenKeyword.CLASS:
-            raise Exception
+            raise self.tokenizer.error()
         self.tokenizer.advance()
         self.class_name = self.tokenizer.identifier()
 
         self.tokenizer.advance()
-        if self.tokenizer.symbol() != "{":
-            raise Exception
-
-        self.tokenizer.advance()
+        self._expect_symbol("{")
         while self.tokenizer.token_type() == TokenType.KEYWORD and self.tokenizer.keyword() in (
             TokenKeyword.STATIC,
             TokenKeyword.FIELD,
         ):
             self.compile_class_var_dec()
+        subroutines = []
         while self.tokenizer.token_type() == TokenType.KEYWORD and self.tokenizer.keyword() in (
             TokenKeyword.CONSTRUCTOR,
             TokenKeyword.FUNCTION,
             TokenKeyword.METHOD,
         ):
-            self.compile_subroutine_dec()
+            subroutines.append(self.compile_subroutine_dec())
 
         if self.tokenizer.symbol() != "}":
-            raise Exception
-        self.writer.close()
+            raise self.tokenizer.error()
+        return ClassNode(
+            name=self.class_name,
+            n_statics=self.class_table.var_count(VarKind.STATIC),
+            n_fields=self.class_table.var_count(VarKind.FIELD),
+            subroutines=subroutines,
+        )
 
     def compile_class_var_dec(self):
         # ('static'|'field') type varName (',' varName)*';'
-        # type = 'int' | 'char' | 'boolean' | 'className'
-        if self.tokenizer.keyword() not in (TokenKeyword.STATIC, TokenKeyword.FIELD):
-            raise Exception
-
         var_kind = self.tokenizer.keyword()
-        # handle type
         self.tokenizer.advance()
-        if self.tokenizer.token_type() == TokenType.KEYWORD:
-            if self.tokenizer.keyword() in (
-                TokenKeyword.INT,
-                TokenKeyword.CHAR,
-                TokenKeyword.BOOLEAN,
-            ):
-                var_type = self.tokenizer.keyword()
-            else:
-                raise Exception
-        elif self.tokenizer.token_type() == TokenType.IDENTIFIER:
-            var_type = self.tokenizer.identifier()
-        else:
-            raise Exception
-
-        self.tokenizer.advance()
-        var_name = self.tokenizer.identifier()
-        self.class_table.define(var_name=var_name, var_type=var_type, var_kind=var_kind)
-
+        var_type = self._compile_type()
+        self.class_table.define(var_name=self.tokenizer.identifier(), var_type=var_type, var_kind=var_kind)
         self.tokenizer.advance()
-        while (
-            self.tokenizer.token_type() == TokenType.SYMBOL
-            and self.tokenizer.symbol() == ","
-        ):
+        while self._at_symbol(","):
             self.tokenizer.advance()
-            var_name = self.tokenizer.identifier()
-            self.class_table.define(
-                var_name=var_name, var_type=var_type, var_kind=var_kind
-            )
+            self.class_table.define(var_name=self.tokenizer.identifier(), var_type=var_type, var_kind=var_kind)
             self.tokenizer.advance()
+        self._expect_symbol(";")
 
-        if self.tokenizer.symbol() != ";":
-            raise Exception
-
-        self.tokenizer.advance()
-
-    def compile_subroutine_dec(self):
+    def compile_subroutine_dec(self) -> SubroutineNode:
         # ('constructor'|'function'|'method') ('void'|type)
         # subroutineName '('parameterList')' subroutineBody
         self.subroutine_table.start_subroutine()
-        if self.tokenizer.keyword() not in (
-            TokenKeyword.CONSTRUCTOR,
-            TokenKeyword.FUNCTION,
-            TokenKeyword.METHOD,
-        ):
-            raise Exception
-        self.method_type = self.tokenizer.keyword()
+        kind = self.tokenizer.keyword()
         self.tokenizer.advance()
-        if self.tokenizer.token_type() == TokenType.IDENTIFIER:
-            self.return_type = self.tokenizer.identifier()
-        elif self.tokenizer.token_type() == TokenType.KEYWORD:
-            if self.tokenizer.keyword() not in (
-                TokenKeyword.VOID,
-                TokenKeyword.INT,
-                TokenKeyword.CHAR,
-                TokenKeyword.BOOLEAN,
-            ):
-                raise Exception
-            else:
-                self.return_type = self.tokenizer.keyword()
+        if self.tokenizer.token_type() == TokenType.KEYWORD and self.tokenizer.keyword() == TokenKeyword.VOID:
+            return_type = self.tokenizer.keyword()
+            self.tokenizer.advance()
         else:
-            raise Exception
-
-        self.tokenizer.advance()
-        self.method_name = self.tokenizer.identifier()
-        self.tokenizer.advance()
-        if self.tokenizer.symbol() != "(":
-            raise Exception
+            return_type = self._compile_type()
 
+        name = self.tokenizer.identifier()
         self.tokenizer.advance()
+        self._expect_symbol("(")
+        if kind == TokenKeyword.METHOD:
+            self.subroutine_table.define(var_name="this", var_type=self.class_name, var_kind=VarKind.ARG)
         self.compile_parameter_list()
-        if self.tokenizer.symbol() != ")":
-            raise Exception
+        self._expect_symbol(")")
 
-        self.tokenizer.advance()
-        self.compile_subroutine_body()
+        # '{'varDec* statements'}'
+        self._expect_symbol("{")
+        while self.tokenizer.token_type() == TokenType.KEYWORD and self.tokenizer.keyword() == TokenKeyword.VAR:
+            self.compile_var_dec()
+        statements = self.compile_statements()
+        self._expect_symbol("}")
+        return SubroutineNode(
+            kind=kind,
+            return_type=return_type,
+            name=name,
+            n_locals=self.subroutine_table.var_count(VarKind.LOCAL),
+            statements=statements,
+        )
 
     def compile_parameter_list(self):
-        # ((type varName) (',' type varName))
-        # handle type
-        if self.method_type == TokenKeyword.METHOD:
-            self.subroutine_table.define(
-                var_name="this", var_type=self.class_name, var_kind=VarKind.ARG
-            )
-
-        if self.tokenizer.token_type() == TokenType.KEYWORD:
-            if self.tokenizer.keyword() in (
-                TokenKeyword.INT,
-                TokenKeyword.CHAR,
-                TokenKeyword.BOOLEAN,
-            ):
-                var_type = self.tokenizer.keyword()
-            else:
-                raise Exception
-        elif self.tokenizer.token_type() == TokenType.IDENTIFIER:
-            var_type = self.tokenizer.identifier()
-        else:
+        # ((type varName) (',' type varName)*)?
+        if self._at_symbol(")"):
             return
-
-        self.tokenizer.advance()
-        var_name = self.tokenizer.identifier()
-        self.subroutine_table.define(
-            var_name=var_name, var_type=var_type, var_kind=VarKind.ARG
-        )
-
+        var_type = self._compile_type()
+        self.subroutine_table.define(var_name=self.tokenizer.identifier(), var_type=var_type, var_kind=VarKind.ARG)
         self.tokenizer.advance()
-        while (
-            self.tokenizer.token_type() == TokenType.SYMBOL
-            and self.tokenizer.symbol() == ","
-        ):
-            self.tokenizer.advance()
-            # handle type
-            if self.tokenizer.token_type() == TokenType.KEYWORD:
-                if self.tokenizer.keyword() in (
-                    TokenKeyword.INT,
-                    TokenKeyword.CHAR,
-                    TokenKeyword.BOOLEAN,
-                ):
-                    var_type = self.tokenizer.keyword()
-                else:
-                    raise Exception
-            elif self.tokenizer.token_type() == TokenType.IDENTIFIER:
-                var_type = self.tokenizer.identifier()
-            else:
-                raise Exception
-
+        while self._at_symbol(","):
             self.tokenizer.advance()
-            var_name = self.tokenizer.identifier()
+            var_type = self._compile_type()
             self.subroutine_table.define(
-                var_name=var_name, var_type=var_type, var_kind=VarKind.ARG
+                var_name=self.tokenizer.identifier(), var_type=var_type, var_kind=VarKind.ARG
             )
             self.tokenizer.advance()
 
-    def compile_subroutine_body(self):
-        # '{'varDec* statements'}'
-        if self.tokenizer.symbol() != "{":
-            raise Exception
-
-        self.tokenizer.advance()
-        while (
-            self.tokenizer.token_type() == TokenType.KEYWORD
-            and self.tokenizer.keyword() == TokenKeyword.VAR
-        ):
-            self.compile_var_dec()
-
-        n_locals = self.subroutine_table.var_count(VarKind.LOCAL)
-        n_fields = self.class_table.var_count(VarKind.FIELD)
-        self.writer.write_function(
-            name=f"{self.class_name}.{self.method_name}", n_locals=n_locals
-        )
-        if self.method_type == TokenKeyword.METHOD:
-            # set THIS to the first argument
-            self.writer.write_push(segment=VMSegment.ARG, index=0)
-            self.writer.write_pop(segment=VMSegment.POINTER, index=0)
-        elif self.method_type == TokenKeyword.CONSTRUCTOR:
-            # allocate memory for field variables
-            self.writer.write_push(segment=VMSegment.CONST, index=n_fields)
-            self.writer.write_call(name="Memory.alloc", n_args=1)
-            self.writer.write_pop(segment=VMSegment.POINTER, index=0)
-
-        self.compile_statements()
-        if self.tokenizer.symbol() != "}":
-            raise Exception
-
-        self.tokenizer.advance()
-
     def compile_var_dec(self):
         # 'var' type varName (',' varName)*';'
-        # type = int | char | boolean | className
-        if self.tokenizer.keyword() != TokenKeyword.VAR:
-            raise Exception
-
-        self.tokenizer.advance()
-        # handle type
-        if self.tokenizer.token_type() == TokenType.KEYWORD:
-            if self.tokenizer.keyword() in (
-                TokenKeyword.INT,
-                TokenKeyword.CHAR,
-                TokenKeyword.BOOLEAN,
-            ):
-                var_type = self.tokenizer.keyword()
-            else:
-                raise Exception
-        elif self.tokenizer.token_type() == TokenType.IDENTIFIER:
-            var_type = self.tokenizer.identifier()
-        else:
-            raise Exception
-
         self.tokenizer.advance()
-        var_name = self.tokenizer.identifier()
-        self.subroutine_table.define(
-            var_name=var_name, var_type=var_type, var_kind=VarKind.LOCAL
-        )
-
+        var_type = self._compile_type()
+        self.subroutine_table.define(var_name=self.tokenizer.identifier(), var_type=var_type, var_kind=VarKind.LOCAL)
         self.tokenizer.advance()
-        while (
-            self.tokenizer.token_type() == TokenType.SYMBOL
-            and self.tokenizer.symbol() == ","
-        ):
+        while self._at_symbol(","):
             self.tokenizer.advance()
-            var_name = self.tokenizer.identifier()
             self.subroutine_table.define(
-                var_name=var_name, var_type=var_type, var_kind=VarKind.LOCAL
+                var_name=self.tokenizer.identifier(), var_type=var_type, var_kind=VarKind.LOCAL
             )
             self.tokenizer.advance()
+        self._expect_symbol(";")
 
-        if self.tokenizer.symbol() != ";":
-            raise Exception
-        self.tokenizer.advance()
-
-    def compile_statements(self):
+    def compile_statements(self) -> List[Statement]:
+        statements = []
         while self.tokenizer.token_type() == TokenType.KEYWORD:
             keyword = self.tokenizer.keyword()
             if keyword == TokenKeyword.IF:
-                self.compile_if()
+                statements.append(self.compile_if())
             elif keyword == TokenKeyword.LET:
-                self.compile_let()
+                statements.append(self.compile_let())
             elif keyword == TokenKeyword.WHILE:
-                self.compile_while()
+                statements.append(self.compile_while())
             elif keyword == TokenKeyword.DO:
-                self.compile_do()
+                statements.append(self.compile_do())
             elif keyword == TokenKeyword.RETURN:
-                self.compile_return()
+                statements.append(self.compile_return())
             else:
                 break
+        return statements
 
-    def compile_let(self):
+    def compile_let(self) -> LetStatement:
         # 'let' varName ('['expression']')?'='expression';'
-        if self.tokenizer.keyword() != TokenKeyword.LET:
-            raise Exception
-
         self.tokenizer.advance()
-        var_name = self.tokenizer.identifier()
-
-        # look at the subroutine table first
-        var_kind = self.subroutine_table.kind_of(var_name)
-        vm_index = self.subroutine_table.index_of(var_name)
-        if var_kind == VarKind.NONE:
-            # if it's not there, it's probably in the class table
-            var_kind = self.class_table.kind_of(var_name)
-            vm_index = self.class_table.index_of(var_name)
-        if var_kind == VarKind.NONE:
-            # if this is the case, then it is in neither tables
-            raise Exception
-        segment = VM_SEGMENT_BY_VAR_KIND[var_kind]
-        self.tokenizer.advance()
-        if self.tokenizer.symbol() == "[":
-            # this is an array assignment
-            self.writer.write_push(segment=segment, index=vm_index)
+        target = self._compile_variable()
+        index = None
+        if self._at_symbol("["):
             self.tokenizer.advance()
-            self.compile_expression()
-            self.writer.write_arithmetic(VMArithmetic.ADD)
-            # offset array by stack val
-            if self.tokenizer.symbol() != "]":
-                raise Exception
-            self.tokenizer.advance()
-
-            if self.tokenizer.symbol() != "=":
-                raise Exception
-
-            self.tokenizer.advance()
-            self.compile_expression()
-            self.writer.write_pop(segment=VMSegment.TEMP, index=0)
-            self.writer.write_pop(segment=VMSegment.POINTER, index=1)
-            self.writer.write_push(segment=VMSegment.TEMP, index=0)
-            self.writer.write_pop(segment=VMSegment.THAT, index=0)
-        else:
-            # this is a non-array assignment
-            if self.tokenizer.symbol() != "=":
-                raise Exception
-
-            self.tokenizer.advance()
-            self.compile_expression()
-            segment = VM_SEGMENT_BY_VAR_KIND[var_kind]
-            self.writer.write_pop(segment=segment, index=vm_index)
-
-        if self.tokenizer.symbol() != ";":
-            raise Exception
-        self.tokenizer.advance()
-
-    def compile_if(self):
+            index = self.compile_expression()
+            self._expect_symbol("]")
+        self._expect_symbol("=")
+        value = self.compile_expression()
+        self._expect_symbol(";")
+        return LetStatement(target=target, index=index, value=value)
+
+    def compile_if(self) -> IfStatement:
         # 'if' '('expression')' '{'statements'}'('else''{'statements'}')?
-        if self.tokenizer.keyword() != TokenKeyword.IF:
-            raise Exception
-
         self.tokenizer.advance()
-        if self.tokenizer.symbol() != "(":
-            raise Exception
+        self._expect_symbol("(")
+        condition = self.compile_expression()
+        self._expect_symbol(")")
+        self._expect_symbol("{")
+        then_statements = self.compile_statements()
+        self._expect_symbol("}")
+        else_statements = None
+        if self.tokenizer.token_type() == TokenType.KEYWORD and self.tokenizer.keyword() == TokenKeyword.ELSE:
+            self.tokenizer.advance()
+            self._expect_symbol("{")
+            else_statements = self.compile_statements()
+            self._expect_symbol("}")
+        return IfStatement(condition=condition, then_statements=then_statements, else_statements=else_statements)
 
+    def compile_while(self) -> WhileStatement:
+        # 'while' '(' expression ')' '{' statements '}'
         self.tokenizer.advance()
-        self.compile_expression()
-        self.writer.write_arithmetic(VMArithmetic.NOT)
-        else_label = f"L{self.label_count}"
-        end_label = f"L{self.label_count + 1}"
-        self.label_count += 2
-        self.writer.write_if(else_label)
-
-        if self.tokenizer.symbol() != ")":
-            raise Exception
-
+        self._expect_symbol("(")
+        condition = self.compile_expression()
+        self._expect_symbol(")")
+        self._expect_symbol("{")
+        statements = self.compile_statements()
+        self._expect_symbol("}")
+        return WhileStatement(condition=condition, statements=statements)
+
+    def compile_do(self) -> DoStatement:
+        # 'do' subroutineCall';'
         self.tokenizer.advance()
-        if self.tokenizer.symbol() != "{":
-            raise Exception
-
+        first_identifier = self.tokenizer.identifier()
         self.tokenizer.advance()
-        self.compile_statements()
-        self.writer.write_goto(end_label)
-
-        if self.tokenizer.symbol() != "}":
-            raise Exception
+        call = self.compile_subroutine_call(first_identifier)
+        self._expect_symbol(";")
+        return DoStatement(call)
 
+    def compile_return(self) -> ReturnStatement:
+        # 'return' expression?';'
         self.tokenizer.advance()
-        self.writer.write_label(else_label)
-        if (
-            self.tokenizer.token_type() == TokenType.KEYWORD
-            and self.tokenizer.keyword() == TokenKeyword.ELSE
-        ):
+        value = None
+        if not self._at_symbol(";"):
+            value = self.compile_expression()
+        self._expect_symbol(";")
+        return ReturnStatement(value)
+
+    def compile_subroutine_call(self, first_identifier: str) -> SubroutineCall:
+        # subroutineName'('expressionList')' | (className|varName)'.'subroutineName'('expressionList')'
+        if self._at_symbol("."):
             self.tokenizer.advance()
-            if self.tokenizer.symbol() != "{":
-                raise Exception
+            receiver = self._resolve(first_identifier)
+            # a method called on a variable, otherwise a function or constructor
+            class_name = first_identifier if receiver is None else receiver.var_type
+            name = f"{class_name}.{self.tokenizer.identifier()}"
+            self.tokenizer.advance()
+        else:
+            # a method of this class, called on the current object
+            receiver = KeywordConstant(TokenKeyword.THIS)
+            name = f"{self.class_name}.{first_identifier}"
+        self._expect_symbol("(")
+        args = self.compile_expression_list()
+        self._expect_symbol(")")
+        return SubroutineCall(name=name, receiver=receiver, args=args)
+
+    def compile_expression(self) -> Expression:
+        # term (op term)*, evaluated left to right
+        expression = self.compile_term()
+        while self.tokenizer.token_type() == TokenType.SYMBOL and self.tokenizer.symbol() in BINARY_OPS:
+            op = self.tokenizer.symbol()
             self.tokenizer.advance()
-            self.compile_statements()
+            expression = BinaryOp(op=op, left=expression, right=self.compile_term())
+        return expression
 
-            if self.tokenizer.symbol() != "}":
-                raise Exception
+    def compile_term(self) -> Expression:
+        # integerConstant | stringConstant | keywordConstant | varName |
+        # varName '['expression']' | subroutineCall | '('expression')' | unaryOp term
+        token_type = self.tokenizer.token_type()
+        if token_type == TokenType.INT_CONST:
+            term = IntegerConstant(self.tokenizer.int_val())
+            self.tokenizer.advance()
+        elif token_type == TokenType.STRING_CONST:
+            term = StringConstant(self.tokenizer.string_val())
+            self.tokenizer.advance()
+        elif token_type == TokenType.KEYWORD and self.tokenizer.keyword() in KEYWORD_CONSTANTS:
+            term = KeywordConstant(self.tokenizer.keyword())
+            self.tokenizer.advance()
+        elif token_type == TokenType.SYMBOL and self.tokenizer.symbol() == "(":
+            self.tokenizer.advance()
+            term = self.compile_expression()
+            self._expect_symbol(")")
+        elif token_type == TokenType.SYMBOL and self.tokenizer.symbol() in UNARY_OPS:
+            op = self.tokenizer.symbol()
+            self.tokenizer.advance()
+            term = UnaryOp(op=op, operand=self.compile_term())
+        elif token_type == TokenType.IDENTIFIER:
+            if self.tokenizer.peek() in ("(", "."):
+                first_identifier = self.tokenizer.identifier()
+                self.tokenizer.advance()
+                return self.compile_subroutine_call(first_identifier)
+            term = self._compile_variable()
+            if self._at_symbol("["):
+                self.tokenizer.advance()
+                term = ArrayAccess(array=term, index=self.compile_expression())
+                self._expect_symbol("]")
+        else:
+            raise self.tokenizer.error()
+        return term
+
+    def compile_expression_list(self) -> List[Expression]:
+        # (expression (',' expression)*)?
+        if self._at_symbol(")"):
+            return []
+        expressions = [self.compile_expression()]
+        while self._at_symbol(","):
             self.tokenizer.advance()
-        self.writer.write_label(end_label)
+            expressions.append(self.compile_expression())
+        return expressions
+
+
+def to_int16(value: int) -> int:
+    """value wrapped to a 16-bit two's complement word, as the Hack ALU computes it."""
+    return (value + 0x8000) % 0x10000 - 0x8000
+
+
+def constant_value(node: Expression) -> Optional[int]:
+    """The 16-bit value of an integer or keyword constant, None for anything else."""
+    if isinstance(node, IntegerConstant):
+        return to_int16(node.value)
+    if isinstance(node, KeywordConstant) and node.keyword != TokenKeyword.THIS:
+        return -1 if node.keyword == TokenKeyword.TRUE else 0
+    return None
+
+
+def evaluate_binary(op: str, x: int, y: int) -> Optional[int]:
+    """x op y as the VM and the OS compute it, None where that is not known at compile time."""
+    if op == "+":
+        return to_int16(x + y)
+    if op == "-":
+        return to_int16(x - y)
+    if op == "*":
+        # Math.multiply keeps the low 16 bits of the product
+        return to_int16(x * y)
+    if op == "/":
+        # Math.divide truncates toward zero; it never returns for 0 and
+        # cannot take the absolute value of -32768
+        if y == 0 or x == -32768 or y == -32768:
+            return None
+        quotient = abs(x) // abs(y)
+        return quotient if (x < 0) == (y < 0) else -quotient
+    if op == "&":
+        return x & y
+    if op == "|":
+        return x | y
+    # the comparisons test the sign of the wrapped difference
+    difference = to_int16(x - y)
+    if op == "<":
+        return -1 if difference < 0 else 0
+    if op == ">":
+        return -1 if difference > 0 else 0
+    return -1 if difference == 0 else 0
+
+
+def is_pure(node: Expression) -> bool:
+    """Whether evaluating node has no effect but its value, so it can be dropped."""
+    if isinstance(node, (SubroutineCall, StringConstant)):
+        return False
+    if isinstance(node, BinaryOp):
+        return is_pure(node.left) and is_pure(node.right)
+    if isinstance(node, UnaryOp):
+        return is_pure(node.operand)
+    if isinstance(node, ArrayAccess):
+        return is_pure(node.index)
+    return True
+
+
+def add_offset(node: Expression, offset: int) -> Expression:
+    if offset == 0:
+        return node
+    if -32768 < offset < 0:
+        return BinaryOp(op="-", left=node, right=IntegerConstant(-offset))
+    return BinaryOp(op="+", left=node, right=IntegerConstant(offset))
+
+
+class ConstantFolder:
+    """Evaluates constant expressions at compile time and simplifies identities.
+
+    Expressions are rewritten bottom up, so Jack's left to right evaluation
+    order is kept, and every operand that is not a constant is still
+    evaluated unless it is pure. folds counts the rewrites.
+    """
 
-    def compile_while(self):
-        # 'while' '(' expression ')' '{' statements '}'
-        if self.tokenizer.keyword() != TokenKeyword.WHILE:
-            raise Exception
+    def __init__(self):
+        self.folds = 0
+
+    def fold_class(self, node: ClassNode):
+        for subroutine in node.subroutines:
+            self.fold_statements(subroutine.statements)
+
+    def fold_statements(self, statements: List[Statement]):
+        for statement in statements:
+            if isinstance(statement, LetStatement):
+                if statement.index is not None:
+                    statement.index = self.fold(statement.index)
+                statement.value = self.fold(statement.value)
+            elif isinstance(statement, IfStatement):
+                statement.condition = self.fold(statement.condition)
+                self.fold_statements(statement.then_statements)
+                if statement.else_statements is not None:
+                    self.fold_statements(statement.else_statements)
+            elif isinstance(statement, WhileStatement):
+                statement.condition = self.fold(statement.condition)
+                self.fold_statements(statement.statements)
+            elif isinstance(statement, DoStatement):
+                self.fold(statement.call)
+            elif statement.value is not None:
+                statement.value = self.fold(statement.value)
+
+    def fold(self, node: Expression) -> Expression:
+        if isinstance(node, BinaryOp):
+            node.left = self.fold(node.left)
+            node.right = self.fold(node.right)
+            return self._fold_binary(node)
+        if isinstance(node, UnaryOp):
+            node.operand = self.fold(node.operand)
+            return self._fold_unary(node)
+        if isinstance(node, SubroutineCall):
+            node.args = [self.fold(arg) for arg in node.args]
+        elif isinstance(node, ArrayAccess):
+            node.index = self.fold(node.index)
+        return node
+
+    def _fold_unary(self, node: UnaryOp) -> Expression:
+        value = constant_value(node.operand)
+        if value is not None:
+            self.folds += 1
+            return IntegerConstant(to_int16(-value) if node.op == "-" else ~value)
+        if isinstance(node.operand, UnaryOp) and node.operand.op == node.op:
+            # --x and ~~x
+            self.folds += 1
+            return node.operand.operand
+        return node
+
+    def _fold_binary(self, node: BinaryOp) -> Expression:
+        op = node.op
+        x = constant_value(node.left)
+        y = constant_value(node.right)
+        if x is not None and y is not None:
+            value = evaluate_binary(op, x, y)
+            if value is None:
+                return node
+            self.folds += 1
+            return IntegerConstant(value)
+
+        simplified = None
+        if y == 0 and op in ("+", "-", "|") or y == 1 and op in ("*", "/") or y == -1 and op == "&":
+            simplified = node.left
+        elif x == 0 and op in ("+", "|") or x == 1 and op == "*" or x == -1 and op == "&":
+            simplified = node.right
+        elif x == 0 and op == "-":
+            simplified = UnaryOp(op="-", operand=node.right)
+        elif (
+            y == 0 and op in ("*", "&") and is_pure(node.left)
+            or x == 0 and op in ("*", "&") and is_pure(node.right)
+        ):
+            simplified = IntegerConstant(0)
+        elif (
+            y is not None
+            and op in ("+", "-")
+            and isinstance(node.left, BinaryOp)
+            and node.left.op in ("+", "-")
+            and constant_value(node.left.right) is not None
+        ):
+            # (x + a) - b is x + (a - b), as addition wraps
+            offset = constant_value(node.left.right)
+            if node.left.op == "-":
+                offset = -offset
+            offset = to_int16(offset + y if op == "+" else offset - y)
+            simplified = add_offset(node.left.left, offset)
+        if simplified is None:
+            return node
+        self.folds += 1
+        return simplified
+
+
+def falls_through(statements: List[Statement]) -> bool:
+    """Whether running statements can continue with whatever follows them."""
+    if not statements:
+        return True
+    last = statements[-1]
+    if isinstance(last, ReturnStatement):
+        return False
+    if isinstance(last, WhileStatement):
+        # Jack has no break, so a loop on true (-1) is only left by return;
+        # any other constant is false, as not then if-goto tests it
+        return constant_value(last.condition) != -1
+    if isinstance(last, IfStatement):
+        return (
+            last.else_statements is None
+            or falls_through(last.then_statements)
+            or falls_through(last.else_statements)
+        )
+    return True
 
-        self.tokenizer.advance()
-        if self.tokenizer.symbol() != "(":
-            raise Exception
 
-        self.tokenizer.advance()
-        start_label = f"L{self.label_count}"
-        end_label = f"L{self.label_count + 1}"
-        self.label_count += 2
-        self.writer.write_label(start_label)
-        self.compile_expression()
-        self.writer.write_arithmetic(VMArithmetic.NOT)
-        self.writer.write_if(end_label)
+class DeadCodeEliminator:
+    """Removes statements that can never run and branches on constant conditions."""
 
-        if self.tokenizer.symbol() != ")":
-            raise Exception
+    def __init__(self):
+        self.statements_removed = 0
+        self.branches_pruned = 0
+
+    def eliminate_class(self, node: ClassNode):
+        for subroutine in node.subroutines:
+            subroutine.statements = self.eliminate(subroutine.statements)
+
+    def eliminate(self, statements: List[Statement]) -> List[Statement]:
+        live: List[Statement] = []
+        for i, statement in enumerate(statements):
+            if isinstance(statement, IfStatement):
+                statement.then_statements = self.eliminate(statement.then_statements)
+                if statement.else_statements is not None:
+                    statement.else_statements = self.eliminate(statement.else_statements)
+                condition = constant_value(statement.condition)
+                if condition is not None:
+                    # only the arm the constant selects is left, in place of the
+                    # if; that is the then arm for -1 alone
+                    self.branches_pruned += 1
+                    live += statement.then_statements if condition == -1 else statement.else_statements or []
+                elif not statement.then_statements and not statement.else_statements and is_pure(statement.condition):
+                    self.branches_pruned += 1
+                else:
+                    live.append(statement)
+            elif isinstance(statement, WhileStatement):
+                statement.statements = self.eliminate(statement.statements)
+                if constant_value(statement.condition) not in (None, -1):
+                    self.branches_pruned += 1
+                else:
+                    live.append(statement)
+            else:
+                live.append(statement)
+            if not falls_through(live):
+                self.statements_removed += len(statements) - i - 1
+                break
+        return live
 
-        self.tokenizer.advance()
-        if self.tokenizer.symbol() != "{":
-            raise Exception
 
-        self.tokenizer.advance()
-        self.compile_statements()
-        self.writer.write_goto(start_label)
+def is_boolean(node: Expression) -> bool:
+    """Whether node always evaluates to 0 or -1, so if-goto on it is exact.
 
-        if self.tokenizer.symbol() != "}":
-            raise Exception
+    Jack only takes -1 as true: not then if-goto treats any other value,
+    1 included, as false.
+    """
+    if isinstance(node, BinaryOp):
+        if node.op in ("<", ">", "="):
+            return True
+        return node.op in ("&", "|") and is_boolean(node.left) and is_boolean(node.right)
+    if isinstance(node, UnaryOp):
+        return node.op == "~" and is_boolean(node.operand)
+    return constant_value(node) in (0, -1)
+
+
+def negated_boolean(node: Expression) -> Optional[Expression]:
+    """Returns b if node is ~b for a boolean b."""
+    if isinstance(node, UnaryOp) and node.op == "~" and is_boolean(node.operand):
+        return node.operand
+    return None
+
+
+VM_ARITHMETIC_BY_OP = {
+    "+": "add",
+    "-": "sub",
+    "&": "and",
+    "|": "or",
+    "<": "lt",
+    ">": "gt",
+    "=": "eq",
+}
+VM_FUNCTION_BY_OP = {
+    "*": "Math.multiply",
+    "/": "Math.divide",
+}
 
-        self.writer.write_label(end_label)
-        self.tokenizer.advance()
+# Estimated Hack instructions VMTranslator.py spends on a VM command, which
+# for straight-line code are both its cycles and its ROM words
+VM_COMMAND_COST = {
+    "push constant": 7,
+    "push": 10,
+    "pop": 10,
+    "add": 10,
+    "sub": 10,
+    "and": 10,
+    "or": 10,
+    "neg": 6,
+    "not": 6,
+    "eq": 20,
+    "lt": 20,
+    "gt": 20,
+}
+CALL_WORDS = 49
+# cycles of `x * y` and `x / y` over `x + y`, measured with tools/OS
+CALL_CYCLES_BY_OP = {"*": 2800, "/": 2650}
+# temps strength reduction keeps x, the sign of x, and partial results in;
+# temp 0 is left to statements
+TEMP_X = 1
+TEMP_SIGN = 2
+TEMP_RESULT = 3
+
+# cycles of String.new and of each String.appendChar with tools/OS, on
+# the heap as Sys.init leaves it; leaked strings make later ones slower
+STRING_NEW_CYCLES = 28500
+APPEND_CHAR_CYCLES = 3900
+# push static, if-goto, push static
+POOLED_STRING_CYCLES = 22
+
+
+def string_heap_words(string: str) -> int:
+    """Heap words String.new takes: 3 fields and the characters, each block with a size word."""
+    return 3 + len(string) + 2
+
+VMCommand = Tuple
+
+
+def command_cost(command: VMCommand) -> int:
+    if command[0] == "push" and command[1] == VMSegment.CONST:
+        return VM_COMMAND_COST["push constant"]
+    return VM_COMMAND_COST[command[0]]
+
+
+def naf_digits(value: int) -> List[int]:
+    """The non-adjacent form of value >= 0, digits -1, 0 or 1, least significant first."""
+    digits = []
+    while value:
+        digit = 0
+        if value & 1:
+            digit = 2 - (value & 3)
+            value -= digit
+        digits.append(digit)
+        value >>= 1
+    return digits
+
+
+def push_word(value: int) -> List[VMCommand]:
+    if value == -32768:
+        return [("push", VMSegment.CONST, 32767), ("not",)]
+    return [("push", VMSegment.CONST, value)]
+
+
+def multiply_commands(load_x: Optional[VMCommand], multiplier: int) -> List[VMCommand]:
+    """x * multiplier, with x pushed by load_x or, if that is None, already on the stack.
+
+    The terms of the signed binary form of the multiplier are summed on
+    the stack while x is doubled in a temp; the low 16 bits of the
+    product are the same as Math.multiply's.
+    """
+    commands: List[VMCommand] = []
+    power = load_x
+    if power is None:
+        commands.append(("pop", VMSegment.TEMP, TEMP_X))
+        power = ("push", VMSegment.TEMP, TEMP_X)
+    digits = naf_digits(multiplier & 0xFFFF)[:16]
+    while digits and not digits[-1]:
+        digits.pop()
+    summing = False
+    for i, digit in enumerate(digits):
+        if digit:
+            commands.append(power)
+            if summing:
+                commands.append(("add",) if digit > 0 else ("sub",))
+            elif digit < 0:
+                commands.append(("neg",))
+            summing = True
+        if i < len(digits) - 1:
+            commands += [power, power, ("add",), ("pop", VMSegment.TEMP, TEMP_X)]
+            power = ("push", VMSegment.TEMP, TEMP_X)
+    return commands
+
+
+def divide_commands(divisor: int) -> List[VMCommand]:
+    """x / divisor, x on the stack, for a divisor that is a power of two up to 2 ** 14.
+
+    The Hack ALU cannot shift right, so each quotient bit is tested on
+    |x| and added; the quotient takes the sign of x, as Math.divide
+    truncates toward zero.
+    """
+    shift = abs(divisor).bit_length() - 1
+    x = ("push", VMSegment.TEMP, TEMP_X)
+    sign = ("push", VMSegment.TEMP, TEMP_SIGN)
+    result = ("push", VMSegment.TEMP, TEMP_RESULT)
+    commands: List[VMCommand] = [
+        ("pop", VMSegment.TEMP, TEMP_X),
+        x, ("push", VMSegment.CONST, 0), ("lt",), ("pop", VMSegment.TEMP, TEMP_SIGN),
+        # |x| is (x & ~sign) | (-x & sign)
+        x, sign, ("not",), ("and",), x, ("neg",), sign, ("and",), ("or",),
+        ("pop", VMSegment.TEMP, TEMP_X),
+    ]
+    for bit in range(shift, 16):
+        # bit 15 is only set for x = -32768
+        commands += [x, *push_word(to_int16(1 << bit)), ("and",), ("push", VMSegment.CONST, 0), ("eq",), ("not",)]
+        commands += [("push", VMSegment.CONST, 1 << (bit - shift)), ("and",)]
+        if bit > shift:
+            commands.append(("add",))
+    commands += [
+        ("pop", VMSegment.TEMP, TEMP_RESULT),
+        result, sign, ("not",), ("and",), result, ("neg",), sign, ("and",), ("or",),
+    ]
+    if divisor < 0:
+        commands.append(("neg",))
+    return commands
+
+
+# cycles a function's prologue spends zeroing each of its locals
+LOCAL_CYCLES = VM_COMMAND_COST["push constant"]
+
+
+def operands(node: Expression) -> List[Expression]:
+    """The expressions evaluated in evaluating node."""
+    if isinstance(node, BinaryOp):
+        return [node.left, node.right]
+    if isinstance(node, UnaryOp):
+        return [node.operand]
+    if isinstance(node, ArrayAccess):
+        return [node.index]
+    if isinstance(node, SubroutineCall):
+        return node.args
+    return []
+
+
+def expression_key(node: Expression) -> Optional[Tuple]:
+    """A key equal for expressions that compute the same value the same way.
+
+    None unless node is arithmetic on locals, arguments and constants only,
+    as only a let to one of those can change its value: a call cannot
+    reach its caller's locals or arguments.
+    """
+    value = constant_value(node)
+    if value is not None:
+        return ("constant", value)
+    if isinstance(node, Variable):
+        if node.segment in (VMSegment.LOCAL, VMSegment.ARG):
+            return (node.segment, node.index)
+        return None
+    if isinstance(node, UnaryOp):
+        operand = expression_key(node.operand)
+        return None if operand is None else (node.op, operand)
+    if isinstance(node, BinaryOp):
+        left = expression_key(node.left)
+        right = expression_key(node.right)
+        if left is None or right is None:
+            return None
+        if node.op in ("+", "*", "&", "|", "="):
+            left, right = sorted((left, right), key=repr)
+        return (node.op, left, right)
+    return None
+
+
+def variables_of(node: Expression) -> Set[Tuple[str, int]]:
+    """The (segment, index) of every local and argument node reads."""
+    if isinstance(node, Variable):
+        return {(node.segment, node.index)} if node.segment in (VMSegment.LOCAL, VMSegment.ARG) else set()
+    variables = set()
+    for operand in operands(node):
+        variables |= variables_of(operand)
+    return variables
+
+
+def assigned_variables(statements: List[Statement]) -> Set[Tuple[str, int]]:
+    """The (segment, index) of every local and argument a let in statements assigns."""
+    assigned = set()
+    for statement in statements:
+        if isinstance(statement, LetStatement):
+            if statement.index is None and statement.target.segment in (VMSegment.LOCAL, VMSegment.ARG):
+                assigned.add((statement.target.segment, statement.target.index))
+        elif isinstance(statement, IfStatement):
+            assigned |= assigned_variables(statement.then_statements)
+            if statement.else_statements is not None:
+                assigned |= assigned_variables(statement.else_statements)
+        elif isinstance(statement, WhileStatement):
+            assigned |= assigned_variables(statement.statements)
+    return assigned
+
+
+def has_division(node: Expression) -> bool:
+    if isinstance(node, BinaryOp) and node.op == "/":
+        return True
+    return any(has_division(operand) for operand in operands(node))
+
+
+def expression_cost(node: Expression) -> int:
+    """Estimated cycles of evaluating arithmetic on variables and constants."""
+    if isinstance(node, (IntegerConstant, KeywordConstant)):
+        return sum(map(command_cost, push_word(constant_value(node))))
+    if isinstance(node, Variable):
+        return VM_COMMAND_COST["push"]
+    if isinstance(node, UnaryOp):
+        return expression_cost(node.operand) + VM_COMMAND_COST["neg" if node.op == "-" else "not"]
+    cost = expression_cost(node.left) + expression_cost(node.right)
+    if node.op in CALL_CYCLES_BY_OP:
+        return cost + VM_COMMAND_COST["add"] + CALL_CYCLES_BY_OP[node.op]
+    return cost + VM_COMMAND_COST[VM_ARITHMETIC_BY_OP[node.op]]
+
+
+def statement_expressions(statement: Statement) -> List[Expression]:
+    """The expressions a statement evaluates once each time it runs, before any of its own statements."""
+    if isinstance(statement, LetStatement):
+        return [statement.value] if statement.index is None else [statement.index, statement.value]
+    if isinstance(statement, IfStatement):
+        return [statement.condition]
+    if isinstance(statement, DoStatement):
+        return [statement.call]
+    if isinstance(statement, ReturnStatement) and statement.value is not None:
+        return [statement.value]
+    return []
+
+
+class CommonSubexpressionEliminator:
+    """Keeps arithmetic on locals and arguments in new locals instead of computing it again.
+
+    In a run of statements, an expression computed again before a let to
+    any of its variables is computed once, into a local, just ahead of the
+    statement that first uses it. An expression a loop does not change is
+    computed once ahead of the loop. Only what every pass through the code
+    evaluates is moved, and a division, which fails on 0, only out of a
+    loop condition, which runs at least once anyway. Constant expressions
+    are left to ConstantFolder.
+
+    cycles_saved_by_function estimates the cycles saved in each function
+    for one run of each statement and one iteration of each loop.
+    """
 
-    def compile_do(self):
-        # 'do' subroutineCall';'
-        if self.tokenizer.keyword() != TokenKeyword.DO:
-            raise Exception
+    def __init__(self):
+        self.expressions_cached = 0
+        self.invariants_hoisted = 0
+        self.cycles_saved_by_function: Dict[str, int] = {}
+        self.subroutine: Optional[SubroutineNode] = None
+        self.first_temp = 0
+        self.cycles_saved = 0
+
+    def eliminate_class(self, node: ClassNode):
+        for subroutine in node.subroutines:
+            self.subroutine = subroutine
+            self.first_temp = subroutine.n_locals
+            self.cycles_saved = 0
+            subroutine.statements = self.eliminate(subroutine.statements)
+            if self.cycles_saved:
+                self.cycles_saved_by_function[f"{node.name}.{subroutine.name}"] = self.cycles_saved
+
+    def eliminate(self, statements: List[Statement]) -> List[Statement]:
+        for statement in statements:
+            if isinstance(statement, IfStatement):
+                statement.then_statements = self.eliminate(statement.then_statements)
+                if statement.else_statements is not None:
+                    statement.else_statements = self.eliminate(statement.else_statements)
+            elif isinstance(statement, WhileStatement):
+                statement.statements = self.eliminate(statement.statements)
+        statements = self._cache_common(statements)
+        optimized: List[Statement] = []
+        for statement in statements:
+            if isinstance(statement, WhileStatement):
+                optimized += self._hoist_invariants(statement)
+            optimized.append(statement)
+        return optimized
+
+    def _new_temp(self) -> Variable:
+        index = self.subroutine.n_locals
+        self.subroutine.n_locals += 1
+        # not a Jack name, so it cannot clash with the program's
+        return Variable(name=f"${index}", var_type=TokenKeyword.INT, segment=VMSegment.LOCAL, index=index)
+
+    def _is_temp_let(self, statement: Statement) -> bool:
+        return (
+            isinstance(statement, LetStatement)
+            and statement.index is None
+            and statement.target.segment == VMSegment.LOCAL
+            and statement.target.index >= self.first_temp
+        )
 
-        # handle subroutine call: subroutineName'('expressionList')' | (className|varName)'.'subroutineName'('expressionList')'
-        self.tokenizer.advance()
-        first_identifier = self.tokenizer.identifier()
+    def _cache_common(self, statements: List[Statement]) -> List[Statement]:
+        """Computes the most profitable repeated expression once, until none is left."""
+        while True:
+            best, best_saved = None, 0
+            for node, first, last, uses in self._repeated(statements):
+                saved = (uses - 1) * expression_cost(node) - VM_COMMAND_COST["pop"]
+                saved -= uses * VM_COMMAND_COST["push"] + LOCAL_CYCLES
+                if saved > best_saved:
+                    best, best_saved = (node, first, last), saved
+            if best is None:
+                return statements
+            node, first, last = best
+            temp = self._new_temp()
+            replacement = {expression_key(node): temp}
+            variables = variables_of(node)
+            for statement in statements[first : last + 1]:
+                # the statements inside one that changes none of the
+                # variables can use the local too
+                nested = not variables & assigned_variables([statement])
+                substitute_statement(statement, replacement, nested)
+            statements = statements[:first] + [LetStatement(target=temp, index=None, value=node)] + statements[first:]
+            self.expressions_cached += 1
+            self.cycles_saved += best_saved
+
+    def _repeated(self, statements: List[Statement]) -> Iterator[Tuple[Expression, int, int, int]]:
+        """Yields (expression, first statement, last statement, uses) for each run of uses of an expression.
+
+        A run ends at the statement after which a let may have changed the
+        expression's value.
+        """
+        # key: [expression, variables, first, last, uses]
+        runs: Dict[Tuple, list] = {}
+        for i, statement in enumerate(statements):
+            for expression in statement_expressions(statement):
+                for node in cacheable_subexpressions(expression):
+                    key = expression_key(node)
+                    if key not in runs:
+                        runs[key] = [node, variables_of(node), i, i, 0]
+                    runs[key][3] = i
+                    runs[key][4] += 1
+            assigned = assigned_variables([statement])
+            for key in [key for key, run in runs.items() if run[1] & assigned]:
+                node, _, first, last, uses = runs.pop(key)
+                yield node, first, last, uses
+        for node, _, first, last, uses in runs.values():
+            yield node, first, last, uses
+
+    def _hoist_invariants(self, loop: WhileStatement) -> List[Statement]:
+        """Moves what the loop does not change out of it, returning the lets to put ahead of it."""
+        hoisted: List[Statement] = []
+        assigned = assigned_variables(loop.statements)
+        # the lets of locals this pass added to the body, for an inner loop
+        # or for a repeated expression, may move out with their value
+        body: List[Statement] = []
+        for statement in loop.statements:
+            if (
+                self._is_temp_let(statement)
+                and not variables_of(statement.value) & assigned
+                and not has_division(statement.value)
+            ):
+                hoisted.append(statement)
+                assigned.discard((VMSegment.LOCAL, statement.target.index))
+            else:
+                body.append(statement)
+        loop.statements = body
+
+        # expressions evaluated on every iteration, by key: [expression, uses]
+        invariants: Dict[Tuple, list] = {}
+        evaluated = [(loop.condition, True)]
+        for statement in body:
+            if isinstance(statement, WhileStatement):
+                evaluated.append((statement.condition, False))
+            elif not isinstance(statement, ReturnStatement):
+                evaluated += [(expression, False) for expression in statement_expressions(statement)]
+        for expression, may_divide in evaluated:
+            for node in invariant_subexpressions(expression, assigned, may_divide):
+                invariants.setdefault(expression_key(node), [node, 0])[1] += 1
+
+        replacement: Dict[Tuple, Variable] = {}
+        for key, (node, uses) in invariants.items():
+            temp = self._new_temp()
+            replacement[key] = temp
+            hoisted.append(LetStatement(target=temp, index=None, value=node))
+            self.invariants_hoisted += 1
+            self.cycles_saved += uses * (expression_cost(node) - VM_COMMAND_COST["push"])
+        if replacement:
+            loop.condition = substitute(loop.condition, replacement)
+            for statement in loop.statements:
+                substitute_statement(statement, replacement, nested=True)
+        return hoisted
+
+
+def cacheable_subexpressions(node: Expression) -> Iterator[Expression]:
+    """Yields every part of node worth keeping in a local: arithmetic on at least one variable."""
+    if isinstance(node, (BinaryOp, UnaryOp)) and expression_key(node) is not None and variables_of(node):
+        yield node
+    for operand in operands(node):
+        yield from cacheable_subexpressions(operand)
+
+
+def invariant_subexpressions(node: Expression, assigned: Set[Tuple[str, int]], may_divide: bool) -> Iterator[Expression]:
+    """Yields the largest parts of node worth keeping in a local that read no variable in assigned."""
+    if isinstance(node, (BinaryOp, UnaryOp)) and expression_key(node) is not None:
+        variables = variables_of(node)
+        if variables and not variables & assigned and (may_divide or not has_division(node)):
+            yield node
+            return
+    for operand in operands(node):
+        yield from invariant_subexpressions(operand, assigned, may_divide)
+
+
+def substitute(node: Expression, replacement: Dict[Tuple, Variable]) -> Expression:
+    """node with each part whose key is in replacement replaced by its variable."""
+    if isinstance(node, (BinaryOp, UnaryOp)):
+        key = expression_key(node)
+        if key in replacement:
+            return replacement[key]
+    if isinstance(node, BinaryOp):
+        node.left = substitute(node.left, replacement)
+        node.right = substitute(node.right, replacement)
+    elif isinstance(node, UnaryOp):
+        node.operand = substitute(node.operand, replacement)
+    elif isinstance(node, ArrayAccess):
+        node.index = substitute(node.index, replacement)
+    elif isinstance(node, SubroutineCall):
+        node.args = [substitute(arg, replacement) for arg in node.args]
+    return node
+
+
+def substitute_statement(statement: Statement, replacement: Dict[Tuple, Variable], nested: bool):
+    """Substitutes in the expressions of statement and, if nested, of the statements it contains."""
+    if isinstance(statement, LetStatement):
+        if statement.index is not None:
+            statement.index = substitute(statement.index, replacement)
+        statement.value = substitute(statement.value, replacement)
+    elif isinstance(statement, IfStatement):
+        statement.condition = substitute(statement.condition, replacement)
+        if nested:
+            for inner in statement.then_statements + (statement.else_statements or []):
+                substitute_statement(inner, replacement, nested)
+    elif isinstance(statement, WhileStatement):
+        if nested:
+            statement.condition = substitute(statement.condition, replacement)
+            for inner in statement.statements:
+                substitute_statement(inner, replacement, nested)
+    elif isinstance(statement, DoStatement):
+        substitute(statement.call, replacement)
+    elif statement.value is not None:
+        statement.value = substitute(statement.value, replacement)
+
+
+def has_array_access(node: Expression) -> bool:
+    if isinstance(node, ArrayAccess):
+        return True
+    return any(has_array_access(operand) for operand in operands(node))
+
+
+def split_index(index: Expression) -> Tuple[Optional[Expression], int]:
+    """index as (base, offset) for an offset that push and pop that can take, base None for 0."""
+    value = constant_value(index)
+    if value is not None and value >= 0:
+        return None, value
+    if isinstance(index, BinaryOp) and index.op == "+":
+        offset = constant_value(index.right)
+        if offset is not None and offset >= 0:
+            return index.left, offset
+        offset = constant_value(index.left)
+        if offset is not None and offset >= 0:
+            return index.right, offset
+    return index, 0
+
+
+def address_key(array: Variable, base: Optional[Expression]) -> Optional[Tuple]:
+    """A key for array + base, None unless it only depends on locals, arguments and constants."""
+    array_key = expression_key(array)
+    base_key = ("constant", 0) if base is None else expression_key(base)
+    if array_key is None or base_key is None:
+        return None
+    return (array_key, base_key)
+
+
+class CodeGenerator:
+    """Writes the VM code of a class AST."""
+
+    def __init__(
+        self,
+        writer: "VMWriter",
+        strength_reduce: bool = False,
+        strength_max_growth: int = 256,
+        string_pool: bool = False,
+        eliminate_dead_code: bool = False,
+        rotate_loops: bool = False,
+        optimize_arrays: bool = False,
+    ):
+        self.writer = writer
+        self.class_name = None
+        self.n_statics = 0
+        self.n_fields = 0
+        self.label_count = 0
 
-        self.tokenizer.advance()
-        if self.tokenizer.symbol() == ".":
-            # (className|varName)'.'subroutineName'('expressionList')'
-            self.tokenizer.advance()
-            object_kind = self.subroutine_table.kind_of(first_identifier)
-            object_index = self.subroutine_table.index_of(first_identifier)
-            object_type = self.subroutine_table.type_of(first_identifier)
-            if object_kind == VarKind.NONE:
-                # lookup in the class table
-                object_kind = self.class_table.kind_of(first_identifier)
-                object_index = self.class_table.index_of(first_identifier)
-                object_type = self.class_table.type_of(first_identifier)
-
-            is_variable = object_kind != VarKind.NONE
-            # if this is a method, we need to push the object as the first arg
-            # otherwise, it is a function or static subroutine
-            if is_variable:
-                segment = VM_SEGMENT_BY_VAR_KIND[object_kind]
-                self.writer.write_push(segment=segment, index=object_index)
-                subroutine_name = f"{object_type}.{self.tokenizer.identifier()}"
+        self.eliminate_dead_code = eliminate_dead_code
+        self.jumps_dropped = 0
+
+        self.rotate_loops = rotate_loops
+        self.loops_rotated = 0
+        self.negations_dropped = 0
+
+        self.optimize_arrays = optimize_arrays
+        # the address_key of what pointer 1 holds, where known, and the
+        # variables it depends on; calls leave THAT as it was
+        self.that_address: Optional[Tuple] = None
+        self.that_variables: Set[Tuple[str, int]] = set()
+        self.offsets_folded = 0
+        self.pointer_reuses = 0
+        self.temps_avoided = 0
+
+        self.string_pool = string_pool
+        self.static_by_string: Dict[str, int] = {}
+        self.pooled_uses = 0
+        self.pool_cycles_saved = 0
+        self.pool_heap_saved = 0
+
+        self.strength_reduce = strength_reduce
+        self.strength_max_growth = strength_max_growth
+        self.reduced_by_op: DefaultDict[str, int] = defaultdict(int)
+        self.cycles_saved = 0
+        self.words_added = 0
+
+    def _new_label(self) -> str:
+        label = f"L{self.label_count}"
+        self.label_count += 1
+        return label
+
+    def _write_label(self, label: str):
+        # control can get here from elsewhere, with THAT pointing anywhere
+        self.that_address = None
+        self.writer.write_label(label)
+
+    def write_class(self, node: ClassNode):
+        self.class_name = node.name
+        self.n_statics = node.n_statics
+        self.n_fields = node.n_fields
+        for subroutine in node.subroutines:
+            self.write_subroutine(subroutine)
+
+    def write_subroutine(self, node: SubroutineNode):
+        self.writer.write_function(name=f"{self.class_name}.{node.name}", n_locals=node.n_locals)
+        self.that_address = None
+        if node.kind == TokenKeyword.METHOD:
+            # set THIS to the first argument
+            self.writer.write_push(segment=VMSegment.ARG, index=0)
+            self.writer.write_pop(segment=VMSegment.POINTER, index=0)
+        elif node.kind == TokenKeyword.CONSTRUCTOR:
+            # allocate memory for field variables
+            self.writer.write_push(segment=VMSegment.CONST, index=self.n_fields)
+            self.writer.write_call(name="Memory.alloc", n_args=1)
+            self.writer.write_pop(segment=VMSegment.POINTER, index=0)
+        self.write_statements(node.statements)
+
+    def write_statements(self, statements: List[Statement]):
+        for statement in statements:
+            if isinstance(statement, LetStatement):
+                self.write_let(statement)
+            elif isinstance(statement, IfStatement):
+                self.write_if(statement)
+            elif isinstance(statement, WhileStatement):
+                self.write_while(statement)
+            elif isinstance(statement, DoStatement):
+                self.write_subroutine_call(statement.call)
+                self.writer.write_pop(segment=VMSegment.TEMP, index=0)
             else:
-                subroutine_name = f"{first_identifier}.{self.tokenizer.identifier()}"
-            self.tokenizer.advance()
+                self.write_return(statement)
+
+    def write_let(self, node: LetStatement):
+        target = node.target
+        if node.index is None:
+            self.write_expression(node.value)
+            self.writer.write_pop(segment=target.segment, index=target.index)
+            if (target.segment, target.index) in self.that_variables:
+                self.that_address = None
+            return
+        if self.optimize_arrays:
+            self._write_array_store(node)
+            return
+        # offset the array by the index, then store through THAT
+        self.writer.write_push(segment=target.segment, index=target.index)
+        self.write_expression(node.index)
+        self.writer.write_arithmetic(VMArithmetic.ADD)
+        self.write_expression(node.value)
+        self.writer.write_pop(segment=VMSegment.TEMP, index=0)
+        self.writer.write_pop(segment=VMSegment.POINTER, index=1)
+        self.writer.write_push(segment=VMSegment.TEMP, index=0)
+        self.writer.write_pop(segment=VMSegment.THAT, index=0)
+
+    def _write_array_store(self, node: LetStatement):
+        target = node.target
+        base, offset = split_index(node.index)
+        if not has_array_access(node.value):
+            # THAT is left alone while the value is computed
+            offset = self._write_that_address(target, node.index)
+            self.write_expression(node.value)
+            self.temps_avoided += 1
+        elif address_key(target, base) is not None or is_pure(node.value) and is_pure(node.index):
+            # the value cannot change the address or tell when it was
+            # computed, so it goes first and THAT is set after it
+            self.write_expression(node.value)
+            offset = self._write_that_address(target, node.index)
+            self.temps_avoided += 1
         else:
-            # subroutineName'('expressionList')'
-            self.writer.write_push(segment=VMSegment.POINTER, index=0)
-            is_variable = True
-            subroutine_name = f"{self.class_name}.{first_identifier}"
-
-        if self.tokenizer.symbol() != "(":
-            raise Exception
+            self.writer.write_push(segment=target.segment, index=target.index)
+            if base is not None:
+                self.write_expression(base)
+                self.writer.write_arithmetic(VMArithmetic.ADD)
+            self.write_expression(node.value)
+            self.writer.write_pop(segment=VMSegment.TEMP, index=0)
+            self.writer.write_pop(segment=VMSegment.POINTER, index=1)
+            self.writer.write_push(segment=VMSegment.TEMP, index=0)
+            self._set_that_address(target, base)
+        self.writer.write_pop(segment=VMSegment.THAT, index=offset)
 
-        self.tokenizer.advance()
-        self.compile_expression_list()
-
-        if self.tokenizer.symbol() != ")":
-            raise Exception
-        n_args = self.expression_counts.pop()
-        if is_variable:
-            n_args += 1
-        self.writer.write_call(name=subroutine_name, n_args=n_args)
-        self.tokenizer.advance()
-        if self.tokenizer.symbol() != ";":
-            raise Exception
-        self.writer.write_pop(segment=VMSegment.TEMP, index=0)
-        self.tokenizer.advance()
+    def _write_that_address(self, array: Variable, index: Expression) -> int:
+        """Points THAT at array + index, less the offset it returns for push and pop that."""
+        if not self.optimize_arrays:
+            base, offset = index, 0
+        else:
+            base, offset = split_index(index)
+            if base is None or offset:
+                self.offsets_folded += 1
+            key = address_key(array, base)
+            if key is not None and key == self.that_address:
+                self.pointer_reuses += 1
+                return offset
+        self.writer.write_push(segment=array.segment, index=array.index)
+        if base is not None:
+            self.write_expression(base)
+            self.writer.write_arithmetic(VMArithmetic.ADD)
+        self.writer.write_pop(segment=VMSegment.POINTER, index=1)
+        self._set_that_address(array, base)
+        return offset
 
-    def compile_return(self):
-        if self.tokenizer.keyword() != TokenKeyword.RETURN:
-            raise Exception
+    def _set_that_address(self, array: Variable, base: Optional[Expression]):
+        if self.optimize_arrays:
+            self.that_address = address_key(array, base)
+            self.that_variables = variables_of(array) | (set() if base is None else variables_of(base))
 
-        self.tokenizer.advance()
+    def write_if(self, node: IfStatement):
         if (
-            self.tokenizer.token_type() == TokenType.SYMBOL
-            and self.tokenizer.symbol() == ";"
+            self.rotate_loops
+            and node.else_statements
+            and is_boolean(node.condition)
+            and negated_boolean(node.condition) is None
         ):
-            self.writer.write_push(segment=VMSegment.CONST, index=0)
-            self.writer.write_return()
-            self.tokenizer.advance()
+            self._write_if_else_first(node)
             return
-
-        self.compile_expression()
+        else_label = self._new_label()
+        end_label = self._new_label()
+        self._write_jump_unless(node.condition, else_label)
+        self.write_statements(node.then_statements)
+        # the jump over the else part is only needed if there is one and
+        # the then part can get to it
+        jump_to_end = not self.eliminate_dead_code or bool(node.else_statements) and falls_through(
+            node.then_statements
+        )
+        if jump_to_end:
+            self.writer.write_goto(end_label)
+        else:
+            self.jumps_dropped += 1
+        self._write_label(else_label)
+        if node.else_statements is not None:
+            self.write_statements(node.else_statements)
+        if jump_to_end:
+            self._write_label(end_label)
+
+    def _write_if_else_first(self, node: IfStatement):
+        """Writes an if with an else part as a jump to the then part on the condition itself."""
+        then_label = self._new_label()
+        end_label = self._new_label()
+        self.write_expression(node.condition)
+        self.writer.write_if(then_label)
+        self.negations_dropped += 1
+        self.write_statements(node.else_statements)
+        jump_to_end = not self.eliminate_dead_code or falls_through(node.else_statements)
+        if jump_to_end:
+            self.writer.write_goto(end_label)
+        else:
+            self.jumps_dropped += 1
+        self._write_label(then_label)
+        self.write_statements(node.then_statements)
+        if jump_to_end:
+            self._write_label(end_label)
+
+    def _write_jump_unless(self, condition: Expression, label: str):
+        """Jumps to label unless condition is true."""
+        operand = negated_boolean(condition) if self.rotate_loops else None
+        if operand is None:
+            self.write_expression(condition)
+            self.writer.write_arithmetic(VMArithmetic.NOT)
+        else:
+            # ~b is false exactly when b is true
+            self.write_expression(operand)
+            self.negations_dropped += 2
+        self.writer.write_if(label)
+
+    def write_while(self, node: WhileStatement):
+        # a loop on true (-1) needs no test, and one that cannot
+        # reach the end of its body no jump back
+        test = not self.eliminate_dead_code or constant_value(node.condition) != -1
+        jump_back = not self.eliminate_dead_code or falls_through(node.statements)
+        if (
+            self.rotate_loops
+            and test
+            and jump_back
+            and is_boolean(node.condition)
+            and negated_boolean(node.condition) is None
+        ):
+            self._write_rotated_while(node)
+            return
+        start_label = self._new_label()
+        end_label = self._new_label()
+        self._write_label(start_label)
+        if test:
+            self._write_jump_unless(node.condition, end_label)
+        else:
+            self.jumps_dropped += 1
+        self.write_statements(node.statements)
+        if jump_back:
+            self.writer.write_goto(start_label)
+        else:
+            self.jumps_dropped += 1
+        if test:
+            self._write_label(end_label)
+
+    def _write_rotated_while(self, node: WhileStatement):
+        """Writes a loop tested at the bottom, so each iteration takes one if-goto.
+
+        The loop is entered with a jump to the test. A loop on ~b stays
+        tested at the top, where b jumps out without a not.
+        """
+        body_label = self._new_label()
+        test_label = self._new_label()
+        self.writer.write_goto(test_label)
+        self._write_label(body_label)
+        self.write_statements(node.statements)
+        self._write_label(test_label)
+        self.write_expression(node.condition)
+        self.writer.write_if(body_label)
+        self.loops_rotated += 1
+        self.negations_dropped += 1
+
+    def write_return(self, node: ReturnStatement):
+        if node.value is None:
+            self.writer.write_push(segment=VMSegment.CONST, index=0)
+        else:
+            self.write_expression(node.value)
         self.writer.write_return()
-        self.tokenizer.advance()
 
-    def compile_expression(self):
-        # term (op term)*
-        self.compile_term()
-        while self.tokenizer.token_type() == TokenType.SYMBOL and self.tokenizer.symbol() in (
-            "+",
-            "-",
-            "*",
-            "/",
-            "&",
-            "|",
-            "<",
-            ">",
-            "=",
-        ):
-            op = self.tokenizer.symbol()
-            self.tokenizer.advance()
-            self.compile_term()
-            if op == "+":
-                self.writer.write_arithmetic(VMArithmetic.ADD)
-            elif op == "-":
-                self.writer.write_arithmetic(VMArithmetic.SUB)
-            elif op == "*":
-                self.writer.write_call("Math.multiply", 2)
-            elif op == "/":
-                self.writer.write_call("Math.divide", 2)
-            elif op == "&":
-                self.writer.write_arithmetic(VMArithmetic.AND)
-            elif op == "|":
-                self.writer.write_arithmetic(VMArithmetic.OR)
-            elif op == "<":
-                self.writer.write_arithmetic(VMArithmetic.LT)
-            elif op == ">":
-                self.writer.write_arithmetic(VMArithmetic.GT)
-            elif op == "=":
-                self.writer.write_arithmetic(VMArithmetic.EQ)
-
-    def compile_term(self):
-        # integerConstant | stringConstant | keywordConstant | varName |
-        # varName '['expression']' | subroutineCall | '('expression')' | unaryOp term
-        token_type = self.tokenizer.token_type()
-        if token_type == TokenType.INT_CONST:
-            # integerConstant
-            self.writer.write_push(
-                segment=VMSegment.CONST, index=self.tokenizer.int_val()
-            )
-            self.tokenizer.advance()
-        elif token_type == TokenType.STRING_CONST:
-            # stringConstant
-            string_const = self.tokenizer.string_val()
-            self.writer.write_push(segment=VMSegment.CONST, index=len(string_const))
-            self.writer.write_call(name="String.new", n_args=1)
-            for char in string_const:
-                self.writer.write_push(segment=VMSegment.CONST, index=ord(char))
-                self.writer.write_call(name="String.appendChar", n_args=2)
-            self.tokenizer.advance()
-        elif token_type == TokenType.KEYWORD and self.tokenizer.keyword() in (
-            TokenKeyword.TRUE,
-            TokenKeyword.FALSE,
-            TokenKeyword.NULL,
-            TokenKeyword.THIS,
-        ):
-            # keywordConstant
-            if self.tokenizer.keyword() == TokenKeyword.TRUE:
+    def write_subroutine_call(self, node: SubroutineCall):
+        # the object a method is called on goes first
+        if node.receiver is not None:
+            self.write_expression(node.receiver)
+        for arg in node.args:
+            self.write_expression(arg)
+        n_args = len(node.args) if node.receiver is None else len(node.args) + 1
+        self.writer.write_call(name=node.name, n_args=n_args)
+
+    def write_expression(self, node: Expression):
+        if isinstance(node, IntegerConstant):
+            self.write_integer(node.value)
+        elif isinstance(node, Variable):
+            self.writer.write_push(segment=node.segment, index=node.index)
+        elif isinstance(node, BinaryOp):
+            if node.op in VM_FUNCTION_BY_OP and self.strength_reduce and self._write_reduced(node):
+                return
+            self.write_expression(node.left)
+            self.write_expression(node.right)
+            if node.op in VM_FUNCTION_BY_OP:
+                self.writer.write_call(name=VM_FUNCTION_BY_OP[node.op], n_args=2)
+            else:
+                self.writer.write_arithmetic(VM_ARITHMETIC_BY_OP[node.op])
+        elif isinstance(node, UnaryOp):
+            self.write_expression(node.operand)
+            self.writer.write_arithmetic(VMArithmetic.NEG if node.op == "-" else VMArithmetic.NOT)
+        elif isinstance(node, SubroutineCall):
+            self.write_subroutine_call(node)
+        elif isinstance(node, ArrayAccess):
+            offset = self._write_that_address(node.array, node.index)
+            self.writer.write_push(segment=VMSegment.THAT, index=offset)
+        elif isinstance(node, KeywordConstant):
+            if node.keyword == TokenKeyword.TRUE:
                 self.writer.write_push(segment=VMSegment.CONST, index=1)
                 self.writer.write_arithmetic(VMArithmetic.NEG)
-            elif self.tokenizer.keyword() == TokenKeyword.FALSE:
-                self.writer.write_push(segment=VMSegment.CONST, index=0)
-            elif self.tokenizer.keyword() == TokenKeyword.NULL:
-                self.writer.write_push(segment=VMSegment.CONST, index=0)
-            elif self.tokenizer.keyword() == TokenKeyword.THIS:
+            elif node.keyword == TokenKeyword.THIS:
                 self.writer.write_push(segment=VMSegment.POINTER, index=0)
-
-            self.tokenizer.advance()
-        elif token_type == TokenType.SYMBOL and self.tokenizer.symbol() == "(":
-            # '(' expression ')'
-            self.tokenizer.advance()
-            self.compile_expression()
-            if self.tokenizer.symbol() != ")":
-                raise Exception
-            self.tokenizer.advance()
-        elif token_type == TokenType.SYMBOL and self.tokenizer.symbol() in ("-", "~"):
-            # unaryOp term
-            op = self.tokenizer.symbol()
-            self.tokenizer.advance()
-            self.compile_term()
-            if op == "-":
-                self.writer.write_arithmetic(VMArithmetic.NEG)
             else:
-                self.writer.write_arithmetic(VMArithmetic.NOT)
-        elif token_type == TokenType.IDENTIFIER:
-            # varName | varName'['expression']'| subroutineCall
-            first_identifier = self.tokenizer.identifier()
-            self.tokenizer.advance()
+                # false and null
+                self.writer.write_push(segment=VMSegment.CONST, index=0)
+        else:
+            self.write_string(node.value)
+
+    def _write_reduced(self, node: BinaryOp) -> bool:
+        """Writes x * c, c * x or x / c without a call where that is estimated to be faster.
+
+        The call is kept when the inline code would add more than
+        strength_max_growth ROM words, which under the default of 256
+        rules out every division. Returns whether node was written.
+        """
+        x, constant = node.left, constant_value(node.right)
+        if constant is None and node.op == "*":
+            x, constant = node.right, constant_value(node.left)
+        if constant is None:
+            return False
+        # x is evaluated in either case, and a variable x need not be
+        load_x = None
+        if isinstance(x, Variable):
+            load_x = ("push", x.segment, x.index)
+        if node.op == "*":
+            if not to_int16(constant):
+                return False
+            # a negative multiplier may be cheaper as the negated product
+            candidates = [multiply_commands(load_x, constant), multiply_commands(load_x, -constant) + [("neg",)]]
+            commands = min(candidates, key=lambda commands: sum(map(command_cost, commands)))
+        elif abs(constant) & (abs(constant) - 1) == 0 and 1 < abs(constant) <= 1 << 14:
+            load_x = None
+            commands = divide_commands(constant)
+        else:
+            return False
 
-            if (
-                self.tokenizer.token_type() == TokenType.SYMBOL
-                and self.tokenizer.symbol() == "["
-            ):
-                # varName '['expression']'
-                var_kind = self.subroutine_table.kind_of(first_identifier)
-                var_index = self.subroutine_table.index_of(first_identifier)
-                if var_kind == VarKind.NONE:
-                    # look at class table
-                    var_kind = self.class_table.kind_of(first_identifier)
-                    var_index = self.class_table.index_of(first_identifier)
-                # if we don't find it in either, then throw
-                if var_kind == VarKind.NONE:
-                    raise Exception
-                segment = VM_SEGMENT_BY_VAR_KIND[var_kind]
-                self.writer.write_push(segment=segment, index=var_index)
-                self.tokenizer.advance()
-                self.compile_expression()
-                if self.tokenizer.symbol() != "]":
-                    raise Exception
-                self.writer.write_arithmetic(VMArithmetic.ADD)
-                self.writer.write_pop(segment=VMSegment.POINTER, index=1)
-                self.writer.write_push(segment=VMSegment.THAT, index=0)
-                self.tokenizer.advance()
-            elif (
-                self.tokenizer.token_type() == TokenType.SYMBOL
-                and self.tokenizer.symbol() == "("
-            ):
-                # handle subroutine call: subroutineName'('expressionList')'
-                self.tokenizer.advance()
-                self.compile_expression_list()
-                if self.tokenizer.symbol() != ")":
-                    raise Exception
-                self.writer.write_push(segment=VMSegment.POINTER, index=0)
-                expression_count = self.expression_counts.pop() + 1
-                self.writer.write_call(
-                    name=f"{self.class_name}.{first_identifier}",
-                    n_args=expression_count,
-                )
-                self.tokenizer.advance()
-            elif (
-                self.tokenizer.token_type() == TokenType.SYMBOL
-                and self.tokenizer.symbol() == "."
-            ):
-                # handle subroutine call: (className|varName)'.'subroutineName'('expressionList')'
-                var_kind = self.subroutine_table.kind_of(first_identifier)
-                var_index = self.subroutine_table.index_of(first_identifier)
-                var_type = self.subroutine_table.type_of(first_identifier)
-                if var_kind == VarKind.NONE:
-                    # lookup in the class table
-                    var_kind = self.class_table.kind_of(first_identifier)
-                    var_index = self.class_table.index_of(first_identifier)
-                    var_type = self.class_table.type_of(first_identifier)
-                is_variable = var_kind != VarKind.NONE
-                # skip the '.'
-                self.tokenizer.advance()
-                # if this is a method, we need to push the object as the first arg
-                # otherwise, it is a function or static subroutine
-                if is_variable:
-                    segment = VM_SEGMENT_BY_VAR_KIND[var_kind]
-                    self.writer.write_push(segment=segment, index=var_index)
-                    subroutine_name = f"{var_type}.{self.tokenizer.identifier()}"
-                else:
-                    subroutine_name = (
-                        f"{first_identifier}.{self.tokenizer.identifier()}"
-                    )
+        cost = sum(map(command_cost, commands))
+        call_cost = VM_COMMAND_COST["push constant"] + (0 if load_x is None else VM_COMMAND_COST["push"])
+        saved = call_cost + CALL_CYCLES_BY_OP[node.op] - cost
+        growth = cost - call_cost - CALL_WORDS
+        if saved <= 0 or growth > self.strength_max_growth:
+            return False
 
-                self.tokenizer.advance()
-                if self.tokenizer.symbol() != "(":
-                    raise Exception
-                self.tokenizer.advance()
-                self.compile_expression_list()
-                if self.tokenizer.symbol() != ")":
-                    raise Exception
-                self.tokenizer.advance()
-                n_args = self.expression_counts.pop()
-                if is_variable:
-                    n_args += 1
-                self.writer.write_call(name=subroutine_name, n_args=n_args)
+        if load_x is None:
+            self.write_expression(x)
+        for command in commands:
+            if command[0] == "push":
+                self.writer.write_push(segment=command[1], index=command[2])
+            elif command[0] == "pop":
+                self.writer.write_pop(segment=command[1], index=command[2])
             else:
-                # varName
-                var_name = first_identifier
-                var_kind = self.subroutine_table.kind_of(var_name)
-                var_index = self.subroutine_table.index_of(var_name)
-                if var_kind == VarKind.NONE:
-                    # lookup in the class table
-                    var_kind = self.class_table.kind_of(var_name)
-                    var_index = self.class_table.index_of(var_name)
-
-                segment = VM_SEGMENT_BY_VAR_KIND[var_kind]
-                self.writer.write_push(segment=segment, index=var_index)
+                self.writer.write_arithmetic(command[0])
+        self.reduced_by_op[node.op] += 1
+        self.cycles_saved += saved
+        self.words_added += growth
+        return True
+
+    def write_integer(self, value: int):
+        # folding can leave negative constants, which push constant cannot take
+        if value == -32768:
+            self.writer.write_push(segment=VMSegment.CONST, index=32767)
+            self.writer.write_arithmetic(VMArithmetic.NOT)
+        elif value < 0:
+            self.writer.write_push(segment=VMSegment.CONST, index=-value)
+            self.writer.write_arithmetic(VMArithmetic.NEG)
         else:
-            raise Exception
+            self.writer.write_push(segment=VMSegment.CONST, index=value)
 
-    def compile_expression_list(self):
-        token_type = self.tokenizer.token_type()
-        expression_count = 0
-        if token_type == TokenType.INT_CONST:
-            self.compile_expression()
-        elif token_type == TokenType.STRING_CONST:
-            self.compile_expression()
-        elif token_type == TokenType.KEYWORD and self.tokenizer.keyword() in (
-            TokenKeyword.TRUE,
-            TokenKeyword.FALSE,
-            TokenKeyword.NULL,
-            TokenKeyword.THIS,
-        ):
-            self.compile_expression()
-        elif token_type == TokenType.SYMBOL and self.tokenizer.symbol() == "(":
-            self.compile_expression()
-        elif token_type == TokenType.SYMBOL and self.tokenizer.symbol() in ("-", "~"):
-            self.compile_expression()
-        elif token_type == TokenType.IDENTIFIER:
-            self.compile_expression()
+    def write_string(self, string: str):
+        if self.string_pool:
+            self._write_pooled_string(string)
         else:
-            self.expression_counts.append(expression_count)
-            return
-
-        expression_count += 1
-        while (
-            self.tokenizer.token_type() == TokenType.SYMBOL
-            and self.tokenizer.symbol() == ","
-        ):
-            expression_count += 1
-            self.tokenizer.advance()
-            self.compile_expression()
-        self.expression_counts.append(expression_count)
+            self._write_new_string(string)
+
+    def _write_new_string(self, string: str):
+        self.writer.write_push(segment=VMSegment.CONST, index=len(string))
+        self.writer.write_call(name="String.new", n_args=1)
+        for char in string:
+            self.writer.write_push(segment=VMSegment.CONST, index=ord(char))
+            self.writer.write_call(name="String.appendChar", n_args=2)
+
+    def _write_pooled_string(self, string: str):
+        """Pushes the one String object of a literal, kept in a static after the class's own.
+
+        The string is built the first time the literal is evaluated, so it
+        must not be changed or disposed of by the program.
+        """
+        if string not in self.static_by_string:
+            self.static_by_string[string] = self.n_statics + len(self.static_by_string)
+        index = self.static_by_string[string]
+        built_label = self._new_label()
+        self.writer.write_push(segment=VMSegment.STATIC, index=index)
+        self.writer.write_if(built_label)
+        self._write_new_string(string)
+        self.writer.write_pop(segment=VMSegment.STATIC, index=index)
+        self._write_label(built_label)
+        self.writer.write_push(segment=VMSegment.STATIC, index=index)
+        self.pooled_uses += 1
+        self.pool_cycles_saved += STRING_NEW_CYCLES + APPEND_CHAR_CYCLES * len(string) - POOLED_STRING_CYCLES
+        self.pool_heap_saved += string_heap_words(string)
+
+
+class CompilerOptions(NamedTuple):
+    fold: bool = False
+    strength_reduce: bool = False
+    strength_max_growth: int = 256
+    string_pool: bool = False
+    eliminate_dead_code: bool = False
+    rotate_loops: bool = False
+    eliminate_common_subexpressions: bool = False
+    optimize_arrays: bool = False
+
+
+def compile_file(in_file: TextIO, out_file: TextIO, options: CompilerOptions = CompilerOptions()) -> Dict[str, int]:
+    """Compiles one class, returning what each enabled optimization did, by name."""
+    report: Dict[str, int] = {}
+    class_node = CompilationEngine(in_file).compile_class()
+    if options.fold:
+        folder = ConstantFolder()
+        folder.fold_class(class_node)
+        report["constant folds"] = folder.folds
+    if options.eliminate_dead_code:
+        eliminator = DeadCodeEliminator()
+        eliminator.eliminate_class(class_node)
+        report["unreachable statements removed"] = eliminator.statements_removed
+        report["constant branches pruned"] = eliminator.branches_pruned
+    if options.eliminate_common_subexpressions:
+        eliminator = CommonSubexpressionEliminator()
+        eliminator.eliminate_class(class_node)
+        report["subexpressions cached"] = eliminator.expressions_cached
+        report["loop invariants hoisted"] = eliminator.invariants_hoisted
+        for function_name, cycles in eliminator.cycles_saved_by_function.items():
+            report[f"cycles saved per pass in {function_name} (est.)"] = cycles
+    writer = VMWriter(out_file)
+    generator = CodeGenerator(
+        writer,
+        strength_reduce=options.strength_reduce,
+        strength_max_growth=options.strength_max_growth,
+        string_pool=options.string_pool,
+        eliminate_dead_code=options.eliminate_dead_code,
+        rotate_loops=options.rotate_loops,
+        optimize_arrays=options.optimize_arrays,
+    )
+    generator.write_class(class_node)
+    writer.close()
+    if options.strength_reduce:
+        report["multiplications inlined"] = generator.reduced_by_op["*"]
+        report["divisions inlined"] = generator.reduced_by_op["/"]
+        report["cycles saved per evaluation (est.)"] = generator.cycles_saved
+        report["ROM words added (est.)"] = generator.words_added
+    if options.string_pool:
+        report["pooled strings"] = len(generator.static_by_string)
+        report["pooled string uses"] = generator.pooled_uses
+        report["cycles saved per repeated evaluation (est.)"] = generator.pool_cycles_saved
+        report["heap words saved per repeated evaluation (est.)"] = generator.pool_heap_saved
+    if options.eliminate_dead_code:
+        report["jumps dropped"] = generator.jumps_dropped
+    if options.rotate_loops:
+        report["loops rotated"] = generator.loops_rotated
+        report["negations dropped"] = generator.negations_dropped
+    if options.optimize_arrays:
+        report["constant array offsets"] = generator.offsets_folded
+        report["array pointer reuses"] = generator.pointer_reuses
+        report["array stores without temps"] = generator.temps_avoided
+    return report
 
 
 class VarKind:
@@ -1062,22 +2002,71 @@ class VMWriter:
 
 
 if __name__ == "__main__":
-    path = sys.argv[1]
-    if os.path.isdir(path):
-        with os.scandir(path) as it:
-            for entry in it:
-                if entry.name.endswith(".jack") and entry.is_file():
-                    out_path = os.path.splitext(entry.path)[0]
-                    out_file = out_path + ".vm"
-                    with open(entry.path, "r") as in_file, open(
-                        out_file, "w"
-                    ) as out_file:
-                        tester = CompilationEngine(in_file=in_file, out_file=out_file)
-                        tester.compile_class()
-
+    arg_parser = argparse.ArgumentParser(description="Compiles Jack classes into VM code.")
+    arg_parser.add_argument("path", help=".jack file, or directory of .jack files to compile each of")
+    arg_parser.add_argument(
+        "--fold",
+        action="store_true",
+        help="evaluate constant expressions and simplify identities such as x + 0 at compile time",
+    )
+    arg_parser.add_argument(
+        "--strength-reduce",
+        action="store_true",
+        help="multiply by a constant with adds where faster than a call; division by a power of two with bit tests "
+        "adds 355 to 1486 ROM words, so it needs --strength-max-growth raised to at least that",
+    )
+    arg_parser.add_argument(
+        "--strength-max-growth",
+        type=int,
+        default=256,
+        help="most ROM words an inlined multiplication or division may add over the call it replaces",
+    )
+    arg_parser.add_argument(
+        "--dce",
+        action="store_true",
+        help="drop statements that cannot run, branches on constant conditions and jumps that are not needed",
+    )
+    arg_parser.add_argument(
+        "--cse",
+        action="store_true",
+        help="compute repeated arithmetic on locals and arguments once, and what a loop does not change before it",
+    )
+    arg_parser.add_argument(
+        "--rotate-loops",
+        action="store_true",
+        help="test while loops at the bottom, and branch on boolean conditions without negating them",
+    )
+    arg_parser.add_argument(
+        "--arrays",
+        action="store_true",
+        help="access a[i + k] as that k, keep THAT for another access at the same address, and store without temps",
+    )
+    arg_parser.add_argument(
+        "--string-pool",
+        action="store_true",
+        help="build each string literal once, on first use, and reuse it; the program must not change or dispose of it",
+    )
+    args = arg_parser.parse_args()
+    options = CompilerOptions(
+        fold=args.fold,
+        strength_reduce=args.strength_reduce,
+        strength_max_growth=args.strength_max_growth,
+        string_pool=args.string_pool,
+        eliminate_dead_code=args.dce,
+        rotate_loops=args.rotate_loops,
+        eliminate_common_subexpressions=args.cse,
+        optimize_arrays=args.arrays,
+    )
+
+    if os.path.isdir(args.path):
+        with os.scandir(args.path) as it:
+            in_paths = sorted(entry.path for entry in it if entry.name.endswith(".jack") and entry.is_file())
     else:
-        out_path = os.path.splitext(path)[0]
-        out_file = out_path + ".vm"
-        with open(path, "r") as in_file, open(out_file, "w") as out_file:
-            tester = CompilationEngine(in_file=in_file, out_file=out_file)
-            tester.compile_class()
+        in_paths = [args.path]
+    for in_path in in_paths:
+        out_path = os.path.splitext(in_path)[0] + ".vm"
+        with open(in_path, "r") as in_file, open(out_path, "w") as out_file:
+            report = compile_file(in_file=in_file, out_file=out_file, options=options)
+        if report:
+            counts = ", ".join(f"{count} {name}" for name, count in report.items())
+            print(f"{os.path.basename(in_path)}: {counts}", file=sys.stderr)
@@ -0,0 +1,46 @@
+import io
+import os
+import glob
+import time
+import argparse
+from typing import List
+
+from JackAnalyzer import JackTokenizer
+
+PROJECTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def read_sources(pattern: str) -> List[str]:
+    return [open(filename).read() for filename in sorted(glob.glob(pattern))]
+
+
+def count_tokens(sources: List[str]) -> int:
+    """Runs the tokenizer over every source as CompilationEngine does."""
+    num_tokens = 0
+    for source in sources:
+        tokenizer = JackTokenizer(io.StringIO(source))
+        while tokenizer.has_more_tokens():
+            tokenizer.advance()
+            tokenizer.token_type()
+            num_tokens += 1
+    return num_tokens
+
+
+def bench(name: str, sources: List[str], repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        num_tokens = count_tokens(sources)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<8} {num_tokens:>7} tokens {best * 1000:9.1f} ms  {num_tokens / best / 1000:8.1f}k tokens/s")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Times JackTokenizer on the OS and on Pong.")
+    arg_parser.add_argument("--scale", type=int, default=20, help="times each source set is tokenized per run")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the best is kept")
+    args = arg_parser.parse_args()
+
+    # repeat the sources so that the timings are measurable
+    bench("OS", read_sources(os.path.join(PROJECTS, "12", "*.jack")) * args.scale, args.repeat)
+    bench("Pong", read_sources(os.path.join(PROJECTS, "11", "Pong", "*.jack")) * args.scale, args.repeat)